@@ -1,138 +1,429 @@
+import argparse
+import collections
+import contextlib
+import fnmatch
+import glob
+import mmap
+import queue
 import socket
 import sys
 import os
+import threading
+import time
 
-def send_command(sock, command, headers=None):
-    sock.sendall((command + '\n').encode())
-    if headers:
-        send_headers(sock, headers)
-
-def send_headers(sock, headers):
-    for key, value in headers.items():
-        sock.sendall(f"{key}: {value}\n".encode())
-    sock.sendall(b'\n')  # End of headers
-
-def receive_line(sock):
-    line = b''
-    while not line.endswith(b'\n'):
-        char = sock.recv(1)
-        if not char:
-            break
-        line += char
-    return line.decode().strip()
-
-def receive_headers(sock):
-    headers = {}
-    while True:
-        line = receive_line(sock)
-        if line == '':
-            break  # End of headers
-        if ': ' in line:
-            key, value = line.split(": ", 1)
-            headers[key] = value
-        else:
-            print(f"Malformed header line: {line}")
-    return headers
+from compression import CODECS, DecodingError, DecodingReader, choose_encoding, parse_encodings, send_encoded
+from checkpoint import CheckpointWriter, load_checkpoint, remove_checkpoint, save_checkpoint
+from delta import DeltaError, SignatureTable, send_delta
+from store import DIGEST_ALGORITHM, file_sha256, format_digest
+from integrity import check_trailer, new_digest, send_trailer
+from scheduler import TransferScheduler, parse_rate
+from metrics import Metrics, ProgressReporter, SessionProfiler
+from passive import TOKEN
+from socket_options import DEFAULT_CONTROL_TIMEOUT, SocketOptions
+from ftp_protocol import MuxChannel, ProtocolError, ProtocolStream
+from transfer import DEFAULT_BUFFER_SIZE, PositionalWriter, receive_file, send_file, send_hashed
+from tree_transfer import CONTENT_TYPE, TreeError, receive_tree, send_tree
+
+# Size of the preallocated receive buffer used for downloads
+TRANSFER_BUFFER_SIZE = DEFAULT_BUFFER_SIZE
+
+# Checkpoints of interrupted GETs and PUTs live here; a GET's data is kept in
+# <filename>.part until it completes
+CHECKPOINT_DIRECTORY = ".ftp-resume"
+
+# Names requested per LS page from servers that support paged listings
+LISTING_PAGE_SIZE = 1000
+
+# Command latencies and transfer sizes and rates of this client, printed by
+# the STATS command alongside the server's
+METRICS = Metrics()
+
+# Caps the combined rate of this client's transfers with --rate-limit,
+# including every PGET segment and MGET/MPUT worker session
+SCHEDULER = None
+
+# Transfers are checked against Content-Digest trailers whenever the server
+# supports them, unless disabled with --no-verify
+VERIFY_TRANSFERS = True
+
+# Timeouts and buffer sizes of this client's connections (see
+# socket_options.py): with --timeout, a server that stops answering, or
+# never connects to our Data-Port, fails the command instead of hanging it
+SOCKET_OPTIONS = SocketOptions()
+
+# PGET never splits a file into segments smaller than this
+MIN_SEGMENT_SIZE = 1024 * 1024
 
-def list_files(control_sock):
-    # Generate an ephemeral port by binding to port 0
-    data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    data_socket.bind(('', 0))  # Ephemeral port
-    data_socket.listen(1)
-    data_port = data_socket.getsockname()[1]  # Retrieve ephemeral port number
+class ClientSession:
+    # Control connection plus whatever data-channel mode was negotiated
+    def __init__(self, control):
+        self.control = control
+        self.address = None  # (host, port), used to open extra sessions
+        self.features = {}
+        self.multiplexed = False  # Server agreed to a persistent data channel
+        self.mux = None
+        self.next_transfer_id = 1
+        self.encoding = None  # Content-Encoding agreed with the server, if any
+        self.passive = None  # (port, secret) once the server agreed to PASV
 
-    # Send LS command with Data-Port header over control channel
-    send_command(control_sock, "LS", headers={"Data-Port": str(data_port)})
+    def new_transfer_id(self):
+        transfer_id = self.next_transfer_id
+        self.next_transfer_id += 1
+        return transfer_id
+
+def negotiate_features(session, multiplex=False, encoding=None, passive=False, verbose=True):
+    # Servers that predate FEAT answer "FAILURE 400 Invalid Command" and the
+    # session simply stays on the original protocol
+    session.control.send_command("FEAT")
+    response = session.control.read_line()
+    if response.startswith("SUCCESS 211"):
+        session.features = session.control.read_headers()
+    if multiplex:
+        if "multiplexed" in session.features.get("Data-Channel", ""):
+            session.multiplexed = True
+            if verbose:
+                print("Using a persistent multiplexed data channel.")
+        elif verbose:
+            print("Server does not support multiplexed data channels; "
+                  "using one data connection per transfer.")
+    if encoding:
+        if encoding in parse_encodings(session.features.get("Content-Encoding", "")):
+            session.encoding = encoding
+            if verbose:
+                print(f"Compressing transfers with {encoding} where it helps.")
+        elif verbose:
+            print(f"Server does not support {encoding} compression; transferring uncompressed.")
+    if passive and "Passive" in session.features:
+        session.control.send_command("PASV")
+        response = session.control.read_line()
+        if response.startswith("SUCCESS 227"):
+            port, secret = response.split()[2:4]
+            session.passive = (int(port), bytes.fromhex(secret))
+            if verbose:
+                print("Using passive data connections.")
+
+def connect_passive(session, headers):
+    # Connects to the server's passive port and identifies the connection
+    # with a fresh nonce, named again in the command's Data-Token header
+    port, secret = session.passive
+    nonce = int(headers.get("Transfer-Id", 0)) or session.new_transfer_id()
+    data_socket = SOCKET_OPTIONS.data_socket()
+    data_socket.connect((session.address[0], port))
+    data_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    data_socket.sendall(TOKEN.pack(secret, nonce))
+    headers["Data-Token"] = str(nonce)
+    return data_socket
+
+def open_data_channel(session, command, headers=None, verbose=True):
+    # Sends a GET/PUT/LS command and returns (response, data channel). The
+    # data channel is None when the server rejected the command.
+    control = session.control
+    headers = dict(headers or {})
+    data_socket = None
+    connected = None  # Passive mode: our connection to the server
+    started = time.perf_counter()
+    if session.multiplexed:
+        transfer_id = session.new_transfer_id()
+        headers["Transfer-Id"] = str(transfer_id)
+    if session.mux is None and session.passive is not None:
+        # Connect before sending the command, so the server finds the
+        # connection waiting instead of dialing back to us
+        connected = connect_passive(session, headers)
+        if session.multiplexed:
+            headers["Data-Channel"] = "multiplexed"
+    elif session.mux is None:
+        # Generate an ephemeral port by binding to port 0
+        data_socket = SOCKET_OPTIONS.data_socket()
+        data_socket.bind(('', 0))  # Ephemeral port
+        data_socket.listen(1)
+        data_port = data_socket.getsockname()[1]  # Retrieve ephemeral port number
+        headers["Data-Port"] = str(data_port)
+        if session.multiplexed:
+            headers["Data-Channel"] = "multiplexed"
+
+    # Send command with its headers over control channel
+    control.send_command(command, headers=headers)
 
     # Wait for server response over control channel
-    response = receive_line(control_sock)
-    print("Server:", response)
+    response = control.read_line()
+    if verbose:
+        print("Server:", response)
     if not response.startswith("SUCCESS 200"):
-        print("Server rejected the LS command.")
-        data_socket.close()
-        return
+        for sock in (data_socket, connected):
+            if sock is not None:
+                sock.close()
+        return response, None
 
-    # Accept incoming connection from server on data channel
-    try:
-        conn, addr = data_socket.accept()
-        print(f"Data connection established with {addr}")
+    if data_socket is None and connected is None:
+        METRICS.observe("data_channel.setup_seconds", time.perf_counter() - started)
+        return response, paced(session.mux.open(transfer_id))
 
+    if connected is not None:
+        conn = connected
+    else:
+        # Accept incoming connection from server on data channel
+        try:
+            conn, addr = data_socket.accept()
+            if verbose:
+                print(f"Data connection established with {addr}")
+        finally:
+            data_socket.close()
+        SOCKET_OPTIONS.tune_data(conn)
+    METRICS.observe("data_channel.setup_seconds", time.perf_counter() - started)
+    if session.multiplexed:
+        SOCKET_OPTIONS.tune_channel(conn)
+        session.mux = MuxChannel(conn).start()
+        return response, paced(session.mux.open(transfer_id))
+    return response, paced(ProtocolStream(conn))
+
+def paced(data):
+    return SCHEDULER.pace(data) if SCHEDULER is not None else data
+
+def fetch_page(session, pattern=None, headers=None, verbose=True):
+    # Runs one LS; returns (lines, cursor for the next page or None), or None
+    # on failure
+    command = f"LS {pattern}" if pattern else "LS"
+    response, data = open_data_channel(session, command, headers=headers, verbose=verbose)
+    if data is None:
+        if verbose:
+            print("Server rejected the LS command.")
+        return None
+
+    try:
         # Receive headers over data channel
-        headers = receive_headers(conn)
-        content_length = int(headers.get("Content-Length", 0))
+        data_headers = data.read_headers()
+        content_length = int(data_headers.get("Content-Length", 0))
         if content_length == 0:
-            print("Invalid content length received.")
-            conn.close()
-            data_socket.close()
-            return
+            return [], None
 
         # Receive data over data channel
-        received_bytes = 0
-        file_list_data = b''
-        while received_bytes < content_length:
-            buffer_size = min(4096, content_length - received_bytes)
-            chunk = conn.recv(buffer_size)
-            if not chunk:
-                print("Connection lost while receiving file list.")
-                break
-            file_list_data += chunk
-            received_bytes += len(chunk)
+        try:
+            file_list_data = data.read_exact(content_length)
+        except ConnectionError:
+            print("Connection lost while receiving file list.")
+            return None
+    finally:
+        data.close()
+    return bytes(file_list_data).decode().split('\n'), data_headers.get("Next-After")
+
+def fetch_listing(session, pattern=None, verbose=True):
+    # Returns the names on the server matching pattern, or None on failure.
+    # Servers with paged listings match the pattern themselves and are asked
+    # a page at a time; older ones send every name in one go.
+    if "Listing" not in session.features:
+        page = fetch_page(session, verbose=verbose)
+        if page is None:
+            return None
+        return fnmatch.filter(page[0], pattern) if pattern else page[0]
+
+    headers = {"Limit": str(LISTING_PAGE_SIZE)}
+    names = []
+    while True:
+        page = fetch_page(session, pattern, headers, verbose=verbose and not names)
+        if page is None:
+            return None
+        lines, after = page
+        names += lines
+        if after is None:
+            return names
+        headers["After"] = after
+
+def list_files(session, pattern=None):
+    if "Listing" not in session.features:
+        files = fetch_listing(session, pattern)
+        if files is None:
+            return
 
-        # Decode and display the directory listing
-        file_list = file_list_data.decode()
+        # Display the directory listing
         print("Files on server:")
-        print(file_list)
+        print('\n'.join(files))
+        return
 
-        conn.close()
-    finally:
-        data_socket.close()
+    # Display the listing with sizes and dates, a page at a time as it arrives
+    headers = {"Format": "long", "Limit": str(LISTING_PAGE_SIZE)}
+    first = True
+    while True:
+        page = fetch_page(session, pattern, headers, verbose=first)
+        if page is None:
+            return
+        lines, after = page
+        if first:
+            print("Files on server:")
+            first = False
+        for line in lines:
+            size, mtime, name = line.split('\t', 2)
+            modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(int(mtime)))
+            print(f"{int(size):>12}  {modified}  {name}")
+        if after is None:
+            return
+        headers["After"] = after
 
-def download_file(control_sock, filename):
-    # Generate an ephemeral port for the data channel
-    data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    data_socket.bind(('', 0))  # Ephemeral port
-    data_socket.listen(1)
-    data_port = data_socket.getsockname()[1]
+def body_stream(data, data_headers):
+    # The data channel itself, or a decoder over it when the server
+    # compressed the body
+    encoding = data_headers.get("Content-Encoding")
+    return DecodingReader(data, encoding) if encoding else data
 
-    # Send GET command with Data-Port header
-    send_command(control_sock, f"GET {filename}", headers={"Data-Port": str(data_port)})
+def verifying(session):
+    return VERIFY_TRANSFERS and "Integrity" in session.features
 
-    # Wait for server response
-    response = receive_line(control_sock)
-    print("Server:", response)
-    if not response.startswith("SUCCESS 200"):
+def get_headers(session):
+    # Request headers for every GET: the compression agreed on, and a
+    # Content-Digest trailer from servers that can send one
+    headers = {}
+    if session.encoding:
+        headers["Accept-Encoding"] = session.encoding
+    if verifying(session):
+        headers["Want-Content-Digest"] = DIGEST_ALGORITHM
+    return headers
+
+def receive_body(data, data_headers, file, length, progress=None):
+    # Receives a GET body into file and checks it against the server's
+    # Content-Digest trailer when one was announced; returns (bytes
+    # received, error or None)
+    stream = body_stream(data, data_headers)
+    digest = new_digest() if data_headers.get("Trailer") == "Content-Digest" else None
+    received_bytes = receive_file(stream, file, length, TRANSFER_BUFFER_SIZE,
+                                  progress=progress, digest=digest)
+    if received_bytes < length:
+        return received_bytes, "Connection lost while receiving file data"
+    if digest is not None:
+        return received_bytes, check_trailer(data, stream, digest)
+    return received_bytes, None
+
+def save_download(data, data_headers, filename, filesize):
+    # Writes the body of a GET data channel to filename, which is removed
+    # again if the body fails verification; returns (bytes received, error
+    # or None)
+    with open(filename, 'wb', buffering=0) as file:
+        received_bytes, error = receive_body(data, data_headers, file, filesize)
+    if error and received_bytes == filesize:
+        os.remove(filename)
+    return received_bytes, error
+
+def send_upload(data, filename, length, offset=0, extra_headers=None, encoding=None,
+                verify=False, known_digest=None):
+    # Sends the headers and body of a PUT: length bytes of filename starting
+    # at offset, compressed with encoding if a sample of them shrinks. With
+    # verify the body is followed by a Content-Digest trailer, computed while
+    # sending unless the caller passes the Content-Digest of the whole file
+    # as known_digest (only valid when sending all of it).
+    headers = {"Content-Length": str(length)}
+    headers.update(extra_headers or {})
+    digest = None
+    if verify:
+        headers["Trailer"] = "Content-Digest"
+        if known_digest is None:
+            digest = new_digest()
+    with open(filename, 'rb') as file:
+        encoding = choose_encoding(file, offset, [encoding]) if encoding else None
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        data.send_headers(headers)
+        if encoding:
+            bytes_sent = send_encoded(data, file, encoding, offset, length, digest)
+        elif digest is not None:
+            bytes_sent = send_hashed(data, file, offset, length, digest)
+        else:
+            bytes_sent = send_file(data, file, offset, length)
+    if digest is not None and bytes_sent == length:
+        send_trailer(data, digest.digest())
+    elif known_digest is not None and bytes_sent == length:
+        data.send_headers({"Content-Digest": known_digest})
+    return bytes_sent
+
+def checkpoint_path(operation, filename):
+    os.makedirs(CHECKPOINT_DIRECTORY, exist_ok=True)
+    return os.path.join(CHECKPOINT_DIRECTORY, f"{operation}-{os.path.basename(filename)}.json")
+
+def source_id(stat):
+    # Identifies one version of a local file, see file_etag on the server
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+def digest_headers(session, filename):
+    # Servers with a content store skip the data transfer entirely when they
+    # already hold a file with this digest
+    if "Dedup" not in session.features:
+        return None
+    return {"Content-Digest": format_digest(file_sha256(filename))}
+
+def download_file(session, filename):
+    # Downloads into <filename>.part and renames it once complete. When an
+    # earlier attempt was interrupted and the server supports ranges, only
+    # the missing tail is requested; If-Range makes the server send the whole
+    # file instead if it has changed since.
+    part_path = filename + ".part"
+    get_checkpoint = checkpoint_path("get", filename)
+    headers = get_headers(session)
+    offset = 0
+    if "Range" in session.features:
+        checkpoint = load_checkpoint(get_checkpoint)
+        if checkpoint and os.path.exists(part_path):
+            offset = min(checkpoint.get("received", 0), os.path.getsize(part_path))
+        headers["Offset"] = str(offset)
+        if offset:
+            headers["If-Range"] = checkpoint.get("etag", "")
+
+    # Send GET command and wait for server response
+    response, data = open_data_channel(session, f"GET {filename}", headers=headers)
+    if data is None:
         print("Server rejected the GET command.")
-        data_socket.close()
         return
 
-    # Accept incoming data connection from server
     try:
-        conn, addr = data_socket.accept()
-        print(f"Data connection established with {addr}")
-
         # Receive headers
-        headers = receive_headers(conn)
-        filesize = int(headers.get("Content-Length", 0))
-        if filesize == 0:
+        data_headers = data.read_headers()
+        filesize = int(data_headers.get("Content-Length", 0))
+        start = int(data_headers.get("Offset", 0))
+        total = int(data_headers.get("Total-Length", filesize))
+        if total == 0:
             print("Invalid file size received.")
-            conn.close()
-            data_socket.close()
             return
 
-        print(f"Downloading '{filename}' of size {filesize} bytes.")
-        received_bytes = 0
-        with open(filename, 'wb') as file:
-            while received_bytes < filesize:
-                buffer_size = min(4096, filesize - received_bytes)
-                chunk = conn.recv(buffer_size)
-                if not chunk:
-                    print("Connection lost while receiving file data.")
-                    break
-                file.write(chunk)
-                received_bytes += len(chunk)
-                print(f"Received {received_bytes}/{filesize} bytes")
-        print(f"File '{filename}' downloaded successfully.")
+        if start:
+            print(f"Resuming '{filename}' at byte {start} of {total}.")
+        else:
+            if offset:
+                print("Remote file changed since the interrupted download; starting over.")
+            print(f"Downloading '{filename}' of size {total} bytes.")
+        if "Content-Encoding" in data_headers:
+            print(f"Server is compressing the transfer with {data_headers['Content-Encoding']}.")
+
+        checkpoint = {"size": total, "etag": data_headers.get("ETag"), "received": start}
+        with open(part_path, 'r+b' if start else 'wb', buffering=0) as file:
+            file.truncate(start)
+            file.seek(start)
+            save_checkpoint(get_checkpoint, checkpoint)
+            writer = CheckpointWriter(get_checkpoint, checkpoint, start)
+            reporter = ProgressReporter("Received", total, start)
+
+            def progress(received, expected):
+                writer(received, expected)
+                reporter(received, expected)
+
+            started = time.perf_counter()
+            try:
+                received_bytes, error = receive_body(data, data_headers, file, filesize, progress)
+            except DecodingError as e:
+                print(f"Invalid compressed data from server: {e}")
+                return
+            finally:
+                writer.save()
+        METRICS.record_transfer("get", received_bytes, time.perf_counter() - started)
         print(f"Total bytes transferred: {received_bytes}")
+        if received_bytes < filesize:
+            print(f"{error}.")
+            print(f"Kept {start + received_bytes} bytes in '{part_path}'; run GET again to resume.")
+            return
+        if error:
+            # Corrupt data is not worth resuming from
+            os.remove(part_path)
+            remove_checkpoint(get_checkpoint)
+            print(f"Download of '{filename}' failed verification: {error}. Run GET again.")
+            return
+        os.replace(part_path, filename)
+        remove_checkpoint(get_checkpoint)
+        print(f"File '{filename}' downloaded successfully.")
 
         # Now read the file and display its contents
         print("\nFile contents:")
@@ -142,98 +433,651 @@ def download_file(control_sock, filename):
         except UnicodeDecodeError:
             print("The file is not a text file and cannot be displayed.")
         print("\n")
-        conn.close()
     finally:
-        data_socket.close()
+        data.close()
+
+def upload_offset(session, filename, local_id):
+    # Asks the server how much of an interrupted upload of this exact local
+    # file it already holds
+    session.control.send_command(f"REST {os.path.basename(filename)} {local_id}")
+    response = session.control.read_line()
+    if not response.startswith("SUCCESS 213"):
+        return 0
+    return int(response.split()[2])
 
-def upload_file(control_sock, filename):
+def upload_file(session, filename):
     try:
-        filesize = os.path.getsize(filename)
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        print(f"File '{filename}' not found.")
+        return
+    filesize = stat.st_size
+    local_id = source_id(stat)
+
+    # A local checkpoint means an earlier PUT of this file did not finish
+    put_checkpoint = checkpoint_path("put", filename)
+    resumable = "Resume" in session.features
+    offset = 0
+    if resumable:
+        checkpoint = load_checkpoint(put_checkpoint)
+        if checkpoint and checkpoint.get("source_id") == local_id:
+            offset = upload_offset(session, filename, local_id)
+        save_checkpoint(put_checkpoint, {"source_id": local_id, "size": filesize})
+
+    if offset:
+        print(f"Resuming upload of '{filename}' at byte {offset} of {filesize}.")
+    else:
         print(f"Uploading '{filename}' of size {filesize} bytes.")
 
-        # Generate an ephemeral port for the data channel
-        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        data_socket.bind(('', 0))  # Ephemeral port
-        data_socket.listen(1)
-        data_port = data_socket.getsockname()[1]
+    # Send PUT command and wait for server response
+    headers = digest_headers(session, filename)
+    response, data = open_data_channel(session, f"PUT {os.path.basename(filename)}", headers=headers)
+    if response.startswith("SUCCESS 201"):
+        remove_checkpoint(put_checkpoint)
+        print(f"Server already has this content; upload of '{filename}' skipped.")
+        return
+    if data is None:
+        print("Server rejected the PUT command.")
+        return
 
-        # Send PUT command with Data-Port header
-        send_command(control_sock, f"PUT {filename}", headers={"Data-Port": str(data_port)})
+    try:
+        extra_headers = None
+        if resumable:
+            extra_headers = {"Offset": str(offset), "Source-Id": local_id}
+        started = time.perf_counter()
+        # The whole-file digest sent for deduplication doubles as the
+        # trailer of a PUT that sends the whole file
+        known_digest = headers["Content-Digest"] if headers and not offset else None
+        bytes_sent = send_upload(data, filename, filesize - offset, offset, extra_headers,
+                                 session.encoding, verifying(session), known_digest)
+        METRICS.record_transfer("put", bytes_sent, time.perf_counter() - started)
+        print("Finished sending file data.")
+        print(f"Total bytes transferred: {bytes_sent}")
+    finally:
+        data.close()
 
-        # Wait for server response
-        response = receive_line(control_sock)
-        print("Server:", response)
-        if not response.startswith("SUCCESS 200"):
-            print("Server rejected the PUT command.")
-            data_socket.close()
+    # Wait for server's final acknowledgment
+    response = session.control.read_line()
+    print("Server:", response)
+    if response.startswith("SUCCESS 201"):
+        remove_checkpoint(put_checkpoint)
+        print(f"File '{filename}' uploaded successfully.")
+    else:
+        print("Error: Did not receive upload completion confirmation from server.")
+
+def sync_file(session, filename):
+    # Uploads only what changed: the server sends block signatures of its
+    # copy and gets back COPY instructions for blocks it already has plus
+    # the new bytes in between
+    if "Delta" not in session.features:
+        print("Server does not support SYNC; uploading the whole file.")
+        upload_file(session, filename)
+        return
+    try:
+        filesize = os.path.getsize(filename)
+    except FileNotFoundError:
+        print(f"File '{filename}' not found.")
+        return
+
+    # Send SYNC command and wait for server response
+    response, data = open_data_channel(session, f"SYNC {os.path.basename(filename)}")
+    if data is None:
+        print("Server rejected the SYNC command.")
+        return
+
+    try:
+        # Receive the signatures of the server's copy
+        headers = data.read_headers()
+        block_size = int(headers.get("Block-Size", 0))
+        signatures = data.read_exact(int(headers.get("Content-Length", 0)))
+        try:
+            table = SignatureTable(signatures, block_size, int(headers.get("Basis-Length", 0)))
+        except DeltaError as e:
+            print(f"Invalid signatures received: {e}")
             return
+        print(f"Server copy has {table.block_count} block(s) of {block_size} bytes.")
+
+        # Send the delta; the file is mapped so the rolling search can index
+        # it without reading it all into memory
+        data.send_headers({"Total-Length": str(filesize)})
+        started = time.perf_counter()
+        with open(filename, 'rb') as file:
+            if filesize == 0:
+                literal_bytes, matched_bytes = send_delta(data, b'', table)
+            else:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        literal_bytes, matched_bytes = send_delta(data, view, table)
+                    finally:
+                        view.release()
+        METRICS.record_transfer("sync", literal_bytes, time.perf_counter() - started)
+        print(f"Sent {literal_bytes} new bytes; reused {matched_bytes} bytes of the server's copy.")
+    finally:
+        data.close()
+
+    # Wait for server's final acknowledgment
+    response = session.control.read_line()
+    print("Server:", response)
+    if response.startswith("SUCCESS 201"):
+        print(f"File '{filename}' synchronized successfully.")
+    else:
+        print("Error: Did not receive upload completion confirmation from server.")
+
+def download_tree(session, name, directory=None):
+    # GETDIR: extracts the server's tree called name into directory (name by
+    # default) while the archive arrives, adding to what is already there
+    if "Tree" not in session.features:
+        print("Server does not support directory transfers.")
+        return
+    directory = directory or name
+    response, data = open_data_channel(session, f"GETDIR {name}", headers=get_headers(session))
+    if data is None:
+        print("Server rejected the GETDIR command.")
+        return
+
+    started = time.perf_counter()
+    members = received_bytes = 0
+    try:
+        data_headers = data.read_headers()
+        digest = new_digest() if data_headers.get("Trailer") == "Content-Digest" else None
+        os.makedirs(directory, exist_ok=True)
+        members, received_bytes = receive_tree(data, directory, data_headers.get("Content-Encoding"),
+                                               digest)
+        error = check_trailer(data, data, digest) if digest is not None else None
+    except TreeError as e:
+        error = str(e)
+    except ConnectionError:
+        error = "Connection lost while receiving the archive"
+    finally:
+        data.close()
+    elapsed = time.perf_counter() - started
+    METRICS.record_transfer("getdir", received_bytes, elapsed)
+    if error:
+        print(f"Directory '{name}' was not received completely ({error}); "
+              f"files extracted into '{directory}' may be incomplete.")
+        return
+    print(f"Directory '{name}' downloaded into '{directory}': {members} entries, "
+          f"{received_bytes} bytes in {elapsed:.2f} s.")
+
+def upload_tree(session, directory, name=None):
+    # PUTDIR: streams the local tree as one archive; the server replaces its
+    # tree called name (the directory's own name by default) once all of it
+    # has arrived
+    if "Tree" not in session.features:
+        print("Server does not support directory transfers.")
+        return
+    if not os.path.isdir(directory):
+        print(f"Directory '{directory}' not found.")
+        return
+    name = name or os.path.basename(os.path.normpath(os.path.abspath(directory)))
+    response, data = open_data_channel(session, f"PUTDIR {name}")
+    if data is None:
+        print("Server rejected the PUTDIR command.")
+        return
+
+    headers = {"Content-Type": CONTENT_TYPE}
+    if session.encoding:
+        headers["Content-Encoding"] = session.encoding
+    digest = None
+    if verifying(session):
+        headers["Trailer"] = "Content-Digest"
+        digest = new_digest()
+    try:
+        started = time.perf_counter()
+        data.send_headers(headers)
+        members, bytes_sent = send_tree(data, directory, session.encoding, digest)
+        if digest is not None:
+            send_trailer(data, digest.digest())
+        elapsed = time.perf_counter() - started
+        METRICS.record_transfer("putdir", bytes_sent, elapsed)
+        print(f"Sent {members} entries, {bytes_sent} bytes in {elapsed:.2f} s.")
+    finally:
+        data.close()
+
+    # Wait for server's final acknowledgment
+    response = session.control.read_line()
+    print("Server:", response)
+    if response.startswith("SUCCESS 201"):
+        print(f"Directory '{directory}' uploaded successfully as '{name}'.")
+    else:
+        print("Error: Did not receive upload completion confirmation from server.")
+
+def remote_size(session, filename):
+    session.control.send_command(f"SIZE {filename}")
+    response = session.control.read_line()
+    if not response.startswith("SUCCESS 213"):
+        print("Server:", response)
+        return None
+    return int(response.split()[2])
+
+def download_range(session, filename, fd, offset, length):
+    # Fetches bytes [offset, offset + length) of filename into the same range
+    # of fd; returns (bytes received, error or None)
+    headers = {"Offset": str(offset), "Length": str(length)}
+    headers.update(get_headers(session))
+    response, data = open_data_channel(session, f"GET {filename}", headers=headers, verbose=False)
+    if data is None:
+        return 0, response
+    try:
+        data_headers = data.read_headers()
+        if (data_headers.get("Offset") != str(offset)
+                or data_headers.get("Content-Length") != str(length)):
+            return 0, "Server did not honor the requested range"
+        return receive_body(data, data_headers, PositionalWriter(fd, offset), length)
+    finally:
+        data.close()
+
+def preallocate(fd, size):
+    os.ftruncate(fd, size)
+    if size and hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fd, 0, size)
+
+def segmented_download(session, filename, segments):
+    # Splits filename into byte ranges fetched concurrently over separate
+    # sessions and written with pwrite into a preallocated <filename>.part,
+    # which replaces filename only once every segment has arrived intact
+    if "Range" not in session.features:
+        print("Server does not support byte ranges; using a single GET.")
+        download_file(session, filename)
+        return
+    filesize = remote_size(session, filename)
+    if filesize is None:
+        print("Server rejected the SIZE command.")
+        return
+
+    segments = max(1, min(segments, filesize // MIN_SEGMENT_SIZE))
+    bounds = [filesize * i // segments for i in range(segments + 1)]
+    print(f"Downloading '{filename}' of size {filesize} bytes in {segments} segment(s).")
+
+    part_path = filename + ".part"
+    # An interrupted GET's checkpoint would describe data this overwrites
+    remove_checkpoint(checkpoint_path("get", filename))
+    results = [None] * segments
+    complete = False
+    start = time.monotonic()
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        preallocate(fd, filesize)
+
+        def fetch(index):
+            offset, length = bounds[index], bounds[index + 1] - bounds[index]
+            try:
+                segment_session = connect_session(*session.address, multiplex=session.multiplexed,
+                                                  encoding=session.encoding,
+                                                  passive=session.passive is not None, verbose=False)
+            except OSError as e:
+                results[index] = (0, str(e))
+                return
+            try:
+                results[index] = download_range(segment_session, filename, fd, offset, length)
+            except (OSError, ProtocolError, DecodingError) as e:
+                results[index] = (0, str(e))
+            finally:
+                close_session(segment_session)
+
+        threads = [threading.Thread(target=fetch, args=(i,)) for i in range(segments)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        complete = not any(error for received, error in results)
+    finally:
+        os.close(fd)
+        if not complete:
+            # Missing or corrupt ranges would read as zeros
+            os.remove(part_path)
+
+    elapsed = max(time.monotonic() - start, 1e-9)
+    received_bytes = sum(received for received, error in results)
+    METRICS.record_transfer("pget", received_bytes, elapsed)
+    for index, (received, error) in enumerate(results):
+        if error:
+            print(f"Segment {index} (bytes {bounds[index]}-{bounds[index + 1] - 1}) failed: {error}")
+    if complete:
+        os.replace(part_path, filename)
+        print(f"File '{filename}' downloaded successfully.")
+    else:
+        print(f"Download of '{filename}' failed; run PGET again.")
+    print(f"Total bytes transferred: {received_bytes} in {elapsed:.2f} s "
+          f"({received_bytes / 2**20 / elapsed:.1f} MiB/s)")
+
+class BatchProgress:
+    # Aggregate progress of a batch, shared by all of its worker sessions
+    def __init__(self, total_files, interval=0.5):
+        self.total_files = total_files
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.last_report = 0.0
+        self.done = 0
+        self.bytes = 0
+        self.failures = []
+
+    def finished(self, name, transferred, error=None):
+        with self.lock:
+            self.done += 1
+            self.bytes += transferred
+            if error:
+                self.failures.append((name, error))
+            now = time.monotonic()
+            if now - self.last_report >= self.interval or self.done == self.total_files:
+                self.last_report = now
+                elapsed = max(now - self.start, 1e-9)
+                print(f"[{self.done}/{self.total_files} files] "
+                      f"{self.bytes / 2**20:.1f} MiB, {self.bytes / 2**20 / elapsed:.1f} MiB/s")
 
-        # Accept incoming data connection from server
+    def summary(self, operation):
+        elapsed = time.monotonic() - self.start
+        METRICS.record_transfer(operation.lower(), self.bytes, elapsed)
+        succeeded = self.done - len(self.failures)
+        print(f"{operation} finished: {succeeded} succeeded, {len(self.failures)} failed, "
+              f"{self.bytes} bytes in {elapsed:.2f} s "
+              f"({self.bytes / 2**20 / max(elapsed, 1e-9):.1f} MiB/s)")
+        for name, error in self.failures:
+            print(f"  {name}: {error}")
+
+def complete_batch_job(session, operation, name, response, data, known_digest=None):
+    # Finishes one GET/PUT whose command has already been answered; returns
+    # (bytes transferred, error or None). known_digest is the Content-Digest
+    # a PUT already announced, if any.
+    if response.startswith("SUCCESS 201"):
+        return 0, None  # The server already had the file
+    if data is None:
+        return 0, response
+    if operation == "GET":
         try:
-            conn, addr = data_socket.accept()
-            print(f"Data connection established with {addr}")
-
-            # Send headers over data channel
-            send_headers(conn, {"Content-Length": str(filesize)})
-
-            # Send the file data
-            with open(filename, 'rb') as file:
-                bytes_sent = 0
-                while True:
-                    chunk = file.read(4096)
-                    if not chunk:
-                        break
-                    conn.sendall(chunk)
-                    bytes_sent += len(chunk)
-                    print(f"Sent {bytes_sent}/{filesize} bytes")
-            print("Finished sending file data.")
-            print(f"Total bytes transferred: {bytes_sent}")
-
-            # Wait for server's final acknowledgment
-            response = receive_line(control_sock)
-            print("Server:", response)
-            if response.startswith("SUCCESS 201"):
-                print(f"File '{filename}' uploaded successfully.")
+            data_headers = data.read_headers()
+            filesize = int(data_headers.get("Content-Length", 0))
+            return save_download(data, data_headers, os.path.basename(name), filesize)
+        except DecodingError as e:
+            return 0, f"Invalid compressed data: {e}"
+        finally:
+            data.close()
+
+    try:
+        bytes_sent = send_upload(data, name, os.path.getsize(name), encoding=session.encoding,
+                                 verify=verifying(session), known_digest=known_digest)
+    finally:
+        data.close()
+    response = session.control.read_line()
+    if not response.startswith("SUCCESS 201"):
+        return bytes_sent, response
+    return bytes_sent, None
+
+def remote_name(operation, name):
+    return name if operation == "GET" else os.path.basename(name)
+
+def run_batch_worker(session, operation, jobs, progress, depth):
+    # With a multiplexed data channel up to depth commands are written ahead
+    # of their replies, so the server never waits a round trip for the next
+    # one. Without it every transfer needs its own data connection and the
+    # jobs run one after another.
+    pending = collections.deque()
+    while True:
+        while len(pending) < depth:
+            try:
+                name = jobs.get_nowait()
+            except queue.Empty:
+                break
+            command = f"{operation} {remote_name(operation, name)}"
+            if operation == "GET":
+                headers = get_headers(session)
             else:
-                print("Error: Did not receive upload completion confirmation from server.")
+                headers = digest_headers(session, name) or {}
+            known_digest = headers.get("Content-Digest")
+            if session.mux is None:
+                response, data = open_data_channel(session, command, headers=headers, verbose=False)
+                progress.finished(name, *complete_batch_job(session, operation, name, response, data,
+                                                            known_digest))
+                continue
+            transfer_id = session.new_transfer_id()
+            headers = dict(headers, **{"Transfer-Id": str(transfer_id)})
+            session.control.send_command(command, headers=headers)
+            pending.append((name, transfer_id, known_digest))
+        if not pending:
+            return
+        name, transfer_id, known_digest = pending.popleft()
+        response = session.control.read_line()
+        data = paced(session.mux.open(transfer_id)) if response.startswith("SUCCESS 200") else None
+        progress.finished(name, *complete_batch_job(session, operation, name, response, data,
+                                                    known_digest))
 
-            conn.close()
+def run_batch(session, operation, names, parallel, depth):
+    # Spreads the names over `parallel` extra control sessions
+    if not names:
+        print("No files matched.")
+        return
+    progress = BatchProgress(len(names))
+    jobs = queue.Queue()
+    for name in names:
+        jobs.put(name)
+
+    def worker():
+        try:
+            worker_session = connect_session(*session.address, multiplex=session.multiplexed,
+                                             encoding=session.encoding,
+                                             passive=session.passive is not None, verbose=False)
+        except OSError as e:
+            print(f"Could not open worker session: {e}")
+            return
+        try:
+            run_batch_worker(worker_session, operation, jobs, progress, depth)
+        except (OSError, ProtocolError) as e:
+            print(f"Worker session failed: {e}")
         finally:
-            data_socket.close()
-    except FileNotFoundError:
-        print(f"File '{filename}' not found.")
+            close_session(worker_session)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(parallel, len(names)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Anything left behind by a failed worker is reported rather than lost
+    while not jobs.empty():
+        progress.finished(jobs.get_nowait(), 0, "Not transferred")
+    progress.summary(f"M{operation}")
 
-def main():
-    if len(sys.argv) != 3:
-        print("Usage: python FTPClient.py <server_address> <server_port>")
-        sys.exit(1)
+def batch_get(session, pattern, parallel, depth):
+    files = fetch_listing(session, pattern, verbose=False)
+    if files is None:
+        print("Server rejected the LS command.")
+        return
+    run_batch(session, "GET", files, parallel, depth)
 
-    server_address = sys.argv[1]
-    server_port = int(sys.argv[2])
+def batch_put(session, pattern, parallel, depth):
+    names = [name for name in sorted(glob.glob(pattern)) if os.path.isfile(name)]
+    run_batch(session, "PUT", names, parallel, depth)
 
+def connect_session(server_address, server_port, multiplex=False, encoding=None, passive=True,
+                    verbose=True):
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.settimeout(SOCKET_OPTIONS.control_timeout)
     client_socket.connect((server_address, server_port))
+    # TCP_NODELAY: pipelined commands must go out immediately rather than
+    # wait for ACKs
+    SOCKET_OPTIONS.tune_control(client_socket)
+    session = ClientSession(ProtocolStream(client_socket))
+    session.address = (server_address, server_port)
+    negotiate_features(session, multiplex=multiplex, encoding=encoding, passive=passive,
+                       verbose=verbose)
+    return session
 
-    while True:
-        command = input("ftp> ").strip()
-        if command.startswith("GET "):
-            filename = command.split()[1]
-            download_file(client_socket, filename)
-        elif command.startswith("PUT "):
-            upload_file(client_socket, command.split()[1])
-        elif command == "LS":
-            list_files(client_socket)
-        elif command == "QUIT":
-            send_command(client_socket, command)
-            response = receive_line(client_socket)
+def close_session(session):
+    try:
+        session.control.send_command("QUIT")
+        session.control.read_line()
+    except OSError:
+        pass
+    if session.mux is not None:
+        session.mux.close()
+    session.control.close()
+
+def show_stats(session):
+    # The server's counters (when it supports STATS), then this client's
+    if "Stats" in session.features:
+        session.control.send_command("STATS")
+        response = session.control.read_line()
+        if response.startswith("SUCCESS 211"):
+            print("Server statistics:")
+            for name, value in session.control.read_headers().items():
+                print(f"  {name}: {value}")
+        else:
             print("Server:", response)
-            if response.startswith("SUCCESS 200"):
-                print("Connection closed by server.")
-                break
+    else:
+        print("Server does not report statistics.")
+    print("Client statistics:")
+    for name, value in METRICS.snapshot().items():
+        print(f"  {name}: {value}")
+
+# Commands timed under their own name in STATS; anything else is "other"
+TIMED_COMMANDS = {"GET", "PUT", "LS", "SYNC", "PGET", "MGET", "MPUT", "GETDIR", "PUTDIR", "STATS",
+                  "QUIT"}
+
+def run_command(session, command, args, profiler=None):
+    # Executes one command line; returns False once the session has ended
+    name = command.split()[0] if command.split() else ""
+    name = name.lower() if name in TIMED_COMMANDS else "other"
+    started = time.perf_counter()
+    try:
+        with profiler or contextlib.nullcontext():
+            return dispatch_command(session, command, args)
+    except (OSError, ProtocolError) as e:
+        # --timeout expired, or the server closed the session (after its
+        # idle timeout, for instance); the session cannot be used any more
+        print(f"Connection to the server failed: {e}")
+        return False
+    finally:
+        METRICS.observe(f"command.{name}.seconds", time.perf_counter() - started)
+
+def dispatch_command(session, command, args):
+    if command.startswith("GET "):
+        filename = command.split()[1]
+        download_file(session, filename)
+    elif command.startswith("PUT "):
+        upload_file(session, command.split()[1])
+    elif command == "LS" or command.startswith("LS "):
+        parts = command.split(maxsplit=1)
+        list_files(session, parts[1] if len(parts) > 1 else None)
+    elif command.startswith("SYNC "):
+        sync_file(session, command.split()[1])
+    elif command.startswith("GETDIR "):
+        parts = command.split()
+        download_tree(session, parts[1], parts[2] if len(parts) > 2 else None)
+    elif command.startswith("PUTDIR "):
+        parts = command.split()
+        upload_tree(session, parts[1], parts[2] if len(parts) > 2 else None)
+    elif command.startswith("PGET "):
+        parts = command.split()
+        segments = int(parts[2]) if len(parts) > 2 else args.segments
+        segmented_download(session, parts[1], segments)
+    elif command.startswith("MGET "):
+        batch_get(session, command.split()[1], args.parallel, args.pipeline_depth)
+    elif command.startswith("MPUT "):
+        batch_put(session, command.split()[1], args.parallel, args.pipeline_depth)
+    elif command == "STATS":
+        show_stats(session)
+    elif command == "QUIT":
+        session.control.send_command(command)
+        response = session.control.read_line()
+        print("Server:", response)
+        if response.startswith("SUCCESS 200"):
+            print("Connection closed by server.")
+            return False
+    else:
+        print("Invalid or unsupported command.")
+    return True
+
+def read_script(path):
+    # Yields the commands of a script file ("-" for stdin), skipping blank
+    # lines and # comments
+    file = sys.stdin if path == "-" else open(path)
+    try:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="FTP client")
+    parser.add_argument("server_address")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("--buffer-size", type=int, default=TRANSFER_BUFFER_SIZE,
+                        help="receive buffer size in bytes for downloads")
+    parser.add_argument("--multiplex", action="store_true",
+                        help="carry all transfers over one persistent data connection "
+                             "when the server supports it")
+    parser.add_argument("--active", action="store_true",
+                        help="have the server connect back to this client for data "
+                             "instead of connecting to the server's passive port")
+    parser.add_argument("--compress", choices=list(CODECS), metavar="CODEC",
+                        help="compress GET/PUT bodies with CODEC (one of: %(choices)s) "
+                             "when the server supports it")
+    parser.add_argument("--script", metavar="FILE",
+                        help="run the commands in FILE (- for stdin) instead of prompting")
+    parser.add_argument("--parallel", type=int, default=4,
+                        help="concurrent sessions used by MGET/MPUT (default: 4)")
+    parser.add_argument("--segments", type=int, default=4,
+                        help="parallel byte-range segments used by PGET (default: 4)")
+    parser.add_argument("--pipeline-depth", type=int, default=8,
+                        help="commands kept in flight per MGET/MPUT session on a "
+                             "multiplexed data channel (default: 8)")
+    parser.add_argument("--rate-limit", type=parse_rate, default=0, metavar="RATE",
+                        help="cap on the combined rate of this client's transfers in "
+                             "bytes/s, e.g. 10M")
+    parser.add_argument("--no-verify", action="store_true",
+                        help="skip Content-Digest verification of transfers, which costs "
+                             "about as much CPU as the transfer itself")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_CONTROL_TIMEOUT, metavar="SECS",
+                        help="give up on a command when the server does not answer or "
+                             "move data for this many seconds, 0 to wait forever (default: 60)")
+    parser.add_argument("--sndbuf", type=int, default=0, metavar="BYTES",
+                        help="SO_SNDBUF of data connections (default: 0, kernel autotuning)")
+    parser.add_argument("--rcvbuf", type=int, default=0, metavar="BYTES",
+                        help="SO_RCVBUF of data connections (default: 0, kernel autotuning)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="profile every command with cProfile and write the stats to FILE")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global TRANSFER_BUFFER_SIZE, SCHEDULER, VERIFY_TRANSFERS, SOCKET_OPTIONS
+    args = parse_args(argv)
+    TRANSFER_BUFFER_SIZE = args.buffer_size
+    SOCKET_OPTIONS = SocketOptions(args.timeout, args.timeout, sndbuf=args.sndbuf,
+                                   rcvbuf=args.rcvbuf)
+    VERIFY_TRANSFERS = not args.no_verify
+    if args.rate_limit:
+        SCHEDULER = TransferScheduler(args.rate_limit)
+
+    session = connect_session(args.server_address, args.server_port, multiplex=args.multiplex,
+                              encoding=args.compress, passive=not args.active)
+    profiler = SessionProfiler(args.profile) if args.profile else None
+
+    try:
+        if args.script:
+            for command in read_script(args.script):
+                print(f"ftp> {command}")
+                if not run_command(session, command, args, profiler):
+                    break
+            else:
+                close_session(session)
+                return
         else:
-            print("Invalid or unsupported command.")
+            while True:
+                command = input("ftp> ").strip()
+                if not run_command(session, command, args, profiler):
+                    break
 
-    client_socket.close()
+        if session.mux is not None:
+            session.mux.close()
+        session.control.close()
+    finally:
+        if profiler is not None:
+            profiler.dump()
+            print(f"Profile written to {args.profile}")
 
 if __name__ == "__main__":
     main()
@@ -1,194 +1,1106 @@
-import socket
+import argparse
+import contextlib
+import errno
 import os
+import shutil
+import signal
+import socket
+import stat
+import tempfile
+import time
+
+import prefork
+import server_engine
+from ftp_protocol import MuxChannel, ProtocolError, ProtocolStream, format_headers
+from compression import CODECS, DecodingError, DecodingReader, choose_encoding, parse_encodings, send_encoded
+from store import ContentStore, ManifestFile, parse_digest
+from storage import FSYNC_MODES, LAYOUTS, FileStorage, valid_name
+from checkpoint import CheckpointWriter, load_checkpoint, remove_checkpoint, save_checkpoint
+from directory_index import DirectoryIndex
+from passive import PassiveListener, parse_port_range
+from socket_options import (DEFAULT_CONTROL_TIMEOUT, DEFAULT_DATA_TIMEOUT, DEFAULT_IDLE_TIMEOUT,
+                            DEFAULT_KEEPALIVE, SocketOptions, optional_timeout)
+from scheduler import TransferScheduler, parse_rate
+from metrics import Metrics, SessionProfiler
+from file_cache import DEFAULT_CACHE_BYTES, DEFAULT_MAX_FILE_SIZE, CachedFile, FileCache
+from integrity import DigestCache, check_trailer, new_digest, send_trailer
+from delta import DeltaError, apply_delta, block_size_for, compute_signatures
+from transfer import (DEFAULT_BUFFER_SIZE, DEFAULT_DEPTH, Prefetcher, discard, receive_file, send_file,
+                      send_hashed, send_mapped)
+from tree_transfer import CONTENT_TYPE, TreeError, receive_tree, send_tree
 
 # run 2 terminals, 1 for server, 1 for client
-# server command: python3 FTPServer.py
+# server command: python3 FTPServer.py [--mode thread|asyncio] [--workers N] [--max-connections N]
+#                 [--processes N]
 # client commands: python3 FTPClient.py localhost 12000 -> GET test.txt 
 
-UPLOAD_DIRECTORY = "uploads"
-
-os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
-
-def read_line(sock):
-    line = b''
-    while not line.endswith(b'\n'):
-        char = sock.recv(1)
-        if not char:
-            break
-        line += char
-    return line.decode().strip()
-
-def receive_headers(sock):
-    headers = {}
-    while True:
-        line = read_line(sock)
-        if line == '':
-            break  # End of headers
-        if ': ' in line:
-            key, value = line.split(": ", 1)
-            headers[key] = value
-        else:
-            print(f"Malformed header line: {line}")
-    return headers
+# The files GET, PUT, SYNC, SIZE and LS work on (see storage.py), set up in
+# main from --root, --layout, --fsync and --fadvise. Uploads are written to
+# its partial directory first and renamed into place once complete; an
+# interrupted upload leaves its data and checkpoint behind.
+STORAGE = None
 
-def handle_client(connection, addr):
+# Content-addressed store for uploads (--store cas) in <root>/.store, see
+# store.py; None keeps every upload as a plain file in STORAGE
+STORE = None
+
+# Names LS reports, with size and mtime, kept current as uploads complete
+def describe_upload(name, file_stat):
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+INDEX = DirectoryIndex([])
+
+# Command latencies, transfer sizes and rates and session counts, reported
+# by the STATS command
+METRICS = Metrics()
+
+# With --processes N, where this worker publishes METRICS and STATS reads
+# those of all workers (see prefork.py); None in a single-process server
+WORKER_STATS = None
+
+# With --profile-dir, every session's command handling is profiled with
+# cProfile and written to <dir>/session-<host>-<port>.prof when it ends
+PROFILE_DIRECTORY = None
+
+# Timeouts, keepalive and buffer sizes of control and data connections (see
+# socket_options.py), set up in serve from --control-timeout, --data-timeout,
+# --keepalive, --sndbuf and --rcvbuf
+SOCKET_OPTIONS = SocketOptions()
+
+# Listener pool for passive-mode data connections (see passive.py); None
+# with --passive-ports off
+PASSIVE = None
+
+# Paces data channels when --rate-limit or --session-rate-limit is set (see
+# scheduler.py); None leaves transfers unshaped
+SCHEDULER = None
+
+# In-memory LRU cache of small, frequently downloaded files (see
+# file_cache.py); None when disabled with --cache-size 0
+CACHE = None
+
+# SHA-256 of whole files sent with a Content-Digest trailer (see
+# integrity.py), so repeated GETs of a file do not hash it again
+DIGESTS = DigestCache()
+
+# Listings sent without a Limit are streamed in batches of this many bytes
+LISTING_BATCH_SIZE = 64 * 1024
+
+# Size of the buffers file data is read and received into
+TRANSFER_BUFFER_SIZE = DEFAULT_BUFFER_SIZE
+
+# Buffers of TRANSFER_BUFFER_SIZE a large GET or PUT keeps in flight between
+# the disk and the socket (see transfer.py), from --io-depth; 0 or 1 makes
+# them read, send, receive and write in turn
+IO_DEPTH = DEFAULT_DEPTH
+
+# Capabilities advertised in reply to FEAT. Clients that never send FEAT keep
+# using the original one-connection-per-transfer protocol.
+FEATURES = {
+    "Data-Channel": "multiplexed",
+    "Range": "Offset, Length",
+    "Resume": "REST, Offset, If-Range",
+    "Delta": "SYNC",
+    "Content-Encoding": ", ".join(CODECS),
+    "Listing": "Format=long, Limit, After, Pattern",
+    "Stats": "STATS",
+    "Integrity": "Content-Digest sha-256",
+    "Tree": "GETDIR, PUTDIR",
+}
+
+class ClientSession:
+    # Per-control-connection state shared by the command handlers
+    def __init__(self, connection, addr):
+        self.connection = connection
+        self.addr = addr
+        self.control = ProtocolStream(connection)
+        self.mux = None  # Persistent multiplexed data channel, once negotiated
+        self.profiler = None
+        self.passive_secret = None  # Set by PASV
+        self.rate_bucket = SCHEDULER.session_bucket() if SCHEDULER is not None else None
+
+def open_session(connection, addr):
     print(f"Connection established with {addr}")
-    while True:
-        # Read command from client over control channel
-        line = read_line(connection)
-        if not line:
-            break  # Client closed the connection
-        message = line.strip()
-        print(f"Received message: {message}")
-
-        command, *args = message.split()
-
-        if command in ["GET", "PUT", "LS"]:
-            # Read headers to get Data-Port
-            headers = receive_headers(connection)
-            data_port = int(headers.get("Data-Port", 0))
-            if data_port == 0:
-                connection.sendall("FAILURE 400 Data-Port not specified\n".encode())
-                continue
-
-            client_ip = addr[0]  # Client's IP from control connection
-
-            # Create data socket to connect to client's data port
-            try:
-                data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                data_socket.connect((client_ip, data_port))
-                print(f"Connected to client's data port {data_port}")
-            except Exception as e:
-                print(f"Failed to connect to client's data port: {e}")
-                connection.sendall("FAILURE 400 Failed to connect to client's data port\n".encode())
-                continue
-
-            if command == "GET":
-                if len(args) < 1:
-                    connection.sendall("FAILURE 400 Invalid GET command format\n".encode())
-                    data_socket.close()
-                    continue
-
-                filename = args[0]
-                filepath = os.path.join(os.getcwd(), filename)
-                if os.path.exists(filepath):
-                    filesize = os.path.getsize(filepath)
-                    # Send success status code over control channel
-                    connection.sendall(f"SUCCESS 200 OK\n".encode())
-
-                    # Send headers over data channel
-                    send_headers(data_socket, {"Content-Length": str(filesize)})
-
-                    # Send file data over data channel
-                    with open(filepath, 'rb') as file:
-                        bytes_sent = 0
-                        while True:
-                            chunk = file.read(4096)
-                            if not chunk:
-                                break
-                            data_socket.sendall(chunk)
-                            bytes_sent += len(chunk)
-                    print(f"File '{filename}' sent to client.")
-                    print(f"Total bytes transferred: {bytes_sent}")
+    # TCP_NODELAY: status lines are tiny and often written back to back;
+    # don't let Nagle hold them behind the client's delayed ACKs
+    SOCKET_OPTIONS.tune_control(connection)
+    session = ClientSession(connection, addr)
+    if PROFILE_DIRECTORY is not None:
+        session.profiler = SessionProfiler(
+            os.path.join(PROFILE_DIRECTORY, f"session-{addr[0]}-{addr[1]}.prof"))
+    METRICS.increment("sessions.total")
+    METRICS.adjust("sessions.active", 1)
+    return session
+
+def close_session(session):
+    if session.mux is not None:
+        session.mux.close()
+    if session.passive_secret is not None:
+        PASSIVE.unregister(session.passive_secret)
+    session.connection.close()
+    METRICS.adjust("sessions.active", -1)
+    if session.profiler is not None:
+        session.profiler.dump()
+        print(f"Profile of {session.addr} written to {session.profiler.path}"
+              + (f" ({session.profiler.skipped} commands not profiled while another "
+                 f"session was)" if session.profiler.skipped else ""))
+    print(f"Connection with {session.addr} closed.")
+
+def reap_session(session):
+    # Called by the connection engine for a session that sent no command
+    # for --idle-timeout seconds, just before it closes the session
+    print(f"Closing idle session with {session.addr}")
+    METRICS.increment("sessions.reaped")
+    try:
+        session.connection.sendall("FAILURE 421 Idle timeout\n".encode())
+    except OSError:
+        pass
+
+def count_timeout(error):
+    # Data connection failures that were a --data-timeout expiring
+    if isinstance(error, socket.timeout):
+        METRICS.increment("data_channel.timeouts")
+
+def handle_client(connection, addr):
+    session = open_session(connection, addr)
+    try:
+        while handle_command(session):
+            pass
+    finally:
+        close_session(session)
+
+def connect_data_port(session, data_port):
+    client_ip = session.addr[0]  # Client's IP from control connection
+
+    # Create data socket to connect to client's data port
+    try:
+        data_socket = SOCKET_OPTIONS.data_socket()
+        data_socket.connect((client_ip, data_port))
+        print(f"Connected to client's data port {data_port}")
+        return data_socket
+    except Exception as e:
+        print(f"Failed to connect to client's data port: {e}")
+        count_timeout(e)
+        session.connection.sendall("FAILURE 400 Failed to connect to client's data port\n".encode())
+        return None
+
+def accept_passive(session, token):
+    # The connection the client opened to our passive port for this transfer
+    if session.passive_secret is None:
+        session.connection.sendall("FAILURE 400 PASV not requested\n".encode())
+        return None
+    try:
+        nonce = int(token)
+    except ValueError:
+        session.connection.sendall("FAILURE 400 Invalid Data-Token\n".encode())
+        return None
+    data_socket = PASSIVE.take(session.passive_secret, nonce)
+    if data_socket is None:
+        print(f"No passive data connection from {session.addr} for token {nonce}")
+        METRICS.increment("data_channel.timeouts")
+        session.connection.sendall("FAILURE 425 Data connection not received\n".encode())
+        return None
+    SOCKET_OPTIONS.tune_data(data_socket)
+    return data_socket
+
+def release_passive(session, headers):
+    # Drops the passive connection of a command answered without a transfer
+    if session.passive_secret is not None and headers.get("Data-Token", "").isdigit():
+        PASSIVE.release(session.passive_secret, int(headers["Data-Token"]))
+
+def open_data_channel(session, headers):
+    # Returns the data channel for one GET/PUT/LS: the connection the client
+    # made to our passive port (Data-Token), a fresh connection to the
+    # client's Data-Port, or a transfer on the session's multiplexed channel
+    # when the request carries only a Transfer-Id. Returns None after
+    # reporting the failure on the control channel.
+    connection = session.connection
+    try:
+        transfer_id = int(headers["Transfer-Id"]) if "Transfer-Id" in headers else None
+    except ValueError:
+        connection.sendall("FAILURE 400 Invalid Transfer-Id\n".encode())
+        return None
+
+    if transfer_id is not None and "Data-Port" not in headers and "Data-Token" not in headers:
+        if session.mux is None:
+            connection.sendall("FAILURE 400 No multiplexed data channel\n".encode())
+            return None
+        return session.mux.open(transfer_id)
+
+    if "Data-Token" in headers:
+        data_socket = accept_passive(session, headers["Data-Token"])
+        data_port = "passive"
+    else:
+        data_port = int(headers.get("Data-Port", 0))
+        if data_port == 0:
+            connection.sendall("FAILURE 400 Data-Port not specified\n".encode())
+            return None
+        data_socket = connect_data_port(session, data_port)
+    if data_socket is None:
+        return None
+
+    if transfer_id is not None and headers.get("Data-Channel") == "multiplexed":
+        # Keep this connection for the rest of the session
+        if session.mux is not None:
+            session.mux.close()
+        SOCKET_OPTIONS.tune_channel(data_socket)
+        session.mux = MuxChannel(data_socket).start()
+        print(f"Multiplexed data channel established ({data_port})")
+        return session.mux.open(transfer_id)
+    return ProtocolStream(data_socket)
+
+def file_etag(stat):
+    # Identifies one version of a file; changes whenever it is rewritten
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+def parse_range(headers, filesize):
+    # Returns (offset, length) for the optional Offset/Length request headers,
+    # or (None, None) when the range falls outside the file
+    try:
+        offset = int(headers.get("Offset", 0))
+        length = int(headers.get("Length", filesize - offset))
+    except ValueError:
+        return None, None
+    if offset < 0 or length < 0 or offset + length > filesize:
+        return None, None
+    return offset, length
+
+def open_download(filename):
+    # Returns (file, size, etag) for a GET or SIZE of filename, or None when
+    # there is no such file. Files in the content store are identified by
+    # their digest, other files by size and modification time. Small files
+    # come from CACHE when enabled, so popular ones are not reread per GET.
+    if not valid_name(filename):
+        return None
+    if STORE is not None:
+        file = STORE.open(filename)
+        if file is not None:
+            # The name of a stored file already tells its digest
+            DIGESTS.put(filename, file.digest, bytes.fromhex(file.digest))
+            if CACHE is not None:
+                # A digest names immutable content, so it is its own version
+                data = CACHE.get(file.digest, file.digest, file.size, file.read)
+                if data is not None:
+                    file.close()
+                    return CachedFile(data), len(data), file.digest
+            return file, file.size, file.digest
+    filepath = STORAGE.path(filename)
+    try:
+        file_stat = os.stat(filepath)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        if CACHE is not None:
+            version = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+            data = CACHE.get(filepath, version, file_stat.st_size, lambda: read_file(filepath))
+            if data is not None:
+                return CachedFile(data), file_stat.st_size, file_etag(file_stat)
+        file = STORAGE.open(filepath, file_stat.st_size)
+    except FileNotFoundError:
+        return None
+    file_stat = os.fstat(file.fileno())
+    return file, file_stat.st_size, file_etag(file_stat)
+
+def read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+def invalidate_cached(filename):
+    # Drops the cached copy of a stored file that was just replaced
+    if CACHE is not None:
+        CACHE.invalidate(STORAGE.path(filename))
+
+def handle_get(session, data, args, headers):
+    connection = session.connection
+    if len(args) < 1:
+        connection.sendall("FAILURE 400 Invalid GET command format\n".encode())
+        return
+
+    filename = args[0]
+    download = open_download(filename)
+    if download is None:
+        connection.sendall("FAILURE 404 File Not Found\n".encode())
+        return
+
+    file, filesize, etag = download
+    with file:
+        if "If-Range" in headers and headers["If-Range"] != etag:
+            # The client's partial copy is of an older version: send it all,
+            # keeping the rest of the request (digest, encoding) as asked
+            headers = dict(headers, Offset="0")
+            headers.pop("Length", None)
+            headers.pop("If-Range", None)
+        offset, length = parse_range(headers, filesize)
+        if offset is None:
+            connection.sendall("FAILURE 416 Range Not Satisfiable\n".encode())
+            return
+
+        # Send success status code over control channel
+        connection.sendall(f"SUCCESS 200 OK\n".encode())
+
+        data_headers = {"Content-Length": str(length)}
+        if "Offset" in headers or "Length" in headers:
+            data_headers["Offset"] = str(offset)
+            data_headers["Total-Length"] = str(filesize)
+            data_headers["ETag"] = etag
+
+        # With a Content-Digest trailer requested, a whole file whose digest
+        # is known still goes out with sendfile; anything else is hashed on
+        # its way out
+        digest = known_digest = None
+        if "Want-Content-Digest" in headers:
+            data_headers["Trailer"] = "Content-Digest"
+            if length == filesize:
+                known_digest = DIGESTS.get(filename, etag)
+            if known_digest is None:
+                digest = new_digest()
+
+        try:
+            # Compress only if the client asked for it and a sample of the
+            # data actually shrinks
+            encoding = choose_encoding(file, offset, parse_encodings(headers.get("Accept-Encoding", "")))
+            if encoding:
+                data_headers["Content-Encoding"] = encoding
+
+            # Send headers over data channel
+            data.send_headers(data_headers)
+
+            # Send file data over data channel, starting at the requested
+            # offset, with the disk reading ahead of the socket
+            read_ahead = IO_DEPTH * TRANSFER_BUFFER_SIZE if IO_DEPTH > 1 else 0
+            if encoding:
+                bytes_sent = send_encoded(data, file, encoding, offset, length, digest, IO_DEPTH)
+            elif digest is not None:
+                mapping = STORAGE.map_file(file, filesize)
+                if mapping is None:
+                    bytes_sent = send_hashed(data, file, offset, length, digest,
+                                             TRANSFER_BUFFER_SIZE, IO_DEPTH)
                 else:
-                    connection.sendall("FAILURE 404 File Not Found\n".encode())
-                data_socket.close()
-
-            elif command == "PUT":
-                if len(args) < 1:
-                    connection.sendall("FAILURE 400 Invalid PUT command format\n".encode())
-                    data_socket.close()
-                    continue
-
-                filename = args[0]
-                filepath = os.path.join(UPLOAD_DIRECTORY, filename)
-
-                # Send success status code over control channel
-                connection.sendall(f"SUCCESS 200 OK\n".encode())
-
-                # Receive headers over data channel
-                data_headers = receive_headers(data_socket)
-                filesize = int(data_headers.get("Content-Length", 0))
-                if filesize == 0:
-                    print("Invalid file size received.")
-                    data_socket.close()
-                    connection.sendall("FAILURE 400 Invalid file size\n".encode())
-                    continue
-
-                print(f"Receiving file '{filename}' of size {filesize} bytes.")
-
-                # Receive file data over data channel
-                with open(filepath, 'wb') as file:
-                    received_bytes = 0
-                    while received_bytes < filesize:
-                        buffer_size = min(4096, filesize - received_bytes)
-                        chunk = data_socket.recv(buffer_size)
-                        if not chunk:
-                            print("Connection lost while receiving file data.")
-                            break
-                        file.write(chunk)
-                        received_bytes += len(chunk)
-                print(f"File '{filename}' uploaded successfully.")
-                print(f"Total bytes transferred: {received_bytes}")
-
-                data_socket.close()
-
-                # Send final acknowledgment over control channel
-                connection.sendall("SUCCESS 201 Upload Complete\n".encode())
-
-            elif command == "LS":
-                # Send success status code over control channel
-                connection.sendall(f"SUCCESS 200 OK\n".encode())
-
-                # Generate directory listing
-                try:
-                    files = os.listdir(UPLOAD_DIRECTORY)
-                    files = [f for f in files if os.path.isfile(os.path.join(UPLOAD_DIRECTORY, f))]
-                    file_list = '\n'.join(files)
-                    content_length = len(file_list.encode())
-
-                    # Send headers over data channel
-                    send_headers(data_socket, {"Content-Length": str(content_length)})
-
-                    # Send directory listing over data channel
-                    data_socket.sendall(file_list.encode())
-                    print("Sent file list to client.")
-                except Exception as e:
-                    print(f"Error retrieving file list: {e}")
-                    connection.sendall("FAILURE 500 Internal Server Error\n".encode())
-
-                data_socket.close()
-
-        elif command == "QUIT":
-            connection.sendall("SUCCESS 200 Goodbye\n".encode())
-            connection.shutdown(socket.SHUT_WR)  # Ensure the client receives the message
-            break  # Exit the loop and close the connection
+                    prefetcher = Prefetcher(file, read_ahead) if read_ahead else None
+                    with mapping:
+                        bytes_sent = send_mapped(data, mapping, offset, length, digest,
+                                                 prefetcher=prefetcher)
+            elif isinstance(file, (ManifestFile, CachedFile)):
+                bytes_sent = file.send_range(data, offset, length)
+            else:
+                bytes_sent = send_file(data, file, offset, length, read_ahead)
+
+            # A body that came up short gets no trailer, so the client
+            # rejects it
+            if "Trailer" in data_headers and bytes_sent == length:
+                if known_digest is None:
+                    known_digest = digest.digest()
+                    if length == filesize:
+                        DIGESTS.put(filename, etag, known_digest)
+                send_trailer(data, known_digest)
+        except OSError as e:
+            print(f"Connection lost while sending file data: {e}")
+            count_timeout(e)
+            return
+    print(f"File '{filename}' sent to client.")
+    print(f"Total bytes transferred: {bytes_sent}")
+    return bytes_sent
+
+def open_upload(filename):
+    # Returns (file, size) for the current uploaded copy of filename, or None
+    if STORE is not None:
+        file = STORE.open(filename)
+        if file is not None:
+            return file, file.size
+    try:
+        file = open(STORAGE.path(filename), 'rb')
+    except FileNotFoundError:
+        return None
+    return file, os.fstat(file.fileno()).st_size
+
+def commit_upload(path, filename, expected_digest=None):
+    # Moves the complete upload at path into place as filename: into the
+    # content store when one is configured, otherwise into STORAGE. Returns
+    # False, leaving the current copy alone, if the data does not match the
+    # Content-Digest the client announced.
+    if STORE is None:
+        STORAGE.commit(path, filename)
+        invalidate_cached(filename)
+        INDEX.update(filename)
+        return True
+    try:
+        digest = STORE.add(path)
+    finally:
+        os.remove(path)
+    if expected_digest is not None and digest != expected_digest:
+        return False
+    STORE.link(filename, digest)
+    remove_plain_upload(filename)
+    INDEX.update(filename)
+    return True
+
+def remove_plain_upload(filename):
+    # A stored name supersedes a plain file of the same name
+    STORAGE.remove(filename)
+    invalidate_cached(filename)
+
+def deduplicate_put(session, args, headers):
+    # A PUT announcing the Content-Digest of a file the store already holds
+    # is answered at once, before any data channel is opened
+    if STORE is None or len(args) < 1 or not valid_name(args[0]):
+        return False
+    digest = parse_digest(headers.get("Content-Digest", ""))
+    if digest is None or not STORE.has(digest):
+        return False
+    STORE.link(args[0], digest)
+    remove_plain_upload(args[0])
+    INDEX.update(args[0])
+    print(f"File '{args[0]}' is already stored; skipped the transfer.")
+    session.connection.sendall("SUCCESS 201 Already Stored\n".encode())
+    return True
+
+def partial_paths(filename):
+    partial_path = os.path.join(STORAGE.partial_directory, filename)
+    return partial_path, partial_path + ".json"
+
+def resumable_offset(filename, source_id=None):
+    # Bytes of filename already received by an interrupted upload of the
+    # same source, or 0 when there is nothing to resume
+    if not valid_name(filename):
+        return 0
+    partial_path, checkpoint_path = partial_paths(filename)
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is None or not os.path.exists(partial_path):
+        return 0
+    if source_id is not None and checkpoint.get("source_id") != source_id:
+        return 0
+    return min(checkpoint.get("received", 0), os.path.getsize(partial_path))
+
+def handle_put(session, data, args, headers):
+    connection = session.connection
+    if len(args) < 1:
+        connection.sendall("FAILURE 400 Invalid PUT command format\n".encode())
+        return
 
+    filename = args[0]
+    if not valid_name(filename):
+        connection.sendall("FAILURE 400 Invalid File Name\n".encode())
+        return
+
+    # Send success status code over control channel
+    connection.sendall(f"SUCCESS 200 OK\n".encode())
+
+    # Receive headers over data channel
+    data_headers = data.read_headers()
+    filesize = int(data_headers.get("Content-Length", 0))
+    offset = int(data_headers.get("Offset", 0))
+    source_id = data_headers.get("Source-Id")
+    encoding = data_headers.get("Content-Encoding")
+    digest = new_digest() if data_headers.get("Trailer") == "Content-Digest" else None
+    if filesize == 0 and offset == 0:
+        print("Invalid file size received.")
+        connection.sendall("FAILURE 400 Invalid file size\n".encode())
+        return
+
+    partial_path, checkpoint_path = partial_paths(filename)
+    if encoding and encoding not in CODECS:
+        print(f"Unsupported Content-Encoding '{encoding}'.")
+        connection.sendall("FAILURE 415 Unsupported Content-Encoding\n".encode())
+        return
+    stream = DecodingReader(data, encoding) if encoding else data
+    if offset and resumable_offset(filename, source_id) < offset:
+        print(f"Cannot resume '{filename}' at byte {offset}.")
+        discard(stream, filesize)
+        connection.sendall("FAILURE 409 Cannot Resume Upload\n".encode())
+        return
+
+    print(f"Receiving file '{filename}' of size {filesize} bytes"
+          + (f" starting at byte {offset}." if offset else "."))
+
+    # Receive file data over data channel into the partial file
+    checkpoint = {"size": offset + filesize, "source_id": source_id, "received": offset}
+    with open(partial_path, 'r+b' if offset else 'wb', buffering=0) as file:
+        file.truncate(offset)
+        try:
+            STORAGE.preallocate(file, offset, filesize)
+        except OSError as e:
+            print(f"Cannot store '{filename}': {e}")
+            file.truncate(offset)
+            discard(stream, filesize)
+            connection.sendall("FAILURE 507 Insufficient Storage\n".encode())
+            return
+        file.seek(offset)
+        save_checkpoint(checkpoint_path, checkpoint)
+        writer = CheckpointWriter(checkpoint_path, checkpoint, offset)
+        try:
+            received_bytes = receive_file(stream, file, filesize, TRANSFER_BUFFER_SIZE,
+                                          progress=writer, digest=digest, depth=IO_DEPTH)
+        except (socket.timeout, ConnectionError) as e:
+            # A stalled or vanished sender; keep what arrived for resuming
+            print(f"Data connection failed: {e}")
+            count_timeout(e)
+            received_bytes = writer.received
+        except DecodingError as e:
+            print(f"Invalid encoded data for '{filename}': {e}")
+            connection.sendall("FAILURE 422 Invalid Encoded Data\n".encode())
+            return
+        except OSError as e:
+            # Writing the file failed (with --io-depth, in the write-behind
+            # thread, which has finished by now). writer.received counts the
+            # bytes that reached the file; they are kept for resuming.
+            print(f"Cannot store '{filename}': {e}")
+            if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                connection.sendall("FAILURE 507 Insufficient Storage\n".encode())
+            else:
+                connection.sendall("FAILURE 500 Internal Server Error\n".encode())
+            return
+        finally:
+            writer.save()
+            if writer.received < filesize:
+                # Give back the preallocated space the data never reached
+                file.truncate(offset + writer.received)
+    print(f"Total bytes transferred: {received_bytes}")
+
+    if received_bytes < filesize:
+        print("Connection lost while receiving file data.")
+        print(f"Partial upload of '{filename}' kept at {offset + received_bytes} bytes.")
+        connection.sendall("FAILURE 426 Upload Incomplete\n".encode())
+        return
+
+    if digest is not None:
+        # The client's digest of what it sent has to match what was written;
+        # data that fails the check is not kept for resuming either
+        error = check_trailer(data, stream, digest)
+        if error:
+            print(f"Upload of '{filename}' failed verification: {error}.")
+            os.remove(partial_path)
+            remove_checkpoint(checkpoint_path)
+            connection.sendall(f"FAILURE 422 {error}\n".encode())
+            return
+
+    committed = commit_upload(partial_path, filename, parse_digest(headers.get("Content-Digest", "")))
+    remove_checkpoint(checkpoint_path)
+    if not committed:
+        print(f"Upload of '{filename}' does not match its Content-Digest.")
+        connection.sendall("FAILURE 422 Content-Digest Mismatch\n".encode())
+        return
+    print(f"File '{filename}' uploaded successfully.")
+
+    # Send final acknowledgment over control channel
+    connection.sendall("SUCCESS 201 Upload Complete\n".encode())
+    return received_bytes
+
+def handle_sync(session, data, args, headers):
+    # SYNC <filename>: send block signatures of the current stored copy,
+    # then rebuild the file from the client's COPY/LITERAL delta
+    connection = session.connection
+    if len(args) < 1:
+        connection.sendall("FAILURE 400 Invalid SYNC command format\n".encode())
+        return
+
+    filename = args[0]
+    if not valid_name(filename):
+        connection.sendall("FAILURE 400 Invalid File Name\n".encode())
+        return
+
+    # Send success status code over control channel
+    connection.sendall(f"SUCCESS 200 OK\n".encode())
+
+    # Without an existing copy there are no signatures and every byte
+    # arrives as a literal
+    basis, basis_size = open_upload(filename) or (None, 0)
+    temp_path = None
+    try:
+        block_size = block_size_for(basis_size)
+        signatures = compute_signatures(basis, block_size) if basis else b''
+        data.send_headers({
+            "Content-Length": str(len(signatures)),
+            "Block-Size": str(block_size),
+            "Basis-Length": str(basis_size),
+        })
+        data.sendall(signatures)
+        print(f"Sent {len(signatures)} bytes of signatures for '{filename}'.")
+
+        # Receive the delta and rebuild the file beside the partial uploads,
+        # so the old copy stays intact until the new one is verified
+        data_headers = data.read_headers()
+        filesize = int(data_headers.get("Total-Length", 0))
+        fd, temp_path = tempfile.mkstemp(dir=STORAGE.partial_directory)
+        with os.fdopen(fd, 'wb') as output:
+            written = apply_delta(data, basis, basis_size, block_size, output, filesize)
+        if written != filesize:
+            raise DeltaError(f"Rebuilt {written} of {filesize} bytes")
+        os.chmod(temp_path, 0o644)
+        commit_upload(temp_path, filename)
+        temp_path = None
+    except DeltaError as e:
+        print(f"Rejected delta for '{filename}': {e}")
+        connection.sendall("FAILURE 422 Delta Rejected\n".encode())
+        return
+    except (OSError, ProtocolError) as e:
+        print(f"Connection lost while receiving delta: {e}")
+        connection.sendall("FAILURE 426 Upload Incomplete\n".encode())
+        return
+    finally:
+        if basis:
+            basis.close()
+        if temp_path:
+            os.remove(temp_path)
+    print(f"File '{filename}' rebuilt from delta ({written} bytes).")
+
+    # Send final acknowledgment over control channel
+    connection.sendall("SUCCESS 201 Upload Complete\n".encode())
+    return written
+
+def handle_getdir(session, data, args, headers):
+    # GETDIR <name>: the tree stored by PUTDIR as one archive (see
+    # tree_transfer.py), compressed if the client accepts an encoding
+    connection = session.connection
+    if len(args) < 1:
+        connection.sendall("FAILURE 400 Invalid GETDIR command format\n".encode())
+        return
+
+    name = args[0]
+    tree = STORAGE.tree_path(name)
+    if tree is None or not os.path.isdir(tree):
+        connection.sendall("FAILURE 404 Directory Not Found\n".encode())
+        return
+
+    # Send success status code over control channel
+    connection.sendall(f"SUCCESS 200 OK\n".encode())
+
+    data_headers = {"Content-Type": CONTENT_TYPE}
+    encoding = next((codec for codec in parse_encodings(headers.get("Accept-Encoding", ""))
+                     if codec in CODECS), None)
+    if encoding:
+        data_headers["Content-Encoding"] = encoding
+    digest = None
+    if "Want-Content-Digest" in headers:
+        data_headers["Trailer"] = "Content-Digest"
+        digest = new_digest()
+    try:
+        data.send_headers(data_headers)
+        members, bytes_sent = send_tree(data, tree, encoding, digest)
+        if digest is not None:
+            send_trailer(data, digest.digest())
+    except OSError as e:
+        print(f"Connection lost while sending directory '{name}': {e}")
+        count_timeout(e)
+        return
+    print(f"Directory '{name}' sent to client ({members} entries, {bytes_sent} bytes).")
+    return bytes_sent
+
+def handle_putdir(session, data, args, headers):
+    # PUTDIR <name>: extracts the archive the client streams into a staging
+    # directory as it arrives, then replaces the tree called name with it
+    connection = session.connection
+    if len(args) < 1:
+        connection.sendall("FAILURE 400 Invalid PUTDIR command format\n".encode())
+        return
+
+    name = args[0]
+    if STORAGE.tree_path(name) is None:
+        connection.sendall("FAILURE 400 Invalid File Name\n".encode())
+        return
+
+    # Send success status code over control channel
+    connection.sendall(f"SUCCESS 200 OK\n".encode())
+
+    data_headers = data.read_headers()
+    encoding = data_headers.get("Content-Encoding")
+    if encoding and encoding not in CODECS:
+        print(f"Unsupported Content-Encoding '{encoding}'.")
+        connection.sendall("FAILURE 415 Unsupported Content-Encoding\n".encode())
+        return
+    digest = new_digest() if data_headers.get("Trailer") == "Content-Digest" else None
+
+    staging = tempfile.mkdtemp(prefix=f".tree-{name}-", dir=STORAGE.partial_directory)
+    os.chmod(staging, 0o755)  # mkdtemp makes it private
+    try:
+        members, received_bytes = receive_tree(data, staging, encoding, digest,
+                                               sync=STORAGE.fsync != "off")
+        if digest is not None:
+            error = check_trailer(data, data, digest)
+            if error:
+                print(f"Directory upload '{name}' failed verification: {error}.")
+                connection.sendall(f"FAILURE 422 {error}\n".encode())
+                return
+        STORAGE.commit_tree(staging, name)
+        staging = None
+    except TreeError as e:
+        print(f"Rejected directory upload '{name}': {e}")
+        connection.sendall("FAILURE 422 Invalid Archive\n".encode())
+        return
+    except (socket.timeout, ConnectionError, ProtocolError) as e:
+        print(f"Connection lost while receiving directory '{name}': {e}")
+        count_timeout(e)
+        connection.sendall("FAILURE 426 Upload Incomplete\n".encode())
+        return
+    finally:
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+    print(f"Directory '{name}' uploaded successfully ({members} entries).")
+
+    # Send final acknowledgment over control channel
+    connection.sendall("SUCCESS 201 Upload Complete\n".encode())
+    return received_bytes
+
+def format_entry(entry, long_format):
+    name, size, mtime = entry
+    if long_format:
+        return f"{size}\t{mtime // 10**9}\t{name}".encode()
+    return name.encode()
+
+def handle_ls(session, data, args, headers):
+    # LS [pattern]: names matching the fnmatch pattern, one per line. Optional
+    # headers: "Format: long" for "size<TAB>mtime<TAB>name" lines, and Limit
+    # plus After to page through the sorted names; a page that is not the
+    # last carries Next-After with the cursor for the next request.
+    connection = session.connection
+    try:
+        limit = int(headers["Limit"]) if "Limit" in headers else None
+    except ValueError:
+        limit = 0
+    if limit is not None and limit < 1:
+        connection.sendall("FAILURE 400 Invalid Limit\n".encode())
+        return
+    if "After" in headers and not valid_name(headers["After"]):
+        # Cursors are names taken from Next-After
+        connection.sendall("FAILURE 400 Invalid After\n".encode())
+        return
+
+    # Send success status code over control channel
+    connection.sendall(f"SUCCESS 200 OK\n".encode())
+
+    # Look up the listing in the directory index
+    try:
+        INDEX.refresh()
+    except OSError as e:
+        print(f"Error retrieving file list: {e}")
+        connection.sendall("FAILURE 500 Internal Server Error\n".encode())
+        return
+    entries, more = INDEX.page(args[0] if args else None, headers.get("After"), limit)
+    long_format = headers.get("Format") == "long"
+
+    # Send headers over data channel; the listing itself is never joined
+    # into one string but streamed a batch of lines at a time
+    lines = [format_entry(entry, long_format) for entry in entries]
+    content_length = sum(map(len, lines)) + max(0, len(lines) - 1)  # Plus newlines
+    data_headers = {"Content-Length": str(content_length)}
+    if more:
+        data_headers["Next-After"] = entries[-1][0]
+    data.send_headers(data_headers)
+
+    # Send directory listing over data channel
+    batch = bytearray()
+    for index, line in enumerate(lines):
+        if index:
+            batch += b'\n'
+        batch += line
+        if len(batch) >= LISTING_BATCH_SIZE:
+            data.sendall(batch)
+            batch.clear()
+    if batch:
+        data.sendall(batch)
+    print(f"Sent file list to client ({len(entries)} entries).")
+    return content_length
+
+DATA_COMMANDS = {
+    "GET": handle_get,
+    "PUT": handle_put,
+    "LS": handle_ls,
+    "SYNC": handle_sync,
+    "GETDIR": handle_getdir,
+    "PUTDIR": handle_putdir,
+}
+
+# Commands timed under their own name in STATS; anything else is "other"
+TIMED_COMMANDS = set(DATA_COMMANDS) | {"SIZE", "REST", "FEAT", "PASV", "STATS", "QUIT"}
+
+def handle_command(session):
+    # Serves one command from the control channel; returns False once the
+    # session is over
+    connection = session.connection
+    control = session.control
+    addr = session.addr
+
+    # Read command from client over control channel
+    try:
+        line = control.read_line()
+    except socket.timeout:
+        print(f"Control connection with {addr} timed out.")
+        METRICS.increment("sessions.timed_out")
+        return False
+    except ProtocolError as e:
+        print(f"Protocol error from {addr}: {e}")
+        connection.sendall("FAILURE 400 Line Too Long\n".encode())
+        return False
+    if not line:
+        return False  # Client closed the connection
+    message = line.strip()
+    print(f"Received message: {message}")
+
+    command, *args = message.split()
+    name = command.lower() if command in TIMED_COMMANDS else "other"
+    started = time.perf_counter()
+    try:
+        with session.profiler or contextlib.nullcontext():
+            return dispatch_command(session, command, args)
+    except socket.timeout:
+        # The client stopped partway through a command or stopped reading
+        # replies; the control channel is out of step, so the session ends
+        print(f"Control connection with {addr} timed out.")
+        METRICS.increment("sessions.timed_out")
+        return False
+    finally:
+        METRICS.observe(f"command.{name}.seconds", time.perf_counter() - started)
+
+def dispatch_command(session, command, args):
+    # Runs one parsed command; returns False once the session is over
+    connection = session.connection
+    control = session.control
+    addr = session.addr
+
+    if command in DATA_COMMANDS:
+        # Read headers to get Data-Port / Transfer-Id
+        try:
+            headers = control.read_headers()
+        except ProtocolError as e:
+            print(f"Protocol error from {addr}: {e}")
+            connection.sendall("FAILURE 431 Headers Too Large\n".encode())
+            return False
+
+        if command == "PUT" and deduplicate_put(session, args, headers):
+            release_passive(session, headers)
+            return True
+
+        setup_started = time.perf_counter()
+        data = open_data_channel(session, headers)
+        if data is None:
+            return True
+        METRICS.observe("data_channel.setup_seconds", time.perf_counter() - setup_started)
+        if SCHEDULER is not None:
+            data = SCHEDULER.pace(data, session.rate_bucket)
+        try:
+            started = time.perf_counter()
+            transferred = DATA_COMMANDS[command](session, data, args, headers)
+            if transferred is not None:
+                METRICS.record_transfer(command.lower(), transferred, time.perf_counter() - started)
+        except socket.timeout:
+            # The client may still be waiting for a reply that never came,
+            # so the session ends with the transfer
+            print(f"Data connection with {addr} timed out.")
+            METRICS.increment("data_channel.timeouts")
+            return False
+        finally:
+            data.close()
+
+    elif command == "SIZE":
+        if len(args) < 1:
+            connection.sendall("FAILURE 400 Invalid SIZE command format\n".encode())
+        else:
+            download = open_download(args[0])
+            if download is not None:
+                download[0].close()
+                connection.sendall(f"SUCCESS 213 {download[1]}\n".encode())
+            else:
+                connection.sendall("FAILURE 404 File Not Found\n".encode())
+
+    elif command == "REST":
+        # REST <filename> [source-id]: how much of an interrupted upload the
+        # server already holds
+        if len(args) < 1:
+            connection.sendall("FAILURE 400 Invalid REST command format\n".encode())
+        else:
+            source_id = args[1] if len(args) > 1 else None
+            connection.sendall(f"SUCCESS 213 {resumable_offset(args[0], source_id)}\n".encode())
+
+    elif command == "FEAT":
+        connection.sendall(("SUCCESS 211 Features\n" + format_headers(FEATURES)).encode())
+
+    elif command == "PASV":
+        # Data connections of this session will come in on a passive port
+        if PASSIVE is None:
+            connection.sendall("FAILURE 502 Passive mode disabled\n".encode())
         else:
-            connection.sendall("FAILURE 400 Invalid Command\n".encode())
-
-    connection.close()
-    print(f"Connection with {addr} closed.")
-
-def send_headers(sock, headers):
-    for key, value in headers.items():
-        sock.sendall(f"{key}: {value}\n".encode())
-    sock.sendall(b'\n')  # End of headers
-
-def main():
-    server_port = 12000
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(('', server_port))
-    server_socket.listen(5)
-    print(f"Server is ready to receive connections on port {server_port}...")
-
-    connection_socket, addr = server_socket.accept()
-    handle_client(connection_socket, addr)
-
-    # Close the server socket after handling one client
-    server_socket.close()
-    print("Server has been shut down.")
+            if session.passive_secret is not None:
+                PASSIVE.unregister(session.passive_secret)
+            port, session.passive_secret = PASSIVE.register()
+            connection.sendall(f"SUCCESS 227 {port} {session.passive_secret.hex()}\n".encode())
+
+    elif command == "STATS":
+        snapshot = METRICS.snapshot() if WORKER_STATS is None else WORKER_STATS.snapshot(METRICS)
+        connection.sendall(("SUCCESS 211 Statistics\n" + format_headers(snapshot)).encode())
+
+    elif command == "QUIT":
+        connection.sendall("SUCCESS 200 Goodbye\n".encode())
+        connection.shutdown(socket.SHUT_WR)  # Ensure the client receives the message
+        return False  # Exit the loop and close the connection
+
+    else:
+        connection.sendall("FAILURE 400 Invalid Command\n".encode())
+
+    return True
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-client FTP server")
+    parser.add_argument("--port", type=int, default=12000,
+                        help="control channel port (default: 12000)")
+    parser.add_argument("--mode", choices=sorted(server_engine.ENGINES), default="thread",
+                        help="connection engine (default: thread)")
+    parser.add_argument("--workers", type=int, default=server_engine.DEFAULT_WORKERS,
+                        help="maximum number of worker threads")
+    parser.add_argument("--max-connections", type=int,
+                        help="maximum number of simultaneous control connections "
+                             "(default: --workers in thread mode, where it cannot be "
+                             f"higher, {server_engine.DEFAULT_MAX_CONNECTIONS} in asyncio mode)")
+    parser.add_argument("--drain-timeout", type=float,
+                        default=server_engine.DEFAULT_DRAIN_TIMEOUT,
+                        help="seconds to let active sessions finish on shutdown")
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="close sessions that send no command for this many seconds, "
+                             "0 for never (default: 300)")
+    parser.add_argument("--control-timeout", type=float, default=DEFAULT_CONTROL_TIMEOUT,
+                        help="seconds a control channel read or write may block while a "
+                             "command is running, 0 for no limit (default: 60)")
+    parser.add_argument("--data-timeout", type=float, default=DEFAULT_DATA_TIMEOUT,
+                        help="seconds connecting, sending or receiving on a data "
+                             "connection may block, 0 for no limit (default: 60)")
+    parser.add_argument("--keepalive", type=int, default=DEFAULT_KEEPALIVE, metavar="SECS",
+                        help="idle seconds before TCP keepalive probes on control "
+                             "connections and multiplexed channels, 0 to disable (default: 60)")
+    parser.add_argument("--sndbuf", type=int, default=0, metavar="BYTES",
+                        help="SO_SNDBUF of data connections (default: 0, kernel autotuning)")
+    parser.add_argument("--rcvbuf", type=int, default=0, metavar="BYTES",
+                        help="SO_RCVBUF of data connections (default: 0, kernel autotuning)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port through SO_REUSEPORT, "
+                             "0 for one per CPU (default: 1, no supervisor)")
+    parser.add_argument("--buffer-size", type=int, default=TRANSFER_BUFFER_SIZE,
+                        help="buffer size in bytes for reading and receiving file data")
+    parser.add_argument("--io-depth", type=int, default=IO_DEPTH, metavar="BUFFERS",
+                        help="buffers of --buffer-size a large transfer keeps in flight, "
+                             "so disk reads and writes overlap with the socket; 0 for "
+                             f"serial I/O (default: {IO_DEPTH})")
+    parser.add_argument("--root", default="uploads",
+                        help="directory holding the files GET, PUT and LS work on "
+                             "(default: uploads)")
+    parser.add_argument("--layout", choices=LAYOUTS, default="flat",
+                        help="keep files directly in the root or in 256 shard "
+                             "directories under it (default: flat); an existing root "
+                             "is converted on startup")
+    parser.add_argument("--fsync", choices=FSYNC_MODES, default="off",
+                        help="make uploads durable before reporting success: always, "
+                             "batch (concurrent uploads share directory flushes) or "
+                             "off (default)")
+    parser.add_argument("--fadvise", action="store_true",
+                        help="tell the kernel downloads of large files read sequentially")
+    parser.add_argument("--store", choices=["plain", "cas"], default="plain",
+                        help="keep uploads as plain files or in a deduplicating "
+                             "content-addressed store (default: plain)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_BYTES,
+                        help="bytes of memory for caching popular small files "
+                             "served by GET, 0 to disable (default: 64 MiB)")
+    parser.add_argument("--cache-max-file", type=int, default=DEFAULT_MAX_FILE_SIZE,
+                        help="largest file kept in the GET cache (default: 128 KiB)")
+    parser.add_argument("--passive-ports", default="0", metavar="PORTS",
+                        help="data ports for passive mode: 0 for one ephemeral port "
+                             "(default), N or N-M for a fixed pool, off to disable")
+    parser.add_argument("--rate-limit", type=parse_rate, default=0, metavar="RATE",
+                        help="cap on the combined rate of all transfers in bytes/s, "
+                             "e.g. 50M; shared fairly between active transfers")
+    parser.add_argument("--session-rate-limit", type=parse_rate, default=0, metavar="RATE",
+                        help="cap on the transfer rate of each session in bytes/s")
+    parser.add_argument("--profile-dir", metavar="DIR",
+                        help="profile each session with cProfile and write the stats "
+                             "to DIR/session-<host>-<port>.prof; on Python 3.12 and "
+                             "later only one command is profiled at a time, and "
+                             "commands of other sessions running meanwhile are skipped")
+    return parser.parse_args(argv)
+
+def worker_settings(args, worker):
+    # Passive ports and the global rate limit are divided between worker
+    # processes: a client must reach the passive port of the worker that
+    # holds its session, and the workers' limits should add up to the cap
+    passive_ports = parse_port_range(args.passive_ports) if args.passive_ports != "off" else None
+    rate_limit = args.rate_limit
+    if worker is not None:
+        if passive_ports is not None and passive_ports != [0]:
+            passive_ports = passive_ports[worker::args.processes]
+        rate_limit //= args.processes
+    return passive_ports, rate_limit
+
+def serve(args, port, worker=None, shared_stats=None):
+    # Runs one server until it is shut down: the whole server, or worker
+    # number `worker` of a multi-process one
+    global TRANSFER_BUFFER_SIZE, STORE, CACHE, PROFILE_DIRECTORY, SCHEDULER, PASSIVE, WORKER_STATS
+    global SOCKET_OPTIONS, IO_DEPTH
+    TRANSFER_BUFFER_SIZE = args.buffer_size
+    IO_DEPTH = args.io_depth
+    SOCKET_OPTIONS = SocketOptions(args.control_timeout, args.data_timeout, args.keepalive,
+                                   args.sndbuf, args.rcvbuf)
+    passive_ports, rate_limit = worker_settings(args, worker)
+    if passive_ports is not None:
+        PASSIVE = PassiveListener(passive_ports)
+        for listener in PASSIVE.listeners:
+            SOCKET_OPTIONS.set_buffers(listener)  # Inherited by accepted connections
+        FEATURES["Passive"] = "PASV"
+        print(f"Passive data connections on port(s) {', '.join(map(str, PASSIVE.ports))}")
+    if rate_limit or args.session_rate_limit:
+        SCHEDULER = TransferScheduler(rate_limit, args.session_rate_limit)
+    if args.cache_size > 0:
+        CACHE = FileCache(args.cache_size, args.cache_max_file)
+        METRICS.add_source("get_cache", CACHE.stats)
+    METRICS.add_source("digest_cache", DIGESTS.stats)
+    METRICS.add_source("storage", STORAGE.stats)
+    if shared_stats is not None:
+        WORKER_STATS = shared_stats
+        shared_stats.start(METRICS)
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok=True)
+        PROFILE_DIRECTORY = args.profile_dir
+    if args.store == "cas":
+        STORE = ContentStore(os.path.join(STORAGE.root, ".store"))
+        FEATURES["Dedup"] = "Content-Digest sha-256"
+        INDEX.sources.append((STORE, STORE.describe))
+    server = server_engine.create_server(
+        args.mode, open_session, handle_command, close_session, port,
+        workers=args.workers, max_connections=args.max_connections,
+        drain_timeout=args.drain_timeout,
+        has_buffered_input=lambda session: session.control.buffered > 0,
+        reuse_port=worker is not None, idle_timeout=optional_timeout(args.idle_timeout),
+        reap_session=reap_session)
+
+    # Stop accepting on Ctrl-C / SIGTERM and let active sessions drain
+    def request_shutdown(signum, frame):
+        print("Shutdown requested, no longer accepting connections.")
+        server.shutdown()
+
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
+    server.serve_forever()
+    if PASSIVE is not None:
+        PASSIVE.close()
+    if CACHE is not None:
+        stats = CACHE.stats()
+        print(f"GET cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['invalidations']} invalidations, {stats['evictions']} evictions")
+    if WORKER_STATS is not None:
+        WORKER_STATS.publish(METRICS)
+
+def main(argv=None):
+    global STORAGE
+    args = parse_args(argv)
+    STORAGE = FileStorage(args.root, args.layout, args.fsync, args.fadvise)
+    moved = STORAGE.relayout()
+    if moved:
+        print(f"Moved {moved} files in {args.root} to the {args.layout} layout")
+    INDEX.sources.append((STORAGE, describe_upload))
+    if args.processes == 0:
+        args.processes = prefork.default_processes()
+    if args.processes == 1:
+        serve(args, args.port)
+        return
+    passive_ports = parse_port_range(args.passive_ports) if args.passive_ports != "off" else None
+    if passive_ports is not None and passive_ports != [0] and len(passive_ports) < args.processes:
+        raise SystemExit(f"--passive-ports needs at least one port per process ({args.processes})")
+    supervisor = prefork.Supervisor(
+        args.processes, args.port, lambda worker, port, stats: serve(args, port, worker, stats))
+    supervisor.serve_forever()
 
 if __name__ == "__main__":
     main()
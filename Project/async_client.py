@@ -0,0 +1,515 @@
+# Asyncio client library for programs that drive many transfers at once. One
+# AsyncFTPClient keeps a pool of control sessions to one server; get(), put(),
+# ls(), size() and stats() borrow a session for the length of one command and
+# return structured results instead of printing, so thousands of transfers
+# can run concurrently on one event loop without a thread per file:
+#
+#   async with AsyncFTPClient("localhost", 12000, pool_size=16) as client:
+#       results = await asyncio.gather(*(client.get(name) for name in names))
+#
+# Sockets are non-blocking and driven with the loop's sock_* calls: bodies
+# are received into one preallocated buffer per transfer with
+# sock_recv_into() and sent with sock_sendfile() (os.sendfile where the
+# platform has it). Data connections use passive mode when the server offers
+# it, so the client never has to accept connections, and fall back to a
+# Data-Port listener otherwise. Bodies are checked against Content-Digest
+# trailers (see integrity.py) when the server supports them.
+#
+# Transfers are neither compressed nor multiplexed; concurrency comes from
+# the session pool instead. Local file I/O is done in line, which the kernel
+# page cache keeps short.
+#
+# Every socket operation gives up after timeout seconds (None waits forever)
+# with a TimeoutError, which closes the session it happened on. Pooled
+# sessions the server has closed for being idle (its --idle-timeout) are
+# dropped when next borrowed rather than handed out.
+
+import asyncio
+import contextlib
+import fnmatch
+import os
+import socket
+import time
+
+from ftp_protocol import (MAX_HEADER_BYTES, MAX_LINE_LENGTH, RECV_SIZE, HeadersTooLarge, LineTooLong,
+                          ProtocolError, format_headers)
+from integrity import new_digest, trailer_error
+from passive import CONNECT_TIMEOUT, TOKEN
+from socket_options import DEFAULT_CONTROL_TIMEOUT
+from store import DIGEST_ALGORITHM, format_digest
+from transfer import DEFAULT_BUFFER_SIZE, write_view
+
+DEFAULT_POOL_SIZE = 8
+
+# Names requested per LS page from servers that support paged listings
+LISTING_PAGE_SIZE = 1000
+
+
+class FTPError(Exception):
+    # A command the server refused, or a transfer that did not complete.
+    # response is the server's status line, when there is one.
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+class TransferResult:
+    # Outcome of one get() or put()
+    def __init__(self, operation, name, path, size, seconds, verified):
+        self.operation = operation
+        self.name = name  # Name on the server
+        self.path = path  # Local file
+        self.size = size  # Bytes transferred
+        self.seconds = seconds
+        self.verified = verified  # Checked against a Content-Digest trailer
+
+    @property
+    def bytes_per_second(self):
+        return self.size / self.seconds if self.seconds > 0 else 0.0
+
+    def __repr__(self):
+        return (f"TransferResult({self.operation} {self.name!r}, {self.size} bytes, "
+                f"{self.seconds:.3f} s{', verified' if self.verified else ''})")
+
+
+class AsyncStream:
+    # Asyncio counterpart of ftp_protocol.ProtocolStream over a non-blocking
+    # socket: buffered lines and header blocks, then raw body bytes
+    def __init__(self, sock, timeout=None):
+        sock.setblocking(False)
+        self.sock = sock
+        self.timeout = timeout
+        self.loop = asyncio.get_running_loop()
+        self.buffer = bytearray()
+        self.pos = 0  # Start of the unread part of buffer
+
+    @property
+    def buffered(self):
+        return len(self.buffer) - self.pos
+
+    async def wait(self, operation):
+        # Awaits one socket operation for at most timeout seconds
+        if self.timeout is None:
+            return await operation
+        return await asyncio.wait_for(operation, self.timeout)
+
+    def alive(self):
+        # Between commands: False once the peer has closed the connection or
+        # sent something unasked (a server's idle timeout notice)
+        if self.buffered:
+            return False
+        try:
+            self.sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    async def fill(self):
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        chunk = await self.wait(self.loop.sock_recv(self.sock, RECV_SIZE))
+        if not chunk:
+            return False
+        self.buffer += chunk
+        return True
+
+    async def read_raw_line(self):
+        searched = 0
+        while True:
+            end = self.buffer.find(b'\n', self.pos + searched)
+            if end >= 0:
+                end += 1
+                if end - self.pos > MAX_LINE_LENGTH:
+                    raise LineTooLong(f"Line exceeds {MAX_LINE_LENGTH} bytes")
+                line = bytes(self.buffer[self.pos:end])
+                self.pos = end
+                return line
+            searched = self.buffered
+            if searched > MAX_LINE_LENGTH:
+                raise LineTooLong(f"Line exceeds {MAX_LINE_LENGTH} bytes")
+            if not await self.fill():
+                line = bytes(self.buffer[self.pos:])
+                self.pos = len(self.buffer)
+                return line
+
+    async def read_line(self):
+        return (await self.read_raw_line()).decode().strip()
+
+    async def read_headers(self):
+        headers = {}
+        total = 0
+        while True:
+            raw = await self.read_raw_line()
+            total += len(raw)
+            if total > MAX_HEADER_BYTES:
+                raise HeadersTooLarge(f"Headers exceed {MAX_HEADER_BYTES} bytes")
+            line = raw.decode().strip()
+            if line == '':
+                return headers
+            key, separator, value = line.partition(": ")
+            if separator:
+                headers[key] = value
+
+    async def recv_into(self, view):
+        if self.buffered:
+            count = min(len(view), self.buffered)
+            view[:count] = self.buffer[self.pos:self.pos + count]
+            self.pos += count
+            return count
+        return await self.wait(self.loop.sock_recv_into(self.sock, view))
+
+    async def read_exact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = await self.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Connection closed in the middle of a frame")
+            received += count
+        return data
+
+    async def sendall(self, data):
+        await self.wait(self.loop.sock_sendall(self.sock, data))
+
+    async def sendfile(self, file, offset=0, count=None):
+        if count == 0:
+            return 0  # sock_sendfile treats a zero count as "until EOF"
+        return await self.wait(self.loop.sock_sendfile(self.sock, file, offset, count))
+
+    async def send_headers(self, headers):
+        await self.sendall(format_headers(headers).encode())
+
+    async def send_command(self, command, headers=None):
+        message = command + '\n'
+        if headers:
+            message += format_headers(headers)
+        await self.sendall(message.encode())
+
+    def close(self):
+        self.sock.close()
+
+
+class AsyncSession:
+    # One pooled control connection and what it negotiated
+    def __init__(self, control, features):
+        self.control = control
+        self.features = features
+        self.passive = None  # (port, secret) once the server agreed to PASV
+        self.next_nonce = 1
+
+    def new_nonce(self):
+        nonce = self.next_nonce
+        self.next_nonce += 1
+        return nonce
+
+
+async def open_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, (host, port)),
+                               CONNECT_TIMEOUT)
+    except BaseException:
+        sock.close()
+        raise
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+async def receive_file(stream, file, length, buffer_size=DEFAULT_BUFFER_SIZE, digest=None):
+    # transfer.receive_file for an AsyncStream
+    buffer = bytearray(max(1, min(buffer_size, length)))
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = await stream.recv_into(view[:min(len(view), length - received)])
+        if not count:
+            break
+        write_view(file, view[:count])
+        if digest is not None:
+            digest.update(view[:count])
+        received += count
+    return received
+
+
+async def send_hashed(stream, file, count, digest, buffer_size=DEFAULT_BUFFER_SIZE):
+    # transfer.send_hashed for an AsyncStream, from the start of file
+    buffer = bytearray(max(1, min(buffer_size, count)))
+    view = memoryview(buffer)
+    sent = 0
+    while sent < count:
+        read = file.readinto(view[:min(len(view), count - sent)])
+        if not read:
+            break
+        digest.update(view[:read])
+        await stream.sendall(view[:read])
+        sent += read
+    return sent
+
+
+class AsyncFTPClient:
+    def __init__(self, host, port, pool_size=DEFAULT_POOL_SIZE, passive=True, verify=True,
+                 buffer_size=DEFAULT_BUFFER_SIZE, timeout=DEFAULT_CONTROL_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.passive = passive
+        self.verify = verify
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(pool_size)
+        self.idle = []  # Connected sessions not running a command
+        self.closed = False
+        # Address data connections go to: the server's IP once a control
+        # connection has resolved it, so sock_connect() does not run
+        # getaddrinfo in an executor thread for every transfer
+        self.data_host = host
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.quit()
+        return False
+
+    # Session pool
+
+    async def connect(self):
+        control = AsyncStream(await open_socket(self.data_host, self.port), self.timeout)
+        self.data_host = control.sock.getpeername()[0]
+        try:
+            await control.send_command("FEAT")
+            response = await control.read_line()
+            features = await control.read_headers() if response.startswith("SUCCESS 211") else {}
+            session = AsyncSession(control, features)
+            if self.passive and "Passive" in features:
+                await control.send_command("PASV")
+                response = await control.read_line()
+                if response.startswith("SUCCESS 227"):
+                    port, secret = response.split()[2:4]
+                    session.passive = (int(port), bytes.fromhex(secret))
+        except BaseException:
+            control.close()
+            raise
+        return session
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        # Borrows a pooled session, connecting a new one while the pool has
+        # room. A session whose command failed with anything but an FTPError
+        # (the server answered, so the control channel is still in step) is
+        # closed rather than returned to the pool.
+        if self.closed:
+            raise FTPError("Client is closed")
+        async with self.slots:
+            session = self.take_idle() or await self.connect()
+            try:
+                yield session
+            except FTPError:
+                self.release(session)
+                raise
+            except BaseException:
+                session.control.close()
+                raise
+            self.release(session)
+
+    def take_idle(self):
+        while self.idle:
+            session = self.idle.pop()
+            if session.control.alive():
+                return session
+            session.control.close()  # Reaped by the server meanwhile
+        return None
+
+    def release(self, session):
+        if self.closed:
+            session.control.close()  # quit() has already run
+        else:
+            self.idle.append(session)
+
+    async def quit(self):
+        # Ends every idle session; sessions still in use are closed when
+        # their command finishes
+        self.closed = True
+        sessions, self.idle = self.idle, []
+        for session in sessions:
+            try:
+                await session.control.send_command("QUIT")
+                await session.control.read_line()
+            except OSError:
+                pass
+            session.control.close()
+
+    # Commands
+
+    def verifying(self, session):
+        return self.verify and "Integrity" in session.features
+
+    async def open_data_channel(self, session, command, headers=None):
+        # Sends a GET/PUT/LS command and returns (response, data stream); the
+        # stream is None when the server did not start a transfer
+        headers = dict(headers or {})
+        loop = asyncio.get_running_loop()
+        connected = listener = None
+        try:
+            if session.passive is not None:
+                # Connect first, so the server finds the connection waiting
+                port, secret = session.passive
+                nonce = session.new_nonce()
+                connected = await open_socket(self.data_host, port)
+                await loop.sock_sendall(connected, TOKEN.pack(secret, nonce))
+                headers["Data-Token"] = str(nonce)
+            else:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.bind(('', 0))
+                listener.listen(1)
+                listener.setblocking(False)
+                headers["Data-Port"] = str(listener.getsockname()[1])
+            await session.control.send_command(command, headers)
+            response = await session.control.read_line()
+            if not response.startswith("SUCCESS 200"):
+                if connected is not None:
+                    connected.close()
+                return response, None
+            if listener is not None:
+                connected, addr = await asyncio.wait_for(loop.sock_accept(listener), CONNECT_TIMEOUT)
+            return response, AsyncStream(connected, self.timeout)
+        except BaseException:
+            if connected is not None:
+                connected.close()
+            raise
+        finally:
+            if listener is not None:
+                listener.close()
+
+    async def check_trailer(self, data, digest):
+        try:
+            trailer = await data.read_headers()
+        except (OSError, ProtocolError):
+            trailer = {}
+        return trailer_error(trailer, digest)
+
+    async def get(self, name, path=None):
+        # Downloads name into path (default: its base name in the current
+        # directory) through path + ".part", which replaces path only once the
+        # whole file has arrived and passed verification
+        path = path or os.path.basename(name)
+        part_path = path + ".part"
+        async with self.session() as session:
+            headers = {"Want-Content-Digest": DIGEST_ALGORITHM} if self.verifying(session) else None
+            started = time.perf_counter()
+            response, data = await self.open_data_channel(session, f"GET {name}", headers)
+            if data is None:
+                raise FTPError(f"GET {name} failed: {response}", response)
+            try:
+                data_headers = await data.read_headers()
+                length = int(data_headers.get("Content-Length", 0))
+                digest = new_digest() if data_headers.get("Trailer") == "Content-Digest" else None
+                with open(part_path, 'wb', buffering=0) as file:
+                    received = await receive_file(data, file, length, self.buffer_size, digest)
+                error = None
+                if received < length:
+                    error = "Connection lost while receiving file data"
+                elif digest is not None:
+                    error = await self.check_trailer(data, digest)
+                if error:
+                    raise FTPError(f"GET {name} failed: {error}")
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(part_path)
+                raise
+            finally:
+                data.close()
+            os.replace(part_path, path)
+        return TransferResult("GET", name, path, received, time.perf_counter() - started,
+                              digest is not None)
+
+    async def put(self, path, name=None):
+        # Uploads the local file path as name (default: its base name)
+        name = name or os.path.basename(path)
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            async with self.session() as session:
+                verify = self.verifying(session)
+                started = time.perf_counter()
+                response, data = await self.open_data_channel(session, f"PUT {name}")
+                if data is None:
+                    raise FTPError(f"PUT {name} failed: {response}", response)
+                try:
+                    headers = {"Content-Length": str(size)}
+                    if verify:
+                        headers["Trailer"] = "Content-Digest"
+                    await data.send_headers(headers)
+                    if verify:
+                        digest = new_digest()
+                        sent = await send_hashed(data, file, size, digest, self.buffer_size)
+                        if sent == size:
+                            await data.send_headers({"Content-Digest": format_digest(digest.digest())})
+                    else:
+                        sent = await data.sendfile(file, 0, size)
+                finally:
+                    data.close()
+                response = await session.control.read_line()
+                if not response.startswith("SUCCESS 201"):
+                    raise FTPError(f"PUT {name} failed: {response}", response)
+        return TransferResult("PUT", name, path, sent, time.perf_counter() - started, verify)
+
+    async def fetch_page(self, session, pattern, headers):
+        # One LS; returns (lines, cursor for the next page or None)
+        command = f"LS {pattern}" if pattern else "LS"
+        response, data = await self.open_data_channel(session, command, headers)
+        if data is None:
+            raise FTPError(f"LS failed: {response}", response)
+        try:
+            data_headers = await data.read_headers()
+            length = int(data_headers.get("Content-Length", 0))
+            try:
+                body = await data.read_exact(length)
+            except ConnectionError:
+                raise FTPError("LS failed: Connection lost while receiving file list")
+        finally:
+            data.close()
+        lines = bytes(body).decode().split('\n') if length else []
+        return lines, data_headers.get("Next-After")
+
+    async def ls(self, pattern=None):
+        # Returns [(name, size, mtime in seconds)] for the uploaded files
+        # matching the fnmatch pattern; size and mtime are None for servers
+        # without long listings
+        async with self.session() as session:
+            if "Listing" not in session.features:
+                names, after = await self.fetch_page(session, None, None)
+                if pattern:
+                    names = fnmatch.filter(names, pattern)
+                return [(name, None, None) for name in names]
+
+            headers = {"Format": "long", "Limit": str(LISTING_PAGE_SIZE)}
+            entries = []
+            while True:
+                lines, after = await self.fetch_page(session, pattern, headers)
+                for line in lines:
+                    size, mtime, name = line.split('\t', 2)
+                    entries.append((name, int(size), int(mtime)))
+                if after is None:
+                    return entries
+                headers["After"] = after
+
+    async def size(self, name):
+        async with self.session() as session:
+            await session.control.send_command(f"SIZE {name}")
+            response = await session.control.read_line()
+        if not response.startswith("SUCCESS 213"):
+            raise FTPError(f"SIZE {name} failed: {response}", response)
+        return int(response.split()[2])
+
+    async def stats(self):
+        # The server's STATS counters as a dict of name -> text
+        async with self.session() as session:
+            await session.control.send_command("STATS")
+            response = await session.control.read_line()
+            if not response.startswith("SUCCESS 211"):
+                raise FTPError(f"STATS failed: {response}", response)
+            return await session.control.read_headers()
@@ -0,0 +1,113 @@
+# Many small GETs from one client process: AsyncFTPClient with a pool of
+# --sessions control sessions on one event loop versus the blocking client
+# with one thread per session. Both write every file to disk through a .part
+# file and verify it against its Content-Digest trailer.
+#
+# usage: python3 benchmarks/bench_async_client.py [--files 200] [--size 4K]
+#            [--transfers 5000] [--sessions 16] [--server-args "--mode asyncio"]
+
+import argparse
+import asyncio
+import os
+import queue
+import shlex
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from async_client import AsyncFTPClient
+from bench_suite import BenchError, write_file
+from FTPClient import close_session, connect_session, get_headers, open_data_channel, receive_body
+from local_server import start_server, stop_server
+from scheduler import parse_size
+
+
+def blocking_get(session, name, path):
+    response, data = open_data_channel(session, f"GET {name}", headers=get_headers(session),
+                                       verbose=False)
+    if data is None:
+        raise BenchError(response)
+    try:
+        data_headers = data.read_headers()
+        size = int(data_headers.get("Content-Length", 0))
+        with open(path + ".part", 'wb', buffering=0) as file:
+            received, error = receive_body(data, data_headers, file, size)
+    finally:
+        data.close()
+    if error:
+        raise BenchError(error)
+    os.replace(path + ".part", path)
+
+
+def run_threads(port, names, output, sessions):
+    jobs = queue.Queue()
+    for index, name in enumerate(names):
+        jobs.put((index, name))
+    errors = []
+
+    def worker():
+        session = connect_session("127.0.0.1", port, verbose=False)
+        try:
+            while True:
+                try:
+                    index, name = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                blocking_get(session, name, os.path.join(output, f"t{index % 1000}"))
+        except (OSError, BenchError) as e:
+            errors.append(e)
+        finally:
+            close_session(session)
+
+    threads = [threading.Thread(target=worker) for _ in range(sessions)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise BenchError(errors[0])
+    return time.perf_counter() - started
+
+
+async def run_async(port, names, output, sessions):
+    async with AsyncFTPClient("127.0.0.1", port, pool_size=sessions) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client.get(name, os.path.join(output, f"a{index % 1000}"))
+                               for index, name in enumerate(names)))
+        return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Async client vs blocking client threads")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=parse_size, default=parse_size("4K"))
+    parser.add_argument("--transfers", type=int, default=5000)
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--server-args", default="", help="extra FTPServer.py arguments")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "uploads"))
+        output = os.path.join(directory, "out")
+        os.makedirs(output)
+        for i in range(args.files):
+            write_file(os.path.join(directory, "uploads", f"small-file{i:05d}.bin"), args.size)
+        names = [f"small-file{i % args.files:05d}.bin" for i in range(args.transfers)]
+
+        server, port = start_server(directory, shlex.split(args.server_args))
+        try:
+            print(f"{args.transfers} GETs of {args.size}-byte files over {args.sessions} sessions")
+            seconds = run_threads(port, names, output, args.sessions)
+            print(f"  {f'blocking client, {args.sessions} threads':34} {args.transfers / seconds:8.0f} GET/s")
+            seconds = asyncio.run(run_async(port, names, output, args.sessions))
+            print(f"  {'AsyncFTPClient, 1 thread':34} {args.transfers / seconds:8.0f} GET/s")
+        finally:
+            stop_server(server)
+
+
+if __name__ == "__main__":
+    main()
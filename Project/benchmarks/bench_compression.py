@@ -0,0 +1,95 @@
+# Content-Encoding benchmark: for each codec, the compression ratio and
+# encode/decode throughput of the streaming path used by GET/PUT, and the
+# resulting transfer time over a link of the given bandwidth compared with
+# sending the file raw. A random (incompressible) file shows the sampling
+# check skipping compression.
+#
+# usage: python3 benchmarks/bench_compression.py [--size 64M] [--link 10M] [--file PATH]
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from compression import CODECS, DecodingReader, choose_encoding, send_encoded
+from scheduler import UNITS, parse_size
+from transfer import receive_file
+
+class Wire:
+    # In-memory stand-in for a data channel that counts the bytes sent
+    def __init__(self):
+        self.data = bytearray()
+        self.pos = 0
+
+    def sendall(self, data):
+        self.data += data
+
+    def read_exact(self, size):
+        if self.pos + size > len(self.data):
+            raise ConnectionError("Wire drained")
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return chunk
+
+
+def make_log(size):
+    random.seed(0)
+    words = ["GET", "PUT", "LS", "served", "client", "bytes", "INFO", "WARN", "session", "closed"]
+    lines = []
+    total = 0
+    while total < size:
+        line = (f"2026-10-18 12:{random.randint(0, 59):02d}:{random.randint(0, 59):02d} "
+                f"{' '.join(random.choices(words, k=6))} {random.randint(0, 10**6)}\n")
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode()[:size]
+
+
+def run(label, payload, link):
+    raw_time = len(payload) / link
+    print(f"{label}: {len(payload)} bytes, raw transfer {raw_time:.2f} s at {link / UNITS['M']:.0f} MiB/s")
+    for name in CODECS:
+        file = io.BytesIO(payload)
+        if choose_encoding(file, 0, [name]) is None:
+            print(f"  {name:>5}: sample does not compress, sent unencoded")
+            continue
+        wire = Wire()
+        start = time.perf_counter()
+        send_encoded(wire, file, name)
+        encoded = time.perf_counter()
+        output = io.BytesIO()
+        receive_file(DecodingReader(wire, name), output, len(payload))
+        decoded = time.perf_counter()
+        if output.getvalue() != payload:
+            raise RuntimeError(f"{name}: decoded data differs")
+        # Encoding, the link and decoding overlap, so the slowest one bounds
+        # the transfer
+        transfer = max(encoded - start, len(wire.data) / link, decoded - encoded)
+        print(f"  {name:>5}: ratio {len(payload) / len(wire.data):5.1f}x  "
+              f"encode {len(payload) / (encoded - start) / UNITS['M']:7.1f} MiB/s  "
+              f"decode {len(payload) / (decoded - encoded) / UNITS['M']:7.1f} MiB/s  "
+              f"transfer {transfer:6.2f} s ({raw_time / transfer:.1f}x faster)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Content-Encoding benchmark")
+    parser.add_argument("--size", default="64M", help="size of the generated files, e.g. 16M")
+    parser.add_argument("--link", default="10M", help="link bandwidth in bytes/s, e.g. 1M or 100M")
+    parser.add_argument("--file", help="also measure this file")
+    args = parser.parse_args()
+    size = parse_size(args.size)
+    link = parse_size(args.link)
+
+    run("text log", make_log(size), link)
+    run("random", os.urandom(size), link)
+    if args.file:
+        with open(args.file, 'rb') as file:
+            run(args.file, file.read(), link)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Microbenchmark for the control channel: byte-at-a-time recv(1) parsing (the
+# original read_line/receive_headers) versus the buffered ProtocolStream.
+# Each round trip is one "GET <file>" command plus its Data-Port header block
+# answered by a status line, over a local socket pair.
+#
+# usage: python3 benchmarks/bench_control_channel.py [--commands N]
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ftp_protocol import ProtocolStream
+
+
+class CountingSocket:
+    # Socket proxy that counts the receive/send calls made through it
+    def __init__(self, sock):
+        self.sock = sock
+        self.recv_calls = 0
+        self.send_calls = 0
+
+    def recv(self, size):
+        self.recv_calls += 1
+        return self.sock.recv(size)
+
+    def recv_into(self, view):
+        self.recv_calls += 1
+        return self.sock.recv_into(view)
+
+    def sendall(self, data):
+        self.send_calls += 1
+        return self.sock.sendall(data)
+
+
+# The original per-byte parser from FTPServer.py / FTPClient.py
+def legacy_read_line(sock):
+    line = b''
+    while not line.endswith(b'\n'):
+        char = sock.recv(1)
+        if not char:
+            break
+        line += char
+    return line.decode().strip()
+
+
+def legacy_read_headers(sock):
+    headers = {}
+    while True:
+        line = legacy_read_line(sock)
+        if line == '':
+            break
+        key, value = line.split(": ", 1)
+        headers[key] = value
+    return headers
+
+
+def legacy_send_command(sock, command, headers):
+    sock.sendall((command + '\n').encode())
+    for key, value in headers.items():
+        sock.sendall(f"{key}: {value}\n".encode())
+    sock.sendall(b'\n')
+
+
+class LegacyEndpoint:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def read_line(self):
+        return legacy_read_line(self.sock)
+
+    def read_headers(self):
+        return legacy_read_headers(self.sock)
+
+    def send_line(self, line):
+        self.sock.sendall((line + '\n').encode())
+
+    def send_command(self, command, headers):
+        legacy_send_command(self.sock, command, headers)
+
+
+HEADERS = {"Data-Port": "54321"}
+
+
+def serve(endpoint, commands):
+    for _ in range(commands):
+        endpoint.read_line()
+        endpoint.read_headers()
+        endpoint.send_line("SUCCESS 200 OK")
+
+
+def run(name, make_endpoint, commands):
+    server_sock, client_sock = socket.socketpair()
+    server_counter = CountingSocket(server_sock)
+    client_counter = CountingSocket(client_sock)
+    server = make_endpoint(server_counter)
+    client = make_endpoint(client_counter)
+
+    thread = threading.Thread(target=serve, args=(server, commands))
+    thread.start()
+    start = time.perf_counter()
+    for i in range(commands):
+        client.send_command(f"GET file{i}.txt", HEADERS)
+        client.read_line()
+    elapsed = time.perf_counter() - start
+    thread.join()
+    server_sock.close()
+    client_sock.close()
+
+    recv_calls = server_counter.recv_calls + client_counter.recv_calls
+    send_calls = server_counter.send_calls + client_counter.send_calls
+    print(f"{name:>9}: {commands / elapsed:10.0f} commands/s  "
+          f"{recv_calls / commands:6.1f} recv calls/command  "
+          f"{send_calls / commands:4.1f} send calls/command")
+    return commands / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control channel microbenchmark")
+    parser.add_argument("--commands", type=int, default=20000)
+    args = parser.parse_args()
+
+    before = run("recv(1)", LegacyEndpoint, args.commands)
+    after = run("buffered", ProtocolStream, args.commands)
+    print(f"Speedup: {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# Capacity of a thread-mode server while flaky clients hold its workers.
+# --flaky connections (by default one per worker) are opened first and left
+# hanging, cycling through three kinds:
+#   idle      connects and never sends a command
+#   half      sends a GET and never finishes its headers
+#   stalled   asks for --large-size over an active data connection and never
+#             reads it
+# then one healthy client runs GETs of a small file, each on a new session,
+# for --duration seconds. Without timeouts the flaky sessions keep every
+# worker and the healthy client gets nothing done; with them the workers
+# come back after --timeout seconds. Reports completed GETs, failures, the
+# wait for the first success and the server's reaped/timed-out counts.
+#
+# usage: python3 benchmarks/bench_flaky_clients.py [--workers 16] [--flaky 16]
+#            [--duration 10] [--timeout 2] [--large-size 32M]
+
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import FTPClient
+from bench_suite import BenchError, get_file, write_file
+from FTPClient import close_session, connect_session
+from local_server import start_server, stop_server
+from scheduler import parse_size
+from socket_options import SocketOptions
+
+KINDS = ["idle", "half", "stalled"]
+
+# How long the healthy client waits for a reply before counting a failure
+CLIENT_TIMEOUT = 5.0
+
+
+def open_flaky(port, kind):
+    # Returns the sockets that keep one flaky session hanging
+    control = socket.create_connection(("127.0.0.1", port))
+    if kind == "half":
+        control.sendall(b"GET small.bin\nData-Port: 1\n")
+    elif kind == "stalled":
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        control.sendall(f"GET large.bin\nData-Port: {listener.getsockname()[1]}\n\n".encode())
+        return [control, listener]
+    return [control]
+
+
+def server_counters(port):
+    session = connect_session("127.0.0.1", port, passive=False, verbose=False)
+    try:
+        session.control.send_command("STATS")
+        if not session.control.read_line().startswith("SUCCESS 211"):
+            return {}
+        return session.control.read_headers()
+    finally:
+        close_session(session)
+
+
+def run(directory, args, label, server_args):
+    server, port = start_server(directory, ["--workers", str(args.workers)] + server_args)
+    flaky = []
+    try:
+        for index in range(args.flaky):
+            flaky.extend(open_flaky(port, KINDS[index % len(KINDS)]))
+        time.sleep(0.2)  # Let the server hand every flaky session a worker
+        started = time.monotonic()
+        first = None
+        completed = failures = 0
+        while time.monotonic() - started < args.duration:
+            try:
+                session = connect_session("127.0.0.1", port, verbose=False)
+                try:
+                    get_file(session, "small.bin")
+                finally:
+                    close_session(session)
+            except (OSError, BenchError):
+                failures += 1
+                continue
+            completed += 1
+            if first is None:
+                first = time.monotonic() - started
+        counters = server_counters(port) if completed else {}
+    finally:
+        for sock in flaky:
+            sock.close()
+        stop_server(server)
+    print(f"  {label:24} {completed:>9} {completed / args.duration:>7.1f} {failures:>8} "
+          f"{'never' if first is None else f'{first:.1f}s':>13} "
+          f"{counters.get('sessions.reaped', '-'):>7} "
+          f"{counters.get('sessions.timed_out', '-'):>9} "
+          f"{counters.get('data_channel.timeouts', '-'):>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server capacity with flaky clients")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--flaky", type=int, default=None,
+                        help="hanging sessions to open (default: one per worker)")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--timeout", type=float, default=2.0,
+                        help="server idle, control and data timeout in the second run")
+    parser.add_argument("--large-size", type=parse_size, default=parse_size("32M"))
+    args = parser.parse_args()
+    if args.flaky is None:
+        args.flaky = args.workers
+    FTPClient.SOCKET_OPTIONS = SocketOptions(CLIENT_TIMEOUT, CLIENT_TIMEOUT)
+
+    timeout = str(args.timeout)
+    runs = [
+        ("no timeouts", ["--idle-timeout", "0", "--control-timeout", "0", "--data-timeout", "0"]),
+        (f"timeouts of {args.timeout:g}s", ["--idle-timeout", timeout, "--control-timeout", timeout,
+                                            "--data-timeout", timeout]),
+    ]
+    print(f"{args.flaky} flaky sessions ({', '.join(KINDS)}), {args.workers} workers, "
+          f"healthy GETs for {args.duration:g}s")
+    print(f"  {'':24} {'completed':>9} {'GET/s':>7} {'failures':>8} {'first success':>13} "
+          f"{'reaped':>7} {'timed out':>9} {'data timeouts':>13}")
+    with tempfile.TemporaryDirectory() as directory:
+        uploads = os.path.join(directory, "uploads")
+        os.makedirs(uploads)
+        write_file(os.path.join(uploads, "small.bin"), 4096)
+        write_file(os.path.join(uploads, "large.bin"), args.large_size)
+        for label, server_args in runs:
+            run(directory, args, label, server_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Server-side cost of serving small files to repeated GETs: the uncached
+# path (isfile, open, fstat, sendfile, close per request) versus the
+# FileCache (one stat per request, then a send from memory). Requests follow
+# a skewed popularity (file i is requested with weight 1/i) and the data is
+# sent over a local socket pair drained by a reader thread.
+#
+# usage: python3 benchmarks/bench_get_cache.py [--files 200] [--size 16K] [--requests 20000]
+
+import argparse
+import os
+import random
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from file_cache import FileCache
+from scheduler import parse_size
+from transfer import send_file
+
+def drain(sock):
+    buffer = bytearray(1024 * 1024)
+    while sock.recv_into(buffer):
+        pass
+
+
+def read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def serve_uncached(sock, path, cache):
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        return send_file(sock, file, 0, size)
+
+
+def serve_cached(sock, path, cache):
+    file_stat = os.stat(path)
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise FileNotFoundError(path)
+    version = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+    data = cache.get(path, version, file_stat.st_size, lambda: read_file(path))
+    sock.sendall(data)
+    return len(data)
+
+
+def measure(name, serve, paths, cache):
+    sender, receiver = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(receiver,))
+    reader.start()
+    start = time.perf_counter()
+    sent = sum(serve(sender, path, cache) for path in paths)
+    elapsed = time.perf_counter() - start
+    sender.close()
+    reader.join()
+    receiver.close()
+    print(f"{name:>10}: {len(paths) / elapsed:9.0f} GETs/s  {sent / elapsed / 1024 ** 2:8.1f} MiB/s  "
+          f"({elapsed * 1e6 / len(paths):.1f} us per GET)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GET hot-file cache benchmark")
+    parser.add_argument("--files", type=int, default=200, help="number of distinct files")
+    parser.add_argument("--size", default="16K", help="size of each file, e.g. 4K or 256K")
+    parser.add_argument("--requests", type=int, default=20000, help="GETs per measurement")
+    parser.add_argument("--cache-size", default="64M", help="cache byte budget")
+    parser.add_argument("--dir", default=None, help="directory for the test files")
+    args = parser.parse_args()
+    size = parse_size(args.size)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        files = []
+        for i in range(args.files):
+            path = os.path.join(directory, f"file{i:05d}.bin")
+            with open(path, 'wb') as file:
+                file.write(os.urandom(size))
+            files.append(path)
+        weights = [1 / rank for rank in range(1, len(files) + 1)]
+        paths = random.Random(1).choices(files, weights, k=args.requests)
+
+        measure("uncached", serve_uncached, paths, None)
+        cache = FileCache(parse_size(args.cache_size), max(size, 1))
+        measure("cached", serve_cached, paths, cache)
+        stats = cache.stats()
+        print(f"cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['evictions']} evictions, {stats['bytes']} bytes held")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# LS cost on a large upload directory: the original os.listdir() plus one
+# os.path.isfile() per entry and a single joined string, versus serving from
+# the DirectoryIndex (one scandir at startup, then a poll per listing) for a
+# full listing, a filtered listing and one page.
+#
+# usage: python3 benchmarks/bench_listing.py [--files 100000] [--repeat 5]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import directory_index
+from directory_index import DirectoryIndex
+
+
+def describe(name, stat):
+    return stat.st_size, stat.st_mtime_ns
+
+
+def legacy_listing(directory):
+    files = os.listdir(directory)
+    files = [f for f in files if os.path.isfile(os.path.join(directory, f))]
+    return '\n'.join(files).encode()
+
+
+def index_listing(index, pattern=None, limit=None):
+    index.refresh()
+    entries, more = index.page(pattern, None, limit)
+    return b'\n'.join(name.encode() for name, size, mtime in entries)
+
+
+def measure(name, function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:>28}: {elapsed * 1000:9.2f} ms  ({len(result)} bytes)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LS listing benchmark")
+    parser.add_argument("--files", type=int, default=100000, help="number of files")
+    parser.add_argument("--repeat", type=int, default=5, help="listings per measurement")
+    parser.add_argument("--dir", default=None, help="directory for the test files")
+    args = parser.parse_args()
+
+    # Poll on every listing so the index pays its full per-request cost
+    directory_index.POLL_INTERVAL = 0
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        print(f"Creating {args.files} files...")
+        for i in range(args.files):
+            open(os.path.join(directory, f"file{i:07d}.log"), 'wb').close()
+
+        index = DirectoryIndex([(directory, describe)])
+        start = time.perf_counter()
+        index.refresh()
+        print(f"Initial index scan: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        measure("listdir + isfile", lambda: legacy_listing(directory), args.repeat)
+        measure("index, full listing", lambda: index_listing(index), args.repeat)
+        measure("index, pattern file00001*", lambda: index_listing(index, "file00001*"), args.repeat)
+        measure("index, first 1000", lambda: index_listing(index, limit=1000), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+# Overlapping disk I/O with the socket (transfer.py) against the serial
+# read/send and receive/write loops, over a localhost TCP connection.
+#
+# Simulated: the file is wrapped so every read or write takes as long as it
+# would on a disk of --disk-rate, and the other end of the connection moves
+# data at --link-rate. Serially a transfer takes the disk time plus the link
+# time; pipelined it takes about the longer of the two. Runs a hashed GET
+# (send_hashed, as for a Content-Digest trailer), an encoded GET
+# (send_encoded) and a PUT (receive_file).
+#
+# The kernel's socket buffers are a pipeline of their own: while the disk is
+# read, the link drains what the send buffer holds. With Linux autotuning on
+# loopback they hold several megabytes and already hide much of the disk
+# time, so by default --socket-buffer fixes SO_SNDBUF/SO_RCVBUF of both
+# ends at 64 KiB (as the server's --sndbuf/--rcvbuf would), modelling a link
+# whose buffers do not cover a disk read; 0 restores autotuning.
+#
+# Cold cache (--cold): the file is dropped from the page cache with
+# POSIX_FADV_DONTNEED before each run and sent with sendfile(), with and
+# without the kernel reading the next window ahead, to a receiver that keeps
+# up with anything. Shows what the real disk gains, if anything.
+#
+# usage: python3 benchmarks/bench_pipeline.py [--size 128M] [--disk-rate 200M]
+#            [--link-rate 200M] [--depth 4] [--buffer-size 1M] [--socket-buffer 64K]
+#            [--cold]
+
+import argparse
+import hashlib
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_suite import write_file
+from compression import send_encoded
+from scheduler import parse_size
+from transfer import receive_file, send_file, send_hashed
+
+
+class Pace:
+    # Makes every count bytes take count / rate seconds from when the last
+    # ones were done or now, whichever is later: time spent waiting for data
+    # is lost, as on a real link, not made up later with a burst
+    def __init__(self, rate):
+        self.rate = rate
+        self.free_at = time.perf_counter()
+
+    def __call__(self, count):
+        self.free_at = max(self.free_at, time.perf_counter()) + count / self.rate
+        ahead = self.free_at - time.perf_counter()
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class SlowFile:
+    # A file whose reads and writes run no faster than rate bytes/s; the
+    # wait blocks the calling thread like a read from a slow disk would
+    def __init__(self, file, rate):
+        self.file = file
+        self.rate = rate
+
+    def seek(self, offset):
+        return self.file.seek(offset)
+
+    def readinto(self, view):
+        started = time.perf_counter()
+        count = self.file.readinto(view)
+        self.wait(count, started)
+        return count
+
+    def write(self, view):
+        started = time.perf_counter()
+        count = self.file.write(view)
+        self.wait(count, started)
+        return count
+
+    def wait(self, count, started):
+        remaining = count / self.rate - (time.perf_counter() - started)
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+# SO_SNDBUF/SO_RCVBUF of both ends, 0 for autotuning; set from --socket-buffer
+SOCKET_BUFFER = 0
+
+
+def connected_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if SOCKET_BUFFER:
+        for sock in (listener, client):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client.connect(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+def drain(sock, rate):
+    # Reads until EOF at no more than rate bytes/s (unlimited when 0)
+    pace = Pace(rate) if rate else None
+    buffer = bytearray(256 * 1024)
+    while True:
+        count = sock.recv_into(buffer)
+        if not count:
+            break
+        if pace:
+            pace(count)
+    sock.close()
+
+
+def feed(sock, size, rate):
+    # Sends size bytes at no more than rate bytes/s
+    pace = Pace(rate)
+    block = os.urandom(256 * 1024)
+    sent = 0
+    while sent < size:
+        count = min(len(block), size - sent)
+        sock.sendall(block[:count])
+        sent += count
+        pace(count)
+    sock.close()
+
+
+def timed_send(send, rate):
+    sender, receiver = connected_pair()
+    thread = threading.Thread(target=drain, args=(receiver, rate))
+    thread.start()
+    started = time.perf_counter()
+    try:
+        send(sender)
+        sender.shutdown(socket.SHUT_WR)
+        thread.join()
+    finally:
+        sender.close()
+    return time.perf_counter() - started
+
+
+def get_hashed(path, args, depth):
+    def send(sock):
+        with open(path, 'rb', buffering=0) as file:
+            send_hashed(sock, SlowFile(file, args.disk_rate), 0, args.size, hashlib.sha256(),
+                        args.buffer_size, depth)
+    return timed_send(send, args.link_rate)
+
+
+def get_encoded(path, args, depth):
+    def send(sock):
+        with open(path, 'rb', buffering=0) as file:
+            send_encoded(sock, SlowFile(file, args.disk_rate), "zlib", 0, args.size, None, depth)
+    return timed_send(send, args.link_rate)
+
+
+def put(path, args, depth):
+    sender, receiver = connected_pair()
+    thread = threading.Thread(target=feed, args=(sender, args.size, args.link_rate))
+    started = time.perf_counter()
+    thread.start()
+    try:
+        with open(path, 'wb', buffering=0) as file:
+            received = receive_file(receiver, SlowFile(file, args.disk_rate), args.size,
+                                    args.buffer_size, depth=depth)
+    finally:
+        receiver.close()
+    thread.join()
+    if received != args.size:
+        raise RuntimeError(f"Received {received} of {args.size} bytes")
+    return time.perf_counter() - started
+
+
+def get_cold(path, args, read_ahead):
+    def send(sock):
+        with open(path, 'rb') as file:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            send_file(sock, file, 0, args.size, read_ahead)
+    return timed_send(send, 0)
+
+
+def report(label, size, seconds, baseline=None):
+    speedup = f"{baseline / seconds:6.2f}x" if baseline else ""
+    print(f"  {label:34} {seconds:7.2f} s {size / 2**20 / seconds:9.1f} MiB/s {speedup}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serial versus pipelined disk and socket I/O")
+    parser.add_argument("--size", type=parse_size, default=parse_size("128M"))
+    parser.add_argument("--disk-rate", type=parse_size, default=parse_size("200M"),
+                        help="simulated disk throughput in bytes/s")
+    parser.add_argument("--link-rate", type=parse_size, default=parse_size("200M"),
+                        help="simulated link throughput in bytes/s")
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--buffer-size", type=parse_size, default=parse_size("1M"))
+    parser.add_argument("--socket-buffer", type=parse_size, default=parse_size("64K"),
+                        help="SO_SNDBUF/SO_RCVBUF of both ends, 0 for autotuning")
+    parser.add_argument("--cold", action="store_true",
+                        help="also send from a cold page cache with sendfile()")
+    args = parser.parse_args()
+    global SOCKET_BUFFER
+    SOCKET_BUFFER = args.socket_buffer
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source.bin")
+        target = os.path.join(directory, "target.bin")
+        write_file(source, args.size)
+        print(f"{args.size / 2**20:.0f} MiB, disk {args.disk_rate / 2**20:.0f} MiB/s, "
+              f"link {args.link_rate / 2**20:.0f} MiB/s, depth {args.depth} x "
+              f"{args.buffer_size // 1024} KiB, socket buffers "
+              f"{f'{args.socket_buffer // 1024} KiB' if args.socket_buffer else 'autotuned'}")
+        for label, run, argument in [("GET hashed", get_hashed, source),
+                                     ("GET encoded (zlib)", get_encoded, source),
+                                     ("PUT", put, target)]:
+            serial = run(argument, args, 0)
+            report(f"{label}, serial", args.size, serial)
+            report(f"{label}, pipelined", args.size, run(argument, args, args.depth), serial)
+
+        if args.cold:
+            print("Cold page cache, sendfile()")
+            read_ahead = args.depth * args.buffer_size
+            serial = get_cold(source, args, 0)
+            report("sendfile", args.size, serial)
+            report(f"sendfile, {read_ahead // 2**20} MiB read-ahead", args.size,
+                   get_cold(source, args, read_ahead), serial)
+
+
+if __name__ == "__main__":
+    main()
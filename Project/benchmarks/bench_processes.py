@@ -0,0 +1,59 @@
+# Scaling of the multi-process server: runs one bench_suite workload against
+# FTPServer.py --processes N for each N in --processes and reports operations/s,
+# MiB/s and server CPU next to the speedup over the first N. The default
+# workload, large-put, is CPU-bound in the server (every upload is hashed to
+# check its Content-Digest), so it scales with processes until the cores,
+# the disk or the clients run out; use at least as many --clients as the
+# largest N.
+#
+# usage: python3 benchmarks/bench_processes.py [--processes 1,2,4,8] [--clients 16]
+#            [--duration 5] [--workload large-put] [--server-args "--mode asyncio"]
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_suite import WORKLOADS, prepare_dataset, run_workload
+from scheduler import parse_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server throughput by number of processes")
+    parser.add_argument("--processes", default="1,2,4,8",
+                        help="comma-separated process counts to compare")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--workload", choices=[name for name in WORKLOADS if name != "baseline"],
+                        default="large-put")
+    parser.add_argument("--small-files", type=int, default=200)
+    parser.add_argument("--small-size", type=parse_size, default=parse_size("4K"))
+    parser.add_argument("--large-size", type=parse_size, default=parse_size("16M"))
+    parser.add_argument("--server-args", default="", help="extra FTPServer.py arguments")
+    args = parser.parse_args()
+    args.ls_files = 1000
+    args.multiplex = False
+    args.active = False
+    server_args = args.server_args
+
+    print(f"{args.workload}, {args.clients} clients, {args.duration:g}s per run, "
+          f"{os.cpu_count()} CPUs")
+    print(f"{'processes':>9} {'ops/s':>9} {'MiB/s':>9} {'server CPU':>11} {'errors':>7} {'speedup':>8}")
+    base = None
+    with tempfile.TemporaryDirectory() as directory:
+        small = prepare_dataset(directory, args)
+        for processes in [int(count) for count in args.processes.split(",")]:
+            args.server_args = f"{server_args} --processes {processes}"
+            summary = run_workload(args.workload, directory, small, args)
+            rate = summary["operations_per_second"]
+            base = base or rate
+            cpu = summary.get("server_cpu_percent")
+            print(f"{processes:>9} {rate:>9.1f} {summary['mib_per_second']:>9.1f} "
+                  f"{'n/a' if cpu is None else f'{cpu:.0f}%':>11} {summary['errors']:>7} "
+                  f"{rate / base if base else 0:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# Micro-benchmarks for the storage layer (storage.py), each comparing the
+# old way with the new one on the filesystem holding --dir:
+#   hashed send   send_hashed() through a buffer vs send_mapped() over mmap
+#   upload write  writing a --size upload with and without posix_fallocate
+#   commits       --uploads small uploads made durable by --threads threads,
+#                 with fsync off, always, and batch
+#   lookups       stat() of random names and a full scan, --files files in
+#                 the flat and the sharded layout
+#
+# usage: python3 benchmarks/bench_storage.py [--size 256M] [--uploads 400]
+#            [--threads 16] [--files 20000] [--dir DIR]
+
+import argparse
+import hashlib
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_suite import write_file
+from scheduler import parse_size
+from storage import FileStorage
+from transfer import DEFAULT_BUFFER_SIZE, send_hashed, send_mapped, write_view
+
+
+def drain(sock):
+    buffer = bytearray(DEFAULT_BUFFER_SIZE)
+    while sock.recv_into(buffer):
+        pass
+
+
+def timed_send(send):
+    # Seconds send(sock) takes to push its data through a socket pair
+    receiver, sender = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(receiver,))
+    reader.start()
+    started = time.perf_counter()
+    send(sender)
+    sender.close()
+    reader.join()
+    receiver.close()
+    return time.perf_counter() - started
+
+
+def bench_hashed_send(directory, size):
+    path = os.path.join(directory, "source.bin")
+    write_file(path, size)
+    storage = FileStorage(directory)
+
+    def buffered(sock):
+        with open(path, 'rb', buffering=0) as file:
+            send_hashed(sock, file, 0, size, hashlib.sha256())
+
+    def mapped(sock):
+        with open(path, 'rb') as file, storage.map_file(file, size) as mapping:
+            send_mapped(sock, mapping, 0, size, hashlib.sha256())
+
+    timed_send(buffered)  # Warm the page cache
+    print("hashed send (SHA-256 + socket), file in page cache:")
+    for label, send in (("read into buffer", buffered), ("mmap", mapped)):
+        seconds = min(timed_send(send) for _ in range(3))
+        print(f"  {label:28} {size / 2**20 / seconds:8.0f} MiB/s")
+    os.remove(path)
+
+
+def bench_upload_write(directory, size):
+    block = memoryview(os.urandom(DEFAULT_BUFFER_SIZE))
+    storage = FileStorage(directory)
+    print(f"upload write of {size} bytes, 1 MiB writes, then fsync:")
+    for label, preallocate in (("plain writes", False), ("posix_fallocate first", True)):
+        path = os.path.join(directory, "upload.bin")
+        started = time.perf_counter()
+        with open(path, 'wb', buffering=0) as file:
+            if preallocate:
+                storage.preallocate(file, 0, size)
+            written = 0
+            while written < size:
+                chunk = block[:min(len(block), size - written)]
+                write_view(file, chunk)
+                written += len(chunk)
+            os.fsync(file.fileno())
+        seconds = time.perf_counter() - started
+        fragments = extent_count(path)
+        print(f"  {label:28} {size / 2**20 / seconds:8.0f} MiB/s"
+              + (f"  ({fragments} extents)" if fragments is not None else ""))
+        os.remove(path)
+
+
+def extent_count(path):
+    # Extents of a file according to filefrag, when it is installed
+    try:
+        output = subprocess.run(["filefrag", path], capture_output=True, text=True).stdout
+        return int(output.rsplit(":", 1)[1].split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def bench_commits(directory, uploads, threads):
+    data = os.urandom(64 * 1024)
+    print(f"{uploads} uploads of 64 KiB committed by {threads} threads:")
+    for mode in ("off", "always", "batch"):
+        root = os.path.join(directory, f"commit-{mode}")
+        os.makedirs(root)
+        storage = FileStorage(root, fsync=mode)
+        names = iter(range(uploads))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    index = next(names, None)
+                if index is None:
+                    return
+                path = os.path.join(storage.partial_directory, f"upload{index}")
+                with open(path, 'wb') as file:
+                    file.write(data)
+                storage.commit(path, f"upload{index}")
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        seconds = time.perf_counter() - started
+        stats = storage.stats()
+        print(f"  fsync {mode:22} {uploads / seconds:8.0f} uploads/s  "
+              f"({stats['fsyncs']} fsyncs, {stats['directory_flushes']} batched directory flushes)")
+
+
+def bench_lookups(directory, files):
+    names = [f"file{i:08d}.dat" for i in range(files)]
+    probes = random.Random(1).choices(names, k=20000)
+    print(f"lookups among {files} files:")
+    for layout in ("flat", "sharded"):
+        root = os.path.join(directory, f"lookup-{layout}")
+        os.makedirs(root)
+        storage = FileStorage(root, layout=layout)
+        storage.relayout()
+        for name in names:
+            open(storage.path(name), 'wb').close()
+        os.sync()
+        started = time.perf_counter()
+        for name in probes:
+            os.stat(storage.path(name))
+        stat_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        found = 0
+        for scanned in storage.directories():
+            with os.scandir(scanned) as scanner:
+                found += sum(1 for entry in scanner if entry.is_file())
+        scan_seconds = time.perf_counter() - started
+        print(f"  {layout:28} {len(probes) / stat_seconds:8.0f} stats/s  "
+              f"full scan {scan_seconds * 1000:.0f} ms ({found} files)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage layer benchmark")
+    parser.add_argument("--size", type=parse_size, default=parse_size("256M"))
+    parser.add_argument("--uploads", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--dir", default=None, help="directory on the filesystem to test")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        bench_hashed_send(directory, args.size)
+        bench_upload_write(directory, args.size)
+        bench_commits(directory, args.uploads, args.threads)
+        bench_lookups(directory, args.files)
+
+
+if __name__ == "__main__":
+    main()
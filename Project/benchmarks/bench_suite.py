@@ -0,0 +1,401 @@
+# End-to-end benchmark and load generator. Starts FTPServer.py on localhost
+# in a scratch directory, drives it with --clients client processes (each
+# one FTPClient session) for --duration seconds per workload, and reports
+# operations/s, MiB/s, p50/p99 latency and server/client CPU time as JSON,
+# so runs on two revisions can be compared with --compare.
+#
+# Workloads:
+#   small-get   GETs of random files from a set of small files
+#   large-get   GETs of one large file
+#   large-put   PUTs of one large file (each client to its own name)
+#   ls          full LS of an upload directory holding --ls-files entries
+#   mixed       70% small GET, 10% small PUT, 10% LS, 10% large GET
+#   baseline    raw streaming with the protocol of sendfilecli.py and
+#               sendfileserv.py (10-byte ASCII length before every 64 KiB
+#               chunk, recv() into a growing bytes object). The scripts
+#               themselves listen on a fixed port and print what they
+#               receive, so their wire protocol is replayed in-process.
+#
+# usage: python3 benchmarks/bench_suite.py [--clients 8] [--duration 5]
+#            [--workloads small-get,ls] [--output results.json]
+#            [--compare previous.json] [--server-args "--mode asyncio"]
+
+import argparse
+import json
+import os
+import platform
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+PROJECT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, PROJECT_DIRECTORY)
+
+from FTPClient import (close_session, connect_session, fetch_listing, get_headers, open_data_channel,
+                       receive_body, send_upload, verifying)
+from ftp_protocol import ProtocolError
+from local_server import start_server, stop_server
+from scheduler import parse_size
+
+WORKLOADS = ["small-get", "large-get", "large-put", "ls", "mixed", "baseline"]
+
+# Chunk size and length prefix of the sendfilecli.py protocol
+LEGACY_CHUNK_SIZE = 65536
+LEGACY_HEADER_SIZE = 10
+
+
+class BenchError(Exception):
+    pass
+
+
+def write_file(path, size):
+    block = os.urandom(min(size, 1024 * 1024)) or b''
+    with open(path, 'wb') as file:
+        remaining = size
+        while remaining > 0:
+            remaining -= file.write(block[:remaining])
+
+
+def prepare_dataset(directory, args):
+    # The files are written to source/, which clients upload from, and
+    # linked into the server's uploads/ directory that GET, PUT and LS share
+    # (a server with --layout sharded moves its links on startup)
+    source = os.path.join(directory, "source")
+    uploads = os.path.join(directory, "uploads")
+    os.makedirs(source, exist_ok=True)
+    os.makedirs(uploads, exist_ok=True)
+    small = [f"small-file{i:05d}.bin" for i in range(args.small_files)]
+    for name in small:
+        write_file(os.path.join(source, name), args.small_size)
+    write_file(os.path.join(source, "large.bin"), args.large_size)
+    for name in small + ["large.bin"]:
+        os.link(os.path.join(source, name), os.path.join(uploads, name))
+    for i in range(args.ls_files):
+        open(os.path.join(uploads, f"entry{i:07d}.log"), 'wb').close()
+    return small
+
+
+# Operations, each returning the number of payload bytes moved
+
+def get_file(session, name):
+    response, data = open_data_channel(session, f"GET {name}", headers=get_headers(session),
+                                       verbose=False)
+    if data is None:
+        raise BenchError(response)
+    try:
+        data_headers = data.read_headers()
+        size = int(data_headers.get("Content-Length", 0))
+        with open(os.devnull, 'wb') as sink:
+            received, error = receive_body(data, data_headers, sink, size)
+    finally:
+        data.close()
+    if error:
+        raise BenchError(error)
+    return received
+
+
+def put_file(session, path, name):
+    response, data = open_data_channel(session, f"PUT {name}", verbose=False)
+    if data is None:
+        raise BenchError(response)
+    try:
+        sent = send_upload(data, path, os.path.getsize(path), verify=verifying(session))
+    finally:
+        data.close()
+    response = session.control.read_line()
+    if not response.startswith("SUCCESS 201"):
+        raise BenchError(response)
+    return sent
+
+
+def list_files(session):
+    names = fetch_listing(session, verbose=False)
+    if names is None:
+        raise BenchError("LS rejected")
+    return sum(len(name) + 1 for name in names)
+
+
+def choose_operation(workload, context, rng):
+    # Returns (operation name, zero-argument callable)
+    session = context["session"]
+    if workload == "mixed":
+        workload = rng.choices(["small-get", "small-put", "ls", "large-get"], [70, 10, 10, 10])[0]
+    if workload == "small-get":
+        name = rng.choice(context["small"])
+        return "GET", lambda: get_file(session, name)
+    if workload == "small-put":
+        name = rng.choice(context["small"])
+        path = os.path.join(context["directory"], "source", name)
+        return "PUT", lambda: put_file(session, path, f"bench-small-{context['worker']}.bin")
+    if workload == "large-get":
+        return "GET", lambda: get_file(session, "large.bin")
+    if workload == "large-put":
+        path = os.path.join(context["directory"], "source", "large.bin")
+        return "PUT", lambda: put_file(session, path, f"bench-large-{context['worker']}.bin")
+    if workload == "ls":
+        return "LS", lambda: list_files(session)
+    raise ValueError(f"Unknown workload {workload}")
+
+
+def run_client(worker, port, workload, directory, small, start_at, duration, multiplex, passive):
+    # Body of one client process: a single session issuing operations back
+    # to back until the deadline
+    context = {"worker": worker, "directory": directory, "small": small,
+               "session": connect_session("127.0.0.1", port, multiplex=multiplex,
+                                          passive=passive, verbose=False)}
+    rng = random.Random(worker)
+    latencies = []
+    transferred = 0
+    errors = 0
+    time.sleep(max(0.0, start_at - time.time()))
+    cpu_started = time.process_time()
+    deadline = start_at + duration
+    while time.time() < deadline:
+        operation, run = choose_operation(workload, context, rng)
+        started = time.perf_counter()
+        try:
+            transferred += run()
+            latencies.append(time.perf_counter() - started)
+        except (BenchError, OSError, ProtocolError):
+            errors += 1
+            try:
+                close_session(context["session"])
+            except OSError:
+                pass
+            context["session"] = connect_session("127.0.0.1", port, multiplex=multiplex,
+                                                 passive=passive, verbose=False)
+    finished = time.time()
+    cpu_seconds = time.process_time() - cpu_started
+    close_session(context["session"])
+    return {"latencies": latencies, "bytes": transferred, "errors": errors,
+            "finished": finished, "cpu_seconds": cpu_seconds}
+
+
+def process_cpu_seconds(pid):
+    # utime + stime of a process and its children (the workers of a server
+    # run with --processes) from /proc, or None where unavailable
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        children = []
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as file:
+                children.extend(int(child) for child in file.read().split())
+    except OSError:
+        return None
+    seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return seconds + sum(process_cpu_seconds(child) or 0.0 for child in children)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(results, wall_seconds, server_cpu, client_cpu):
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    transferred = sum(result["bytes"] for result in results)
+    summary = {
+        "operations": len(latencies),
+        "errors": sum(result["errors"] for result in results),
+        "bytes": transferred,
+        "seconds": round(wall_seconds, 3),
+        "operations_per_second": round(len(latencies) / wall_seconds, 1),
+        "mib_per_second": round(transferred / 2**20 / wall_seconds, 1),
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            "p50": round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+            "p99": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+            "max": round(latencies[-1] * 1000, 3) if latencies else None,
+        },
+        "client_cpu_seconds": round(client_cpu, 3),
+    }
+    if server_cpu is not None:
+        summary["server_cpu_seconds"] = round(server_cpu, 3)
+        summary["server_cpu_percent"] = round(server_cpu / wall_seconds * 100, 1)
+    return summary
+
+
+def run_workload(workload, directory, small, args):
+    server, port = start_server(directory, shlex.split(args.server_args))
+    try:
+        start_at = time.time() + 1.0  # Time for every client to connect
+        with ProcessPoolExecutor(max_workers=args.clients) as executor:
+            futures = [executor.submit(run_client, worker, port, workload, directory, small,
+                                       start_at, args.duration, args.multiplex, not args.active)
+                       for worker in range(args.clients)]
+            time.sleep(max(0.0, start_at - time.time()))
+            cpu_before = process_cpu_seconds(server.pid)
+            results = [future.result() for future in futures]
+            cpu_after = process_cpu_seconds(server.pid)
+    finally:
+        stop_server(server)
+    wall_seconds = max(result["finished"] for result in results) - start_at
+    server_cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return summarize(results, wall_seconds, server_cpu,
+                     sum(result["cpu_seconds"] for result in results))
+
+
+def legacy_send(sock, path):
+    # The sending loop of sendfilecli.py
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(LEGACY_CHUNK_SIZE)
+            if not data:
+                break
+            data = str(len(data)).zfill(LEGACY_HEADER_SIZE).encode() + data
+            sent = 0
+            while len(data) > sent:
+                sent += sock.send(data[sent:])
+
+
+def legacy_recv_all(sock, count):
+    # recvAll() of sendfileserv.py
+    buffer = b""
+    while len(buffer) < count:
+        chunk = sock.recv(count - len(buffer))
+        if not chunk:
+            break
+        buffer += chunk
+    return buffer
+
+
+def legacy_receive(sock):
+    received = 0
+    while True:
+        header = legacy_recv_all(sock, LEGACY_HEADER_SIZE)
+        if len(header) < LEGACY_HEADER_SIZE:
+            return received
+        received += len(legacy_recv_all(sock, int(header.decode())))
+
+
+def run_baseline(directory, args):
+    path = os.path.join(directory, "source", "large.bin")
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    latencies = []
+    transferred = 0
+    cpu_started = time.process_time()
+    start = time.perf_counter()
+    while not latencies or time.perf_counter() - start < args.duration:
+        result = {}
+
+        def receive():
+            conn, _ = listener.accept()
+            result["received"] = legacy_receive(conn)
+            conn.close()
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        started = time.perf_counter()
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            legacy_send(sock, path)
+        receiver.join()
+        latencies.append(time.perf_counter() - started)
+        transferred += result["received"]
+    wall_seconds = time.perf_counter() - start
+    listener.close()
+    # Sender and receiver share this process, so all CPU is counted as client
+    return summarize([{"latencies": latencies, "bytes": transferred, "errors": 0}],
+                     wall_seconds, None, time.process_time() - cpu_started)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIRECTORY,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    print(f"{'workload':>10}  {'ops/s':>20}  {'MiB/s':>20}  {'p99 ms':>20}")
+    for workload, result in current["results"].items():
+        before = previous.get("results", {}).get(workload)
+        if before is None:
+            continue
+        columns = []
+        for key in ("operations_per_second", "mib_per_second"):
+            columns.append(change(before[key], result[key]))
+        columns.append(change(before["latency_ms"]["p99"], result["latency_ms"]["p99"]))
+        print(f"{workload:>10}  " + "  ".join(f"{column:>20}" for column in columns))
+
+
+def change(before, after):
+    if not before or after is None:
+        return f"{before} -> {after}"
+    return f"{before:g} -> {after:g} ({(after - before) / before * 100:+.0f}%)"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FTP server benchmark and load generator")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent client sessions")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per workload")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help=f"comma-separated subset of: {', '.join(WORKLOADS)}")
+    parser.add_argument("--small-files", type=int, default=1000, help="files in the small-file set")
+    parser.add_argument("--small-size", default="4K", help="size of each small file")
+    parser.add_argument("--large-size", default="64M", help="size of the large file")
+    parser.add_argument("--ls-files", type=int, default=20000, help="entries in the listed directory")
+    parser.add_argument("--multiplex", action="store_true",
+                        help="clients use a persistent multiplexed data channel")
+    parser.add_argument("--active", action="store_true",
+                        help="server connects back to the clients instead of passive mode")
+    parser.add_argument("--server-args", default="", help="extra FTPServer.py arguments")
+    parser.add_argument("--dir", default=None, help="directory for the scratch data")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", metavar="JSON", help="earlier results to compare against")
+    args = parser.parse_args()
+    args.small_size = parse_size(args.small_size)
+    args.large_size = parse_size(args.large_size)
+    workloads = [workload.strip() for workload in args.workloads.split(",") if workload.strip()]
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error(f"unknown workload '{workload}'")
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {key: getattr(args, key) for key in
+                   ("clients", "duration", "small_files", "small_size", "large_size",
+                    "ls_files", "multiplex", "active", "server_args")},
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        print("Preparing data...", file=sys.stderr)
+        small = prepare_dataset(directory, args)
+        for workload in workloads:
+            print(f"Running {workload}...", file=sys.stderr)
+            if workload == "baseline":
+                result = run_baseline(directory, args)
+            else:
+                result = run_workload(workload, directory, small, args)
+            report["results"][workload] = result
+            print(f"  {result['operations_per_second']} ops/s, {result['mib_per_second']} MiB/s, "
+                  f"p99 {result['latency_ms']['p99']} ms, {result['errors']} errors", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# Throughput benchmark for the GET/PUT data path over a localhost TCP
+# connection: the original 4 KiB read()/sendall()/recv() loop versus
+# socket.sendfile() on the sending side and recv_into() a preallocated
+# buffer on the receiving side. Both variants write the received file to disk.
+#
+# usage: python3 benchmarks/bench_transfer.py [--size 4G] [--buffer-size 1M]
+
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from scheduler import UNITS, parse_size
+from transfer import DEFAULT_BUFFER_SIZE, receive_file, send_file
+
+def make_source_file(directory, size):
+    path = os.path.join(directory, "source.bin")
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as file:
+        remaining = size
+        while remaining > 0:
+            remaining -= file.write(block[:remaining])
+    return path
+
+
+def legacy_send(sock, path, size, buffer_size):
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(4096)
+            if not chunk:
+                break
+            sock.sendall(chunk)
+
+
+def legacy_receive(sock, path, size, buffer_size):
+    with open(path, 'wb') as file:
+        received = 0
+        while received < size:
+            chunk = sock.recv(min(4096, size - received))
+            if not chunk:
+                break
+            file.write(chunk)
+            received += len(chunk)
+    return received
+
+
+def zero_copy_send(sock, path, size, buffer_size):
+    with open(path, 'rb') as file:
+        send_file(sock, file)
+
+
+def zero_copy_receive(sock, path, size, buffer_size):
+    with open(path, 'wb', buffering=0) as file:
+        return receive_file(sock, file, size, buffer_size)
+
+
+def run(name, sender, receiver, source, destination, size, buffer_size):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    result = {}
+
+    def receive():
+        conn, _ = listener.accept()
+        result["received"] = receiver(conn, destination, size, buffer_size)
+        conn.close()
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    sock = socket.create_connection(listener.getsockname())
+    start = time.perf_counter()
+    sender(sock, source, size, buffer_size)
+    sock.close()
+    thread.join()
+    elapsed = time.perf_counter() - start
+    listener.close()
+
+    if result["received"] != size:
+        raise RuntimeError(f"{name}: received {result['received']} of {size} bytes")
+    throughput = size / elapsed
+    print(f"{name:>10}: {elapsed:7.2f} s  {throughput / UNITS['M']:9.1f} MiB/s")
+    return throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GET/PUT data path benchmark")
+    parser.add_argument("--size", default="2G", help="file size, e.g. 512M or 4G")
+    parser.add_argument("--buffer-size", default=str(DEFAULT_BUFFER_SIZE),
+                        help="recv_into buffer size, e.g. 256K or 4M")
+    parser.add_argument("--dir", default=None, help="directory for the test files")
+    args = parser.parse_args()
+    size = parse_size(args.size)
+    buffer_size = parse_size(args.buffer_size)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        print(f"Creating {size} byte test file...")
+        source = make_source_file(directory, size)
+        destination = os.path.join(directory, "destination.bin")
+        before = run("4 KiB loop", legacy_send, legacy_receive,
+                     source, destination, size, buffer_size)
+        after = run("sendfile", zero_copy_send, zero_copy_receive,
+                    source, destination, size, buffer_size)
+    print(f"Speedup: {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
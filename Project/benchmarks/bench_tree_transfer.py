@@ -0,0 +1,121 @@
+# Moving a directory of many small files: one PUT/GET per file on one
+# session versus one PUTDIR/GETDIR archive stream (tree_transfer.py), both
+# against a local FTPServer.py with Content-Digest verification on.
+#
+# usage: python3 benchmarks/bench_tree_transfer.py [--files 2000] [--size 4K]
+#            [--directories 20] [--server-args "--mode asyncio"] [--multiplex]
+
+import argparse
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_suite import get_file, put_file, write_file
+from FTPClient import close_session, connect_session, get_headers, open_data_channel, verifying
+from integrity import check_trailer, new_digest, send_trailer
+from local_server import start_server, stop_server
+from scheduler import parse_size
+from tree_transfer import CONTENT_TYPE, receive_tree, send_tree
+
+
+def make_tree(root, files, size, directories):
+    names = []
+    for index in range(files):
+        name = f"dir{index % directories:03d}/file{index:06d}.bin"
+        os.makedirs(os.path.join(root, os.path.dirname(name)), exist_ok=True)
+        write_file(os.path.join(root, name), size)
+        names.append(name)
+    return names
+
+
+def put_tree(session, root, name):
+    response, data = open_data_channel(session, f"PUTDIR {name}", verbose=False)
+    if data is None:
+        raise RuntimeError(response)
+    digest = new_digest() if verifying(session) else None
+    try:
+        data.send_headers(dict({"Content-Type": CONTENT_TYPE},
+                               **({"Trailer": "Content-Digest"} if digest else {})))
+        send_tree(data, root, digest=digest)
+        if digest is not None:
+            send_trailer(data, digest.digest())
+    finally:
+        data.close()
+    response = session.control.read_line()
+    if not response.startswith("SUCCESS 201"):
+        raise RuntimeError(response)
+
+
+def get_tree(session, name, root):
+    response, data = open_data_channel(session, f"GETDIR {name}", headers=get_headers(session),
+                                       verbose=False)
+    if data is None:
+        raise RuntimeError(response)
+    try:
+        data_headers = data.read_headers()
+        digest = new_digest() if data_headers.get("Trailer") == "Content-Digest" else None
+        receive_tree(data, root, digest=digest)
+        error = check_trailer(data, data, digest) if digest is not None else None
+    finally:
+        data.close()
+    if error:
+        raise RuntimeError(error)
+
+
+def report(label, files, size, seconds):
+    print(f"  {label:28} {seconds:8.2f} s {files / seconds:9.0f} files/s "
+          f"{files * size / 2**20 / seconds:8.1f} MiB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-file transfers versus PUTDIR/GETDIR")
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size", type=parse_size, default=parse_size("4K"))
+    parser.add_argument("--directories", type=int, default=20)
+    parser.add_argument("--multiplex", action="store_true")
+    parser.add_argument("--server-args", default="", help="extra FTPServer.py arguments")
+    args = parser.parse_args()
+
+    print(f"{args.files} files of {args.size} bytes in {args.directories} directories")
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source")
+        names = make_tree(source, args.files, args.size, args.directories)
+        os.makedirs(os.path.join(directory, "uploads"))
+        server, port = start_server(directory, shlex.split(args.server_args))
+        try:
+            session = connect_session("127.0.0.1", port, multiplex=args.multiplex, verbose=False)
+            try:
+                # The flat namespace has no directories, so per-file names
+                # are flattened; the bytes and the count are the same
+                started = time.perf_counter()
+                for name in names:
+                    put_file(session, os.path.join(source, name), name.replace("/", "-"))
+                report("PUT per file", args.files, args.size, time.perf_counter() - started)
+
+                started = time.perf_counter()
+                put_tree(session, source, "tree")
+                report("PUTDIR", args.files, args.size, time.perf_counter() - started)
+
+                started = time.perf_counter()
+                for name in names:
+                    get_file(session, name.replace("/", "-"))
+                report("GET per file", args.files, args.size, time.perf_counter() - started)
+
+                target = os.path.join(directory, "target")
+                started = time.perf_counter()
+                get_tree(session, "tree", target)
+                report("GETDIR", args.files, args.size, time.perf_counter() - started)
+                shutil.rmtree(target)
+            finally:
+                close_session(session)
+        finally:
+            stop_server(server)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# Checkpoint files for resumable transfers. A checkpoint is a small JSON
+# document stored next to the partial data; it records what the transfer was
+# for (size, version of the source) and how many bytes had safely reached
+# disk, so an interrupted GET or PUT can continue from there.
+
+import json
+import os
+import threading
+import time
+
+# Persist progress at most this often while a transfer is running
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+CHECKPOINT_SECONDS = 1.0
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(path, checkpoint):
+    # Write-then-rename so a crash never leaves a half-written checkpoint; the
+    # temporary name is unique so concurrent writers never share one
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(temp_path, path)
+
+
+def remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class CheckpointWriter:
+    # Progress callback for receive_file that records how far the transfer
+    # got in checkpoint["received"] every few megabytes or seconds
+    def __init__(self, path, checkpoint, offset=0):
+        self.path = path
+        self.checkpoint = checkpoint
+        self.offset = offset  # Bytes already on disk before this transfer
+        self.received = 0
+        self.saved_bytes = 0
+        self.saved_at = time.monotonic()
+
+    def __call__(self, received, total):
+        self.received = received
+        now = time.monotonic()
+        if (received - self.saved_bytes >= CHECKPOINT_BYTES
+                or now - self.saved_at >= CHECKPOINT_SECONDS):
+            self.save(received)
+
+    def save(self, received=None):
+        # Defaults to the last count reported, i.e. what is known to be on disk
+        if received is None:
+            received = self.received
+        self.checkpoint["received"] = self.offset + received
+        save_checkpoint(self.path, self.checkpoint)
+        self.saved_bytes = received
+        self.saved_at = time.monotonic()
@@ -0,0 +1,165 @@
+# Streaming Content-Encoding for GET/PUT bodies. An encoded body is a series
+# of chunks, each a u32 length followed by that many compressed bytes, ended
+# by a zero-length chunk; Content-Length still gives the decoded size. The
+# sender compresses one file block at a time and the receiver decompresses
+# into its receive buffer, so neither side ever holds the whole file.
+#
+# zlib and gzip are always available; lzma and bz2 are offered only when the
+# interpreter was built with them.
+
+import struct
+import zlib
+
+from transfer import PIPELINE_MIN_SIZE, ReadAhead
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+CHUNK = struct.Struct("!I")
+CHUNK_SIZE = 256 * 1024  # File bytes compressed per chunk
+MAX_CHUNK_SIZE = 4 * 1024 * 1024  # Largest encoded chunk a receiver accepts
+
+# The sender compresses this much of the body with a fast zlib level first
+# and sends it unencoded unless that saves at least MIN_SAVING
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVING = 0.1
+
+# Compression runs in line with the transfer, so levels favour speed: zlib
+# level 3 keeps most of level 6's ratio at more than twice the speed, and lzma
+# preset 0 is an order of magnitude faster than its default
+ZLIB_LEVEL = 3
+LZMA_PRESET = 0
+
+# name -> (compressor factory, decompressor factory), in order of preference
+CODECS = {
+    "gzip": (lambda: zlib.compressobj(ZLIB_LEVEL, wbits=31), lambda: zlib.decompressobj(wbits=31)),
+    "zlib": (lambda: zlib.compressobj(ZLIB_LEVEL), zlib.decompressobj),
+}
+if lzma is not None:
+    CODECS["lzma"] = (lambda: lzma.LZMACompressor(preset=LZMA_PRESET), lzma.LZMADecompressor)
+if bz2 is not None:
+    CODECS["bz2"] = (bz2.BZ2Compressor, bz2.BZ2Decompressor)
+
+DECODING_ERRORS = (zlib.error, EOFError, OSError) + ((lzma.LZMAError,) if lzma else ())
+
+
+class DecodingError(Exception):
+    pass
+
+
+def parse_encodings(value):
+    # "gzip, zlib" -> ["gzip", "zlib"]
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+def worth_compressing(sample):
+    return bool(sample) and len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def choose_encoding(file, offset, accepted):
+    # First encoding in accepted that this side supports, or None when there
+    # is none or the data at offset does not compress (already compressed
+    # archives, media, encrypted files)
+    for name in accepted:
+        if name in CODECS:
+            file.seek(offset)
+            return name if worth_compressing(file.read(SAMPLE_SIZE)) else None
+    return None
+
+
+def send_chunk(stream, data):
+    if data:
+        stream.sendall(CHUNK.pack(len(data)) + data)
+
+
+def send_encoded(stream, file, encoding, offset=0, count=None, digest=None, depth=0):
+    # Encoded counterpart of send_file: compresses count bytes of file (all
+    # of it when None) from offset and returns how many file bytes were sent;
+    # digest, if given, is updated with the file bytes before compression.
+    # With depth, a ReadAhead reads the file while blocks are compressed.
+    compressor = CODECS[encoding][0]()
+    total = 0
+    if depth > 1 and (count is None or count >= PIPELINE_MIN_SIZE):
+        with ReadAhead(file, offset, count, CHUNK_SIZE, depth, digest) as reader:
+            for view in reader:
+                send_chunk(stream, compressor.compress(view))
+                total += len(view)
+    else:
+        file.seek(offset)
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        while count is None or total < count:
+            size = len(view) if count is None else min(len(view), count - total)
+            read = file.readinto(view[:size])
+            if not read:
+                break
+            if digest is not None:
+                digest.update(view[:read])
+            send_chunk(stream, compressor.compress(view[:read]))
+            total += read
+    send_chunk(stream, compressor.flush())
+    stream.sendall(CHUNK.pack(0))
+    return total
+
+
+class DecodingReader:
+    # Wraps a data channel carrying an encoded body and offers recv_into()
+    # of the decoded bytes, so receive_file() can consume it unchanged.
+    # Returns 0 once the body ends, or early if the connection drops.
+    def __init__(self, stream, encoding):
+        self.stream = stream
+        self.decompressor = CODECS[encoding][1]()
+        self.pending = b''  # Compressed input not yet consumed
+        self.ended = False
+
+    def read_chunk(self):
+        try:
+            length, = CHUNK.unpack(self.stream.read_exact(CHUNK.size))
+            if length > MAX_CHUNK_SIZE:
+                raise DecodingError(f"Encoded chunk of {length} bytes exceeds {MAX_CHUNK_SIZE}")
+            if length == 0:
+                self.ended = True
+                if not self.decompressor.eof:
+                    raise DecodingError("Encoded body ended before the end of the compressed stream")
+                return False
+            self.pending = bytes(self.stream.read_exact(length))
+        except ConnectionError:
+            self.ended = True
+            return False
+        if self.decompressor.eof:
+            raise DecodingError("Data after the end of the compressed stream")
+        return True
+
+    def recv_into(self, view):
+        while True:
+            if not self.decompressor.eof:
+                # Output is capped at the caller's buffer; zlib keeps the rest
+                # of its input in unconsumed_tail, lzma and bz2 internally
+                try:
+                    output = self.decompressor.decompress(self.pending, len(view))
+                except DECODING_ERRORS as e:
+                    raise DecodingError(f"Invalid encoded data: {e}") from e
+                self.pending = getattr(self.decompressor, "unconsumed_tail", b'')
+                if output:
+                    view[:len(output)] = output
+                    return len(output)
+            if self.ended or not self.read_chunk():
+                return 0
+
+    def recv(self, size):
+        data = bytearray(size)
+        return bytes(data[:self.recv_into(memoryview(data))])
+
+    def finish(self):
+        # Consumes the rest of the body (the final chunk and the end marker
+        # may still be unread once all decoded bytes have been taken), so
+        # whatever follows it on the data channel can be read
+        if self.recv_into(memoryview(bytearray(1))):
+            raise DecodingError("Encoded body is longer than its Content-Length")
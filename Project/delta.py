@@ -0,0 +1,246 @@
+# rsync-style delta encoding for SYNC. The side holding the old copy (the
+# basis) sends one signature per block: a weak Adler-32 checksum that can be
+# rolled forward a byte at a time, plus a strong BLAKE2b digest to confirm a
+# match. The side holding the new copy slides a block-sized window over its
+# file and sends COPY instructions for blocks the basis already has and
+# LITERAL instructions for everything else; the basis side rebuilds the file
+# from those and checks the result against a digest of the whole new file.
+
+import hashlib
+import math
+import struct
+import zlib
+
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 128 * 1024
+
+# Literal runs are split so the receiver never buffers more than this
+MAX_LITERAL = 1024 * 1024
+
+STRONG_DIGEST_SIZE = 16
+FILE_DIGEST_SIZE = 32
+
+# One block signature: weak checksum (u32) | strong digest
+SIGNATURE = struct.Struct(f"!I{STRONG_DIGEST_SIZE}s")
+
+# One instruction: opcode | two u32 arguments
+#   COPY    first block, block count
+#   LITERAL byte count, unused; followed by that many bytes
+#   END     unused, unused; followed by the digest of the whole new file
+INSTRUCTION = struct.Struct("!cII")
+OP_COPY = b'C'
+OP_LITERAL = b'L'
+OP_END = b'E'
+
+ADLER_MOD = 65521
+SEND_BUFFER_SIZE = 256 * 1024
+
+
+class DeltaError(Exception):
+    pass
+
+
+def block_size_for(size):
+    # Roughly sqrt(size), like rsync, so neither the signature list nor the
+    # literal bytes around each change grow too quickly with the file
+    block_size = math.isqrt(size) & ~7
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def strong_digest(data):
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
+
+
+def file_digest(data):
+    return hashlib.blake2b(data, digest_size=FILE_DIGEST_SIZE).digest()
+
+
+def compute_signatures(file, block_size):
+    # Returns the packed signatures of every block of file, the last one
+    # possibly short
+    signatures = bytearray()
+    while True:
+        block = file.read(block_size)
+        if not block:
+            break
+        signatures += SIGNATURE.pack(zlib.adler32(block), strong_digest(block))
+    return bytes(signatures)
+
+
+class SignatureTable:
+    # Lookup of basis blocks by weak checksum. Only full blocks can match a
+    # sliding window; a short last block can only match the end of the file.
+    def __init__(self, payload, block_size, basis_size):
+        if len(payload) % SIGNATURE.size:
+            raise DeltaError("Truncated block signatures")
+        self.block_size = block_size
+        self.signatures = [SIGNATURE.unpack_from(payload, offset)
+                           for offset in range(0, len(payload), SIGNATURE.size)]
+        self.block_count = len(self.signatures)
+        self.tail_length = basis_size - (self.block_count - 1) * block_size if self.block_count else 0
+        full_blocks = self.block_count if self.tail_length == block_size else self.block_count - 1
+        self.weak = {}
+        for index in range(max(0, full_blocks)):
+            self.weak.setdefault(self.signatures[index][0], []).append(index)
+
+    def find(self, view, pos, length, weak, hint):
+        # Index of a basis block equal to view[pos:pos + length], preferring
+        # hint (the block after the previous match) so copies coalesce
+        if length == self.block_size:
+            candidates = self.weak.get(weak)
+        elif length == self.tail_length and self.signatures[-1][0] == weak:
+            candidates = [self.block_count - 1]
+        else:
+            candidates = None
+        if not candidates:
+            return None
+        if hint in candidates:
+            candidates = [hint] + candidates
+        strong = strong_digest(view[pos:pos + length])
+        for index in candidates:
+            if self.signatures[index][1] == strong:
+                return index
+        return None
+
+
+def generate_delta(view, table):
+    # Yields (OP_COPY, first block, count) and (OP_LITERAL, start, end)
+    # instructions that rebuild view from the basis. Each position is first
+    # checked with zlib.adler32 over the whole window, so runs of unchanged
+    # blocks are matched at C speed; the byte-at-a-time rolling search only
+    # runs through data the basis does not have.
+    block_size = table.block_size
+    size = len(view)
+    weak_table = table.weak
+    pos = 0
+    literal_start = 0
+    copy_first, copy_count = 0, 0
+    hint = 0
+
+    while pos < size:
+        length = min(block_size, size - pos)
+        weak = zlib.adler32(view[pos:pos + length])
+        index = table.find(view, pos, length, weak, hint)
+        if index is None and length == block_size:
+            # Roll the window forward until a weak checksum hits, the next
+            # window would run past the end, or the literal gets too long
+            a, b = weak & 0xffff, weak >> 16
+            while index is None:
+                stop = min(size - block_size, literal_start + MAX_LITERAL)
+                while pos < stop:
+                    out, new = view[pos], view[pos + block_size]
+                    a = (a - out + new) % ADLER_MOD
+                    b = (b - block_size * out + a - 1) % ADLER_MOD
+                    pos += 1
+                    if (b << 16 | a) in weak_table:
+                        index = table.find(view, pos, block_size, b << 16 | a, hint)
+                        if index is not None:
+                            break
+                if index is not None or pos >= size - block_size:
+                    break
+                if copy_count:
+                    yield OP_COPY, copy_first, copy_count
+                    copy_count = 0
+                yield OP_LITERAL, literal_start, pos
+                literal_start = pos
+            if index is None:
+                break  # Nothing left that a full block could match
+
+        if index is None:
+            pos += length
+            continue
+
+        if pos > literal_start:
+            if copy_count:
+                yield OP_COPY, copy_first, copy_count
+                copy_count = 0
+            for start in range(literal_start, pos, MAX_LITERAL):
+                yield OP_LITERAL, start, min(pos, start + MAX_LITERAL)
+        if copy_count and index == copy_first + copy_count:
+            copy_count += 1
+        else:
+            if copy_count:
+                yield OP_COPY, copy_first, copy_count
+            copy_first, copy_count = index, 1
+        pos += min(block_size, size - pos)
+        literal_start = pos
+        hint = index + 1
+
+    if copy_count:
+        yield OP_COPY, copy_first, copy_count
+    for start in range(literal_start, size, MAX_LITERAL):
+        yield OP_LITERAL, start, min(size, start + MAX_LITERAL)
+
+
+def send_delta(stream, view, table):
+    # Encodes the delta of view against table onto stream, followed by the
+    # END instruction and the digest of view. Returns (literal bytes, matched
+    # bytes).
+    literal_bytes = 0
+    buffer = bytearray()
+    for op, first, second in generate_delta(view, table):
+        if op == OP_COPY:
+            buffer += INSTRUCTION.pack(OP_COPY, first, second)
+        else:
+            buffer += INSTRUCTION.pack(OP_LITERAL, second - first, 0)
+            literal_bytes += second - first
+            if second - first >= SEND_BUFFER_SIZE:
+                stream.sendall(buffer)
+                buffer.clear()
+                stream.sendall(view[first:second])
+                continue
+            buffer += view[first:second]
+        if len(buffer) >= SEND_BUFFER_SIZE:
+            stream.sendall(buffer)
+            buffer.clear()
+    buffer += INSTRUCTION.pack(OP_END, 0, 0)
+    buffer += file_digest(view)
+    stream.sendall(buffer)
+    return literal_bytes, len(view) - literal_bytes
+
+
+def copy_range(source, output, offset, length, digest, buffer_size=MAX_LITERAL):
+    # Copies length bytes of the source file at offset to output
+    source.seek(offset)
+    while length > 0:
+        chunk = source.read(min(buffer_size, length))
+        if not chunk:
+            raise DeltaError("Basis file changed while it was being read")
+        output.write(chunk)
+        digest.update(chunk)
+        length -= len(chunk)
+
+
+def apply_delta(stream, basis, basis_size, block_size, output, max_size):
+    # Rebuilds the new file into output from the instructions on stream and
+    # the basis file object (None when there is no basis); returns the
+    # number of bytes written. Raises DeltaError if the instructions are
+    # malformed or the result does not match the sender's digest.
+    block_count = -(-basis_size // block_size)
+    digest = hashlib.blake2b(digest_size=FILE_DIGEST_SIZE)
+    written = 0
+    while True:
+        op, first, second = INSTRUCTION.unpack(stream.read_exact(INSTRUCTION.size))
+        if op == OP_END:
+            break
+        if op == OP_COPY:
+            if first + second > block_count:
+                raise DeltaError(f"Block {first + second - 1} is out of range")
+            offset = first * block_size
+            length = min(second * block_size, basis_size - offset)
+            copy_range(basis, output, offset, length, digest)
+            written += length
+        elif op == OP_LITERAL:
+            if first > MAX_LITERAL:
+                raise DeltaError(f"Literal of {first} bytes exceeds {MAX_LITERAL}")
+            chunk = stream.read_exact(first)
+            output.write(chunk)
+            digest.update(chunk)
+            written += first
+        else:
+            raise DeltaError(f"Unknown delta instruction {op!r}")
+        if written > max_size:
+            raise DeltaError(f"Rebuilt file exceeds the announced {max_size} bytes")
+    if stream.read_exact(FILE_DIGEST_SIZE) != digest.digest():
+        raise DeltaError("Rebuilt file does not match the sender's digest")
+    return written
@@ -0,0 +1,126 @@
+# In-memory index of the files LS reports, so a listing does not have to
+# walk the upload directory on every request. Entries are kept in a dict
+# plus a sorted name list, which makes cursor-based pages a bisect away.
+#
+# The server updates single names as uploads complete. Changes made behind
+# its back are picked up by polling: a directory whose mtime moved (files
+# created, removed or renamed) is rescanned, and everything is rescanned
+# every RESCAN_INTERVAL seconds to catch files rewritten in place.
+
+import bisect
+import fnmatch
+import itertools
+import os
+import re
+import stat
+import threading
+import time
+
+POLL_INTERVAL = 1.0
+RESCAN_INTERVAL = 30.0
+
+
+class DirectoryIndex:
+    def __init__(self, sources):
+        # sources: list of (storage, describe). A storage lists the
+        # directories its files are kept in with directories() and says where
+        # one name would be with path(name); describe(name, stat) returns
+        # (size, mtime_ns) for a listed file or None to leave it out. A name
+        # found in an earlier source hides the same name in later ones.
+        self.sources = sources
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.names = []
+        self.directory_mtimes = None
+        self.checked_at = 0.0
+        self.scanned_at = 0.0
+
+    def directory_state(self):
+        # directory -> mtime_ns of every directory the sources keep files in
+        return {directory: os.stat(directory).st_mtime_ns
+                for storage, describe in self.sources for directory in storage.directories()}
+
+    def scan(self):
+        # Full rebuild with os.scandir; directory mtimes are taken first so a
+        # change made during the scan triggers another one
+        mtimes = self.directory_state()
+        entries = {}
+        for storage, describe in self.sources:
+            for directory in storage.directories():
+                with os.scandir(directory) as scanner:
+                    for entry in scanner:
+                        if entry.name in entries or not entry.is_file():
+                            continue
+                        try:
+                            info = describe(entry.name, entry.stat())
+                        except FileNotFoundError:
+                            continue  # Removed while we were scanning
+                        if info is not None:
+                            entries[entry.name] = info
+        self.entries = entries
+        self.names = sorted(entries)
+        self.directory_mtimes = mtimes
+        self.scanned_at = time.monotonic()
+
+    def refresh(self):
+        # Called before serving a listing; cheap unless something changed
+        with self.lock:
+            now = time.monotonic()
+            if self.directory_mtimes is not None and now - self.checked_at < POLL_INTERVAL:
+                return
+            self.checked_at = now
+            if (self.directory_mtimes != self.directory_state()
+                    or now - self.scanned_at >= RESCAN_INTERVAL):
+                self.scan()
+
+    def update(self, name):
+        # Re-reads one name after the server added, replaced or removed it
+        info = None
+        paths = [(storage.path(name), describe) for storage, describe in self.sources]
+        paths = [(path, describe) for path, describe in paths if path is not None]
+        for path, describe in paths:
+            try:
+                file_stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(file_stat.st_mode):
+                info = describe(name, file_stat)
+                if info is not None:
+                    break
+        with self.lock:
+            if self.directory_mtimes is None:
+                return  # Not scanned yet; the first listing will see it
+            known = name in self.entries
+            if info is not None:
+                self.entries[name] = info
+                if not known:
+                    bisect.insort(self.names, name)
+            elif known:
+                del self.entries[name]
+                del self.names[bisect.bisect_left(self.names, name)]
+            # The mtime of the directory holding name moved because of this
+            # change; remember it so the next poll does not mistake it for an
+            # outside change
+            for path, describe in paths:
+                directory = os.path.dirname(path)
+                if directory in self.directory_mtimes:
+                    self.directory_mtimes[directory] = os.stat(directory).st_mtime_ns
+
+    def page(self, pattern=None, after=None, limit=None):
+        # Returns ([(name, size, mtime_ns), ...], more) for up to limit names
+        # sorting after `after` that match the fnmatch pattern; more is True
+        # when further matches remain. The pattern is compiled once and the
+        # names are filtered with filter/islice rather than a Python loop.
+        if limit is not None and limit < 1:
+            raise ValueError(f"Invalid page limit {limit}")
+        with self.lock:
+            start = bisect.bisect_right(self.names, after) if after else 0
+            names = itertools.islice(self.names, start, None)
+            if pattern:
+                names = filter(re.compile(fnmatch.translate(pattern)).match, names)
+            names = list(names if limit is None else itertools.islice(names, limit + 1))
+            more = limit is not None and len(names) > limit
+            if more:
+                del names[limit:]
+            entries = self.entries
+            return [(name,) + entries[name] for name in names], more
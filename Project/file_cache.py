@@ -0,0 +1,94 @@
+# In-memory cache of small, frequently downloaded files for GET. Entries are
+# kept in LRU order within a byte budget and carry the version they were read
+# at (size, mtime and inode for plain files, the digest for stored ones); a
+# lookup with a different version drops the stale copy and reloads it. Files
+# over max_file_size are left to sendfile(), which already serves them from
+# the kernel page cache without copying; past roughly 128 KiB the open/fstat
+# calls saved per GET no longer outweigh the copy (benchmarks/bench_get_cache.py).
+
+import collections
+import io
+import threading
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_FILE_SIZE = 128 * 1024
+
+
+class CachedFile(io.BytesIO):
+    # A cached file handed to GET: readable and seekable for compression and
+    # ranges, and sent straight from memory otherwise
+    def __init__(self, data):
+        super().__init__(data)
+        self.data = data
+
+    def send_range(self, sock, offset=0, count=None):
+        end = len(self.data) if count is None else offset + count
+        view = memoryview(self.data)[offset:end]
+        sock.sendall(view)
+        return len(view)
+
+
+class FileCache:
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, max_file_size=DEFAULT_MAX_FILE_SIZE):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (version, data)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, key, version, size, load):
+        # Returns the contents of key at version, calling load() to read them
+        # on a miss. Returns None for files too large to cache or when load()
+        # returned a different size (the file changed while being read).
+        if size > self.max_file_size:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == version:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self.remove(key)
+                self.invalidations += 1
+            self.misses += 1
+
+        data = load()
+        if len(data) != size:
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)  # Loaded concurrently; keep the newest
+            self.entries[key] = (version, data)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                evicted_key, (evicted_version, evicted) = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+        return data
+
+    def remove(self, key):
+        # Caller holds the lock
+        version, data = self.entries.pop(key)
+        self.bytes -= len(data)
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+            }
@@ -0,0 +1,440 @@
+# Buffered framing for the control channel and the header block that starts
+# every data transfer. One ProtocolStream wraps one socket: lines and headers
+# are parsed out of a receive buffer filled with large recv() calls, and any
+# bytes read past the end of a line stay buffered for the next read (or for
+# the file data that follows a header block).
+#
+# MuxChannel carries many transfers over one persistent data connection as
+# length-prefixed frames tagged with a transfer ID. Each MuxTransfer offers
+# the same send_headers/read_headers/recv_into/sendfile calls as a
+# ProtocolStream on a per-transfer data socket, so GET/PUT/LS code does not
+# care which kind of data channel it was given.
+#
+# Data frames are flow controlled per transfer: a sender may have at most
+# TRANSFER_WINDOW bytes of data frames that the receiving transfer has not
+# consumed yet, and the receiver hands back credit as it reads them, so one
+# slow consumer cannot make its side buffer a whole file. Frames for a
+# transfer that was already closed, or never opened with a headers frame,
+# are dropped, and their data credited straight back so the sender can
+# finish.
+
+import collections
+import socket
+import struct
+import threading
+
+MAX_LINE_LENGTH = 8192
+MAX_HEADER_BYTES = 64 * 1024
+RECV_SIZE = 64 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class LineTooLong(ProtocolError):
+    pass
+
+
+class HeadersTooLarge(ProtocolError):
+    pass
+
+
+def parse_headers(text):
+    headers = {}
+    for line in text.split('\n'):
+        line = line.strip()
+        if line == '':
+            continue
+        if ': ' in line:
+            key, value = line.split(": ", 1)
+            headers[key] = value
+        else:
+            print(f"Malformed header line: {line}")
+    return headers
+
+
+def format_headers(headers):
+    lines = [f"{key}: {value}\n" for key, value in headers.items()]
+    lines.append("\n")  # End of headers
+    return "".join(lines)
+
+
+class ProtocolStream:
+    def __init__(self, sock, max_line=MAX_LINE_LENGTH,
+                 max_header_bytes=MAX_HEADER_BYTES, recv_size=RECV_SIZE):
+        self.sock = sock
+        self.max_line = max_line
+        self.max_header_bytes = max_header_bytes
+        self.recv_size = recv_size
+        self.buffer = bytearray()
+        self.pos = 0  # Start of the unread part of buffer
+
+    @property
+    def buffered(self):
+        return len(self.buffer) - self.pos
+
+    def fill(self):
+        # Compact consumed bytes before growing the buffer so it never holds
+        # more than one line plus one recv() worth of data
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        chunk = self.sock.recv(self.recv_size)
+        if not chunk:
+            return False
+        self.buffer += chunk
+        return True
+
+    def read_raw_line(self):
+        # Returns one line including its newline, or whatever is left when
+        # the peer closes the connection (b'' at EOF)
+        searched = 0  # Unread bytes already known to hold no newline
+        while True:
+            end = self.buffer.find(b'\n', self.pos + searched)
+            if end >= 0:
+                end += 1
+                if end - self.pos > self.max_line:
+                    raise LineTooLong(f"Line exceeds {self.max_line} bytes")
+                line = bytes(self.buffer[self.pos:end])
+                self.pos = end
+                return line
+            searched = self.buffered
+            if searched > self.max_line:
+                raise LineTooLong(f"Line exceeds {self.max_line} bytes")
+            if not self.fill():
+                line = bytes(self.buffer[self.pos:])
+                self.pos = len(self.buffer)
+                return line
+
+    def read_line(self):
+        return self.read_raw_line().decode().strip()
+
+    def read_headers(self):
+        headers = {}
+        total = 0
+        while True:
+            raw = self.read_raw_line()
+            total += len(raw)
+            if total > self.max_header_bytes:
+                raise HeadersTooLarge(f"Headers exceed {self.max_header_bytes} bytes")
+            line = raw.decode().strip()
+            if line == '':
+                break  # End of headers
+            if ': ' in line:
+                key, value = line.split(": ", 1)
+                headers[key] = value
+            else:
+                print(f"Malformed header line: {line}")
+        return headers
+
+    def recv_into(self, view):
+        # Serves leftover buffered bytes first, then reads from the socket
+        if self.buffered:
+            count = min(len(view), self.buffered)
+            view[:count] = self.buffer[self.pos:self.pos + count]
+            self.pos += count
+            return count
+        return self.sock.recv_into(view)
+
+    def recv(self, size):
+        if self.buffered:
+            chunk = bytes(self.buffer[self.pos:self.pos + size])
+            self.pos += len(chunk)
+            return chunk
+        return self.sock.recv(size)
+
+    def read_exact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = self.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Connection closed in the middle of a frame")
+            received += count
+        return data
+
+    def sendfile(self, file, offset=0, count=None):
+        return self.sock.sendfile(file, offset, count)
+
+    def send_line(self, line):
+        self.sock.sendall((line + '\n').encode())
+
+    def send_headers(self, headers):
+        self.sock.sendall(format_headers(headers).encode())
+
+    def send_command(self, command, headers=None):
+        # Command line and header block go out in a single send
+        message = command + '\n'
+        if headers:
+            message += format_headers(headers)
+        self.sock.sendall(message.encode())
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+
+# Frame layout on a multiplexed data channel:
+#   transfer ID (u32) | frame type (u8) | payload length (u32) | payload
+FRAME_HEADER = struct.Struct("!IBI")
+FRAME_HEADERS = 1  # Payload is a header block, starts a transfer
+FRAME_DATA = 2
+FRAME_END = 3  # Sender has finished this transfer
+FRAME_CREDIT = 4  # Payload is a u32: more data bytes the receiver will take
+MAX_FRAME_SIZE = 256 * 1024
+SMALL_FRAME_SIZE = 16 * 1024  # Copied together with its header into one send
+CREDIT = struct.Struct("!I")
+
+# Data bytes a transfer may have in flight before the receiver grants more;
+# credit is returned once half of it has been consumed
+TRANSFER_WINDOW = 4 * MAX_FRAME_SIZE
+
+# Closed transfer IDs remembered so late frames for them are not mistaken
+# for new transfers
+RELEASED_IDS = 4096
+
+
+class MuxTransfer:
+    # One transfer on a MuxChannel; frames for it are queued by the channel's
+    # reader thread until the transfer consumes them
+
+    def __init__(self, channel, transfer_id):
+        self.channel = channel
+        self.transfer_id = transfer_id
+        self.frames = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False  # No more frames will arrive
+        self.released = False  # Closed on this side; frames are no longer queued
+        self.current = None
+        self.current_pos = 0
+        self.sent = False
+        self.credit = TRANSFER_WINDOW  # Data bytes we may still send
+        self.consumed = 0  # Data bytes read but not yet credited back
+
+    def deliver(self, frame_type, payload):
+        # False once the transfer has been closed here; the frame is dropped
+        with self.condition:
+            if self.released:
+                return False
+            self.frames.append((frame_type, payload))
+            self.condition.notify_all()
+            return True
+
+    def add_credit(self, amount):
+        with self.condition:
+            self.credit += amount
+            self.condition.notify_all()
+
+    def disconnect(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def next_frame(self):
+        with self.condition:
+            while not self.frames:
+                if self.closed:
+                    return FRAME_END, b''
+                self.condition.wait()
+            return self.frames.popleft()
+
+    def take_credit(self, size):
+        # Waits until some of size bytes may be sent; returns how many
+        with self.condition:
+            while self.credit <= 0:
+                if self.closed:
+                    raise ConnectionError("Multiplexed data channel closed")
+                self.condition.wait()
+            count = min(size, self.credit)
+            self.credit -= count
+            return count
+
+    def return_credit(self, amount):
+        self.consumed += amount
+        if self.consumed >= TRANSFER_WINDOW // 2:
+            self.channel.send_credit(self.transfer_id, self.consumed)
+            self.consumed = 0
+
+    def read_headers(self):
+        frame_type, payload = self.next_frame()
+        if frame_type != FRAME_HEADERS:
+            raise ProtocolError(f"Transfer {self.transfer_id} did not start with headers")
+        return parse_headers(bytes(payload).decode())
+
+    def recv_into(self, view):
+        while self.current is None or self.current_pos == len(self.current):
+            frame_type, payload = self.next_frame()
+            if frame_type == FRAME_END:
+                self.current = None
+                return 0
+            if frame_type != FRAME_DATA:
+                raise ProtocolError(f"Unexpected frame type {frame_type} in transfer {self.transfer_id}")
+            self.return_credit(len(payload))
+            self.current = payload
+            self.current_pos = 0
+        count = min(len(view), len(self.current) - self.current_pos)
+        view[:count] = self.current[self.current_pos:self.current_pos + count]
+        self.current_pos += count
+        return count
+
+    def recv(self, size):
+        data = bytearray(size)
+        return bytes(data[:self.recv_into(memoryview(data))])
+
+    def read_exact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = self.recv_into(view[received:])
+            if not count:
+                raise ConnectionError(f"Transfer {self.transfer_id} ended in the middle of a frame")
+            received += count
+        return data
+
+    def send_headers(self, headers):
+        self.sent = True
+        self.channel.send_frame(self.transfer_id, FRAME_HEADERS, format_headers(headers).encode())
+
+    def send_data(self, view):
+        while view:
+            count = self.take_credit(min(len(view), MAX_FRAME_SIZE))
+            self.channel.send_frame(self.transfer_id, FRAME_DATA, view[:count])
+            view = view[count:]
+
+    def sendall(self, data):
+        self.sent = True
+        self.send_data(memoryview(data))
+
+    def sendfile(self, file, offset=0, count=None):
+        # Frames have to be built in user space, so this reads the file into
+        # one reused buffer instead of using os.sendfile
+        self.sent = True
+        file.seek(offset)
+        buffer = bytearray(MAX_FRAME_SIZE)
+        view = memoryview(buffer)
+        total = 0
+        while count is None or total < count:
+            size = len(view) if count is None else min(len(view), count - total)
+            read = file.readinto(view[:size])
+            if not read:
+                break
+            self.send_data(view[:read])
+            total += read
+        return total
+
+    def close(self):
+        if self.sent:
+            self.channel.send_frame(self.transfer_id, FRAME_END, b'')
+        with self.condition:
+            self.released = True
+            unread = sum(len(payload) for frame_type, payload in self.frames
+                         if frame_type == FRAME_DATA)
+            self.frames.clear()
+        self.channel.release(self.transfer_id)
+        # Data that arrived but was never read is credited back, so a peer
+        # still sending does not wait for credit that would never come
+        if unread + self.consumed:
+            self.channel.send_credit(self.transfer_id, unread + self.consumed)
+            self.consumed = 0
+
+
+class MuxChannel:
+    def __init__(self, sock):
+        self.sock = sock
+        # Frames are written as soon as they are complete; waiting for more
+        # data (Nagle) would stall small transfers behind delayed ACKs
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = ProtocolStream(sock)
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.transfers = {}
+        self.released = collections.OrderedDict()  # Recently closed IDs, oldest first
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_frames, daemon=True)
+
+    def start(self):
+        self.reader.start()
+        return self
+
+    def open(self, transfer_id):
+        # Transfers are created on first use by either side, so frames that
+        # arrive before the local handler opens the transfer are kept
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            if transfer is None:
+                transfer = MuxTransfer(self, transfer_id)
+                if self.closed:
+                    transfer.disconnect()
+                self.transfers[transfer_id] = transfer
+                self.released.pop(transfer_id, None)
+            return transfer
+
+    def release(self, transfer_id):
+        with self.lock:
+            self.transfers.pop(transfer_id, None)
+            self.released[transfer_id] = True
+            if len(self.released) > RELEASED_IDS:
+                self.released.popitem(last=False)
+
+    def receiving(self, transfer_id, frame_type):
+        # The transfer a frame from the peer belongs to, or None to drop it:
+        # only a headers frame for an ID not seen closed starts a transfer
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            if transfer is None and frame_type == FRAME_HEADERS and transfer_id not in self.released:
+                transfer = MuxTransfer(self, transfer_id)
+                self.transfers[transfer_id] = transfer
+            return transfer
+
+    def send_credit(self, transfer_id, amount):
+        try:
+            self.send_frame(transfer_id, FRAME_CREDIT, CREDIT.pack(amount))
+        except OSError:
+            pass  # The channel is gone; so is the sender waiting for this
+
+    def send_frame(self, transfer_id, frame_type, payload):
+        header = FRAME_HEADER.pack(transfer_id, frame_type, len(payload))
+        with self.send_lock:
+            if len(payload) <= SMALL_FRAME_SIZE:
+                self.sock.sendall(header + bytes(payload))
+            else:
+                self.sock.sendall(header)
+                self.sock.sendall(payload)
+
+    def read_frames(self):
+        try:
+            while True:
+                header = self.stream.read_exact(FRAME_HEADER.size)
+                transfer_id, frame_type, length = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    raise ProtocolError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+                payload = self.stream.read_exact(length) if length else b''
+                transfer = self.receiving(transfer_id, frame_type)
+                if frame_type == FRAME_CREDIT:
+                    if length != CREDIT.size:
+                        raise ProtocolError(f"Credit frame of {length} bytes")
+                    if transfer is not None:
+                        transfer.add_credit(CREDIT.unpack(payload)[0])
+                elif transfer is None or not transfer.deliver(frame_type, payload):
+                    if frame_type == FRAME_DATA and length:
+                        self.send_credit(transfer_id, length)
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            with self.lock:
+                self.closed = True
+                transfers = list(self.transfers.values())
+            for transfer in transfers:
+                transfer.disconnect()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
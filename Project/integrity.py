@@ -0,0 +1,93 @@
+# End-to-end verification of GET and PUT bodies with Content-Digest trailers.
+# A sender that was asked for one (Want-Content-Digest on a GET, Trailer on
+# a PUT's data headers) hashes the body in the same loop that sends it and
+# follows the last byte with one more header block:
+#
+#   Content-Digest: sha-256=:<base64 digest>:
+#
+# The digest covers the bytes of this body only (the requested range of a
+# ranged GET or resumed PUT) as they are on disk, i.e. before compression.
+# The receiver hashes what it writes in the same pass and keeps the data
+# only when the digests match; a body cut short never gets its trailer, so
+# truncation fails the check as well.
+#
+# SHA-256 is the fastest strong digest hashlib offers on current hardware
+# (SHA extensions), and it is the one the content store already uses.
+#
+# The server keeps the digests of whole files it has sent in a DigestCache,
+# keyed by name and version like FileCache, so a repeated full GET goes back
+# to sendfile() and does not rehash the file.
+
+import collections
+import hashlib
+import threading
+
+from compression import DecodingError, DecodingReader
+from ftp_protocol import ProtocolError
+from store import format_digest, parse_digest
+
+DEFAULT_DIGEST_ENTRIES = 16384
+
+
+def new_digest():
+    return hashlib.sha256()
+
+
+def send_trailer(data, digest):
+    # digest is the raw digest of the body just sent
+    data.send_headers({"Content-Digest": format_digest(digest)})
+
+
+def check_trailer(data, stream, digest):
+    # Reads the trailer following a body received through stream (data
+    # itself, or a decoder over it) and compares it with digest, the hash of
+    # the bytes received. Returns None when they match, otherwise the reason.
+    try:
+        if isinstance(stream, DecodingReader):
+            stream.finish()
+        trailer = data.read_headers()
+    except (OSError, ProtocolError, DecodingError):
+        trailer = {}
+    return trailer_error(trailer, digest)
+
+
+def trailer_error(trailer, digest):
+    # Compares the headers of a received trailer with digest; None when they
+    # match, otherwise the reason
+    expected = parse_digest(trailer.get("Content-Digest", ""))
+    if expected is None:
+        return "Missing Content-Digest Trailer"
+    if expected != digest.hexdigest():
+        return "Content-Digest Mismatch"
+    return None
+
+
+class DigestCache:
+    def __init__(self, max_entries=DEFAULT_DIGEST_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (version, digest)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        # The digest of key at version, or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, digest):
+        with self.lock:
+            self.entries[key] = (version, digest)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
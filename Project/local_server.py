@@ -0,0 +1,53 @@
+# Runs FTPServer.py as a child process on a free localhost port, for the
+# tests and the benchmarks that drive a real server over sockets.
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+SERVER_START_TIMEOUT = 10.0
+
+
+class ServerStartError(Exception):
+    pass
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(directory, server_args):
+    # Starts a server in directory and waits until it accepts connections;
+    # returns (process, port)
+    port = free_port()
+    command = [sys.executable, os.path.join(PROJECT_DIRECTORY, "FTPServer.py"),
+               "--port", str(port)] + server_args
+    server = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            # A bare connect and close is a session the server simply ends
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server, port
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise ServerStartError(f"Server did not start: {' '.join(command)}")
+            time.sleep(0.05)
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=SERVER_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
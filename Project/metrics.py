@@ -0,0 +1,207 @@
+# Counters, gauges and latency/size histograms shared by the server and the
+# client, plus a throttled progress printer and a cProfile hook. Everything
+# is kept in process memory; snapshot() flattens it into name -> text pairs
+# that the server sends in reply to STATS and the client prints locally.
+# export() gives the same state as plain JSON-able data that merge_exports()
+# can add up, which is how a multi-process server reports one set of STATS.
+#
+# Histograms use fixed logarithmic buckets (eight per decade, 1e-6 to 1e12),
+# so observing a value is a bisect and an increment, and percentiles are
+# accurate to within one bucket (about 33%).
+
+import bisect
+import cProfile
+import threading
+import time
+
+BUCKET_BOUNDS = [10 ** (exponent / 8) for exponent in range(-48, 97)]
+
+# Minimum seconds between two progress lines for the same transfer
+PROGRESS_INTERVAL = 1.0
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested rank, clamped to
+        # the values actually seen
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                bound = BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+    def export(self):
+        # Only the non-empty buckets, as [index, count] pairs
+        return {"buckets": [[index, count] for index, count in enumerate(self.buckets) if count],
+                "count": self.count, "total": self.total, "min": self.min, "max": self.max}
+
+    def merge(self, state):
+        # Adds the observations of an exported histogram to this one
+        for index, count in state["buckets"]:
+            self.buckets[index] += count
+        self.count += state["count"]
+        self.total += state["total"]
+        for name, pick in (("min", min), ("max", max)):
+            if state[name] is not None:
+                mine = getattr(self, name)
+                setattr(self, name, state[name] if mine is None else pick(mine, state[name]))
+
+    def summary(self):
+        if not self.count:
+            return "count=0"
+        return (f"count={self.count} mean={self.total / self.count:.6g} "
+                f"p50={self.percentile(0.5):.6g} p90={self.percentile(0.9):.6g} "
+                f"p99={self.percentile(0.99):.6g} max={self.max:.6g}")
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.sources = {}  # prefix -> function returning a dict of values
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def adjust(self, name, delta):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def record_transfer(self, operation, count, seconds):
+        # Bytes moved by one GET/PUT/... and the rate it ran at
+        self.increment(f"transfer.{operation}.bytes", count)
+        self.observe(f"transfer.{operation}.size_bytes", count)
+        if seconds > 0:
+            self.observe(f"transfer.{operation}.bytes_per_second", count / seconds)
+
+    def add_source(self, prefix, function):
+        # Values computed on demand, e.g. the GET cache counters
+        self.sources[prefix] = function
+
+    def export(self):
+        # Values from sources count as gauges: they describe this process as
+        # it is now (cache contents), not work done that should add up
+        with self.lock:
+            state = {
+                "uptime_seconds": time.monotonic() - self.started,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {name: histogram.export() for name, histogram in self.histograms.items()},
+            }
+        for prefix, function in self.sources.items():
+            state["gauges"].update((f"{prefix}.{name}", value) for name, value in function().items())
+        return state
+
+    def snapshot(self):
+        return format_snapshot(self.export())
+
+
+def merge_exports(states):
+    # One export adding up the counters, gauges and histograms of several
+    merged = {"uptime_seconds": 0.0, "counters": {}, "gauges": {}, "histograms": {}}
+    histograms = {}
+    for state in states:
+        merged["uptime_seconds"] = max(merged["uptime_seconds"], state["uptime_seconds"])
+        for kind in ("counters", "gauges"):
+            totals = merged[kind]
+            for name, value in state[kind].items():
+                totals[name] = totals.get(name, 0) + value
+        for name, histogram in state["histograms"].items():
+            histograms.setdefault(name, Histogram()).merge(histogram)
+    merged["histograms"] = {name: histogram.export() for name, histogram in histograms.items()}
+    return merged
+
+
+def format_snapshot(state):
+    # An export as the name -> text pairs STATS sends
+    values = {"uptime_seconds": f"{state['uptime_seconds']:.1f}"}
+    values.update((name, str(value)) for name, value in state["counters"].items())
+    values.update((name, str(value)) for name, value in state["gauges"].items())
+    for name, exported in state["histograms"].items():
+        histogram = Histogram()
+        histogram.merge(exported)
+        values[name] = histogram.summary()
+    return dict(sorted(values.items()))
+
+
+class ProgressReporter:
+    # progress(received, expected) callback for receive_file that prints at
+    # most one line per interval (and one at the end) instead of one per
+    # buffer, which cost more than the copy itself on fast links
+    def __init__(self, label, total, start=0, interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.total = total
+        self.start = start
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def __call__(self, received, expected):
+        now = time.monotonic()
+        if received < expected and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        done = self.start + received
+        rate = received / 2**20 / max(now - self.started, 1e-9)
+        print(f"{self.label}: {done}/{self.total} bytes "
+              f"({done * 100 // max(self.total, 1)}%, {rate:.1f} MiB/s)")
+
+
+class SessionProfiler:
+    # Opt-in cProfile hook: wrap the code to profile in `with profiler:` (may
+    # be entered many times, from different threads one after another) and
+    # write the accumulated stats with dump(); read them with pstats. From
+    # Python 3.12 only one profiler can be enabled in the interpreter at a
+    # time, so a command that starts while another session's is running goes
+    # unprofiled and is counted in skipped.
+    def __init__(self, path):
+        self.path = path
+        self.profile = cProfile.Profile()
+        self.enabled = False
+        self.skipped = 0
+
+    def __enter__(self):
+        try:
+            self.profile.enable()
+            self.enabled = True
+        except ValueError:
+            # "Another profiling tool is already active"
+            self.skipped += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.enabled:
+            self.profile.disable()
+            self.enabled = False
+        return False
+
+    def dump(self):
+        self.profile.dump_stats(self.path)
@@ -0,0 +1,179 @@
+# Passive-mode data connections. The server listens on a pool of data ports
+# and the client connects out to one of them, so a transfer needs no
+# connect() from the server back to the client (which fails behind NAT and
+# firewalls and used to block the command loop).
+#
+# A session that sends PASV gets a port from the pool and a random secret.
+# For each transfer the client connects to that port, sends the 24-byte
+# token below and then sends the data command with a Data-Token header
+# holding the nonce; the connect overlaps the command, so passive mode costs
+# no extra round trip. Connections queue on the listeners until a handler
+# needs one; handlers claim their connection by (secret, nonce) and the
+# control connections keep being served meanwhile.
+
+import secrets
+import selectors
+import socket
+import threading
+import time
+from struct import Struct
+
+# Secret of the session, then the nonce named by the command's Data-Token
+SECRET_SIZE = 16
+TOKEN = Struct(f"!{SECRET_SIZE}sQ")
+
+# Seconds a handler waits for its data connection, and a new connection
+# gets to send its token
+CONNECT_TIMEOUT = 10.0
+
+POLL_INTERVAL = 0.5
+
+
+def parse_port_range(text):
+    # "0" (one ephemeral port), "50000" or "50000-50009"
+    first, _, last = text.partition("-")
+    return list(range(int(first), int(last or first) + 1))
+
+
+class PassiveListener:
+    def __init__(self, ports, host=''):
+        self.listeners = []
+        self.selector = selectors.DefaultSelector()
+        for port in ports:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host, port))
+            listener.listen(128)
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ)
+            self.listeners.append(listener)
+        self.ports = [listener.getsockname()[1] for listener in self.listeners]
+        self.next_port = 0
+        self.condition = threading.Condition()
+        self.sessions = {}  # secret -> {nonce: socket, or None once used}
+        self.partial = {}  # connection -> (token buffer, bytes received, deadline)
+        self.accepting = False  # A handler is running poll()
+
+    def poll(self, timeout):
+        # Accepts waiting connections and reads their tokens. Only one thread
+        # runs this at a time: whichever handler is waiting for its data
+        # connection accepts on behalf of all of them, so a connection that
+        # is already queued (the usual case, since clients connect before
+        # sending the command) is picked up without a thread handoff or a
+        # select() call.
+        ready = [listener for listener in self.listeners if self.accept(listener)]
+        if not ready:
+            for key, events in self.selector.select(timeout):
+                if key.fileobj in self.listeners:
+                    self.accept(key.fileobj)
+                elif self.read_token(key.fileobj):
+                    self.selector.unregister(key.fileobj)
+        now = time.monotonic()
+        for connection, (token, received, deadline) in list(self.partial.items()):
+            if now > deadline:
+                self.selector.unregister(connection)
+                del self.partial[connection]
+                connection.close()
+
+    def accept(self, listener):
+        # Takes one queued connection, if any, and reads its token
+        try:
+            connection, addr = listener.accept()
+        except OSError:
+            return False  # Nothing queued
+        connection.setblocking(False)
+        self.partial[connection] = (bytearray(TOKEN.size), 0, time.monotonic() + CONNECT_TIMEOUT)
+        if not self.read_token(connection):
+            self.selector.register(connection, selectors.EVENT_READ)
+        return True
+
+    def read_token(self, connection):
+        # Reads what has arrived of the token; returns True once the
+        # connection is done with (matched to its session or closed)
+        token, received, deadline = self.partial[connection]
+        try:
+            count = connection.recv_into(memoryview(token)[received:])
+        except BlockingIOError:
+            return False
+        except OSError:
+            count = 0
+        if not count:
+            del self.partial[connection]
+            connection.close()
+            return True
+        received += count
+        if received < TOKEN.size:
+            self.partial[connection] = (token, received, deadline)
+            return False
+        del self.partial[connection]
+        connection.setblocking(True)
+        secret, nonce = TOKEN.unpack(token)
+        with self.condition:
+            pending = self.sessions.get(secret)
+            if pending is None or nonce in pending:
+                connection.close()  # Unknown session or a replayed nonce
+                return True
+            pending[nonce] = connection
+            self.condition.notify_all()
+        return True
+
+    def register(self):
+        # Returns (port, secret) for a session entering passive mode
+        secret = secrets.token_bytes(SECRET_SIZE)
+        with self.condition:
+            self.sessions[secret] = {}
+            port = self.ports[self.next_port % len(self.ports)]
+            self.next_port += 1
+        return port, secret
+
+    def unregister(self, secret):
+        with self.condition:
+            pending = self.sessions.pop(secret, {})
+        for connection in pending.values():
+            if connection is not None:
+                connection.close()
+
+    def take(self, secret, nonce, timeout=CONNECT_TIMEOUT):
+        # Waits for the session's connection carrying nonce; None on timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.condition:
+                pending = self.sessions.get(secret)
+                if pending is None:
+                    return None
+                if nonce in pending:
+                    connection = pending[nonce]  # None if already used
+                    pending[nonce] = None
+                    return connection
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if self.accepting:
+                    self.condition.wait(remaining)
+                    continue
+                self.accepting = True
+            try:
+                self.poll(min(remaining, POLL_INTERVAL))
+            finally:
+                with self.condition:
+                    self.accepting = False
+                    self.condition.notify_all()
+
+    def release(self, secret, nonce):
+        # Gives up on a nonce whose command ended without a transfer; a
+        # connection arriving for it later is refused
+        with self.condition:
+            pending = self.sessions.get(secret)
+            if pending is None:
+                return
+            connection = pending.get(nonce)
+            pending[nonce] = None
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        for connection in self.partial:
+            connection.close()
+        for listener in self.listeners:
+            listener.close()
+        self.selector.close()
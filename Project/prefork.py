@@ -0,0 +1,194 @@
+# Multi-process server mode (FTPServer.py --processes N). One Python process
+# tops out at one core once transfers hash, compress or compute deltas, so
+# a supervisor forks N workers that each run the ordinary server. Every
+# worker binds its own listener on the control port with SO_REUSEPORT and
+# the kernel spreads new connections across them; a session, its passive
+# data port and its multiplexed channel all live in the worker that
+# accepted it.
+#
+# The supervisor only watches: it restarts a worker that exits while the
+# server is running (a crash, or a SIGTERM sent to that worker alone to
+# recycle it after it drains) and on SIGINT/SIGTERM tells every worker to
+# drain and waits for them.
+#
+# Workers share their metrics through a directory of JSON files: each one
+# writes Metrics.export() to worker-<n>.json every PUBLISH_INTERVAL seconds,
+# and STATS on any worker merges all of them. When a worker exits the
+# supervisor folds its counters and histograms into retired.json, so totals
+# survive restarts; gauges (active sessions, cache contents) go with it.
+
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from checkpoint import load_checkpoint, save_checkpoint
+from metrics import Metrics, format_snapshot, merge_exports
+
+PUBLISH_INTERVAL = 1.0
+
+# A worker that dies sooner than this after starting is restarted only after
+# the same delay, so one that cannot start does not spin
+MIN_WORKER_SECONDS = 1.0
+
+RETIRED = "retired"
+SUPERVISOR = "supervisor"
+
+
+def default_processes():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+
+def reserve_port(port, host=''):
+    # Binds (without listening) a SO_REUSEPORT socket to port, resolving 0 to
+    # a free port. Held by the supervisor, it keeps the port ours while every
+    # worker is down; only listening sockets are given connections.
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise OSError("Multi-process mode needs SO_REUSEPORT, which this platform lacks")
+    reserved = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reserved.bind((host, port))
+    return reserved
+
+
+class SharedStats:
+    # One process's view of the stats directory
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.json")
+
+    def publish(self, metrics):
+        save_checkpoint(self.path(self.name), metrics.export())
+
+    def start(self, metrics, interval=PUBLISH_INTERVAL):
+        # Publishes metrics every interval seconds for as long as the process runs
+        def publish_forever():
+            while True:
+                self.publish(metrics)
+                time.sleep(interval)
+
+        threading.Thread(target=publish_forever, name="stats-publisher", daemon=True).start()
+
+    def collect(self):
+        states = []
+        for entry in sorted(os.listdir(self.directory)):
+            if entry.endswith(".json"):
+                state = load_checkpoint(os.path.join(self.directory, entry))
+                if state is not None:
+                    states.append(state)
+        return merge_exports(states)
+
+    def snapshot(self, metrics):
+        # STATS for the whole server; this process's own numbers are current,
+        # the other workers' at most PUBLISH_INTERVAL old
+        self.publish(metrics)
+        return format_snapshot(self.collect())
+
+    def retire(self, name):
+        # Moves the counters and histograms of an exited process into RETIRED
+        state = load_checkpoint(self.path(name))
+        if state is None:
+            return
+        state["gauges"] = {}
+        retired = load_checkpoint(self.path(RETIRED))
+        save_checkpoint(self.path(RETIRED), merge_exports([state] + ([retired] if retired else [])))
+        os.remove(self.path(name))
+
+
+class Supervisor:
+    def __init__(self, processes, port, run_worker, host=''):
+        # run_worker(index, port, stats) runs one worker in a forked child
+        # and returns when it has shut down
+        self.processes = processes
+        self.run_worker = run_worker
+        self.reserved = reserve_port(port, host)
+        self.port = self.reserved.getsockname()[1]
+        self.stats_directory = tempfile.mkdtemp(prefix="ftp-stats-")
+        self.stats = SharedStats(self.stats_directory, SUPERVISOR)
+        self.metrics = Metrics()
+        self.workers = {}  # pid -> (index, started)
+        self.stopping = False
+
+    def spawn(self, index):
+        sys.stdout.flush()  # Or the child prints our buffered output again
+        pid = os.fork()
+        if pid == 0:
+            self.run_child(index)
+        self.workers[pid] = (index, time.monotonic())
+        self.metrics.adjust("processes.workers", 1)
+        print(f"Started worker {index} (pid {pid})")
+
+    def run_child(self, index):
+        # Never returns: the child leaves with os._exit once its server stops
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.workers = {}
+        self.reserved.close()
+        code = 0
+        try:
+            self.run_worker(index, self.port, SharedStats(self.stats_directory, f"worker-{index}"))
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def signal_workers(self, signum):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def shutdown(self, signum=None, frame=None):
+        if not self.stopping:
+            print("Shutdown requested, stopping workers.")
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    def serve_forever(self):
+        print(f"Supervisor starting {self.processes} workers on port {self.port}")
+        signal.signal(signal.SIGINT, self.shutdown)
+        signal.signal(signal.SIGTERM, self.shutdown)
+        try:
+            for index in range(self.processes):
+                self.spawn(index)
+            while self.workers:
+                self.stats.publish(self.metrics)
+                pid, status = os.wait()
+                index, started = self.workers.pop(pid)
+                self.metrics.adjust("processes.workers", -1)
+                self.stats.retire(f"worker-{index}")
+                code = os.waitstatus_to_exitcode(status)
+                if self.stopping:
+                    print(f"Worker {index} (pid {pid}) stopped.")
+                    continue
+                print(f"Worker {index} (pid {pid}) exited with status {code}; restarting it.")
+                self.metrics.increment("processes.restarts")
+                if time.monotonic() - started < MIN_WORKER_SECONDS:
+                    time.sleep(MIN_WORKER_SECONDS)
+                if not self.stopping:
+                    self.spawn(index)
+        finally:
+            self.stopping = True
+            self.signal_workers(signal.SIGTERM)
+            self.reserved.close()
+            self.report()
+            shutil.rmtree(self.stats_directory, ignore_errors=True)
+            print("Supervisor has been shut down.")
+
+    def report(self):
+        totals = self.stats.collect()["counters"]
+        print(f"Served {totals.get('sessions.total', 0)} sessions, "
+              f"{totals.get('processes.restarts', 0)} worker restarts.")
@@ -0,0 +1,179 @@
+# Bandwidth shaping for data channels. A TransferScheduler owns an optional
+# global token bucket; every transfer gets a PacedChannel wrapping its data
+# channel that asks for tokens one QUANTUM at a time, from its session's own
+# bucket first and then from the global one.
+#
+# Waiters on the global bucket are granted in order of priority class and
+# then round robin: a stream that got its quantum goes to the back of its
+# class queue, so concurrent streams share the rate equally instead of the
+# first large GET taking all of it. Every stream starts out INTERACTIVE and
+# drops to BULK once it has moved SMALL_TRANSFER_SIZE bytes, so listings and
+# small files overtake bulk transfers without the handlers having to say
+# which is which.
+
+import collections
+import os
+import threading
+import time
+
+QUANTUM = 64 * 1024
+SMALL_TRANSFER_SIZE = 1024 * 1024
+
+# Buckets hold at most this many seconds worth of tokens, so an idle period
+# does not turn into an unlimited burst
+BURST_SECONDS = 0.1
+
+INTERACTIVE = 0
+BULK = 1
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    # Bytes from "64K", "10M", "1G" or a plain number
+    text = text.strip().upper()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def parse_rate(text):
+    # Bytes per second, as parse_size with an optional "/s"
+    return parse_size(text.strip().upper().removesuffix("/S"))
+
+
+class TokenBucket:
+    # Not locked; the scheduler serializes access to the global bucket and a
+    # session bucket is only used by the session's own transfers
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(QUANTUM, int(rate * BURST_SECONDS))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def delay(self):
+        # Seconds until the bucket is out of debt
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens > 0 else -self.tokens / self.rate
+
+    def consume(self, count):
+        # May take the bucket below zero; the debt delays the next caller
+        self.tokens -= count
+
+    def throttle(self, count):
+        wait = self.delay()
+        if wait > 0:
+            time.sleep(wait)
+            self.delay()
+        self.consume(count)
+
+
+class TransferScheduler:
+    def __init__(self, rate=0, session_rate=0):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.session_rate = session_rate
+        self.condition = threading.Condition()
+        self.queues = {INTERACTIVE: collections.deque(), BULK: collections.deque()}
+
+    def session_bucket(self):
+        # A fresh per-session bucket, or None without a per-session limit
+        return TokenBucket(self.session_rate) if self.session_rate else None
+
+    def pace(self, channel, session_bucket=None):
+        if self.bucket is None and session_bucket is None:
+            return channel
+        return PacedChannel(channel, self, session_bucket)
+
+    def head(self):
+        for priority in (INTERACTIVE, BULK):
+            if self.queues[priority]:
+                return self.queues[priority][0]
+        return None
+
+    def grant(self, priority, count):
+        # Blocks until it is this request's turn and the global bucket has
+        # tokens, then charges count bytes to it
+        ticket = object()
+        with self.condition:
+            queue = self.queues[priority]
+            queue.append(ticket)
+            self.condition.notify_all()  # A new head may have to go first
+            try:
+                while True:
+                    if self.head() is ticket:
+                        wait = self.bucket.delay()
+                        if wait <= 0:
+                            break
+                        self.condition.wait(wait)
+                    else:
+                        self.condition.wait()
+                self.bucket.consume(count)
+            finally:
+                queue.remove(ticket)
+                self.condition.notify_all()
+
+
+class PacedChannel:
+    # Data channel wrapper that sends and receives at most QUANTUM bytes per
+    # grant; everything else goes to the wrapped channel
+    def __init__(self, channel, scheduler, session_bucket=None):
+        self.channel = channel
+        self.scheduler = scheduler
+        self.session_bucket = session_bucket
+        self.transferred = 0
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def acquire(self, count):
+        if self.session_bucket is not None:
+            self.session_bucket.throttle(count)
+        if self.scheduler.bucket is not None:
+            priority = INTERACTIVE if self.transferred < SMALL_TRANSFER_SIZE else BULK
+            self.scheduler.grant(priority, count)
+        self.transferred += count
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), QUANTUM):
+            chunk = view[start:start + QUANTUM]
+            self.acquire(len(chunk))
+            self.channel.sendall(chunk)
+
+    def sendfile(self, file, offset=0, count=None):
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        sent = 0
+        while sent < count:
+            size = min(QUANTUM, count - sent)
+            self.acquire(size)
+            written = self.channel.sendfile(file, offset + sent, size)
+            if not written:
+                break
+            sent += written
+        return sent
+
+    def recv_into(self, view):
+        # Reads first and pays afterwards; holding back the next read is
+        # what slows the sender down through TCP flow control
+        count = self.channel.recv_into(view[:QUANTUM])
+        if count:
+            self.acquire(count)
+        return count
+
+    def recv(self, size):
+        data = bytearray(min(size, QUANTUM))
+        return bytes(data[:self.recv_into(memoryview(data))])
+
+    def read_exact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = self.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Connection closed in the middle of a frame")
+            received += count
+        return data
@@ -0,0 +1,347 @@
+import asyncio
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Connection engines for FTPServer.py. Both engines drive the same three
+# per-session callbacks supplied by the server:
+#   open_session(connection, addr) -> session
+#   handle_command(session) -> False once the session is over
+#   close_session(session)
+# plus an optional has_buffered_input(session) telling the engine that a
+# pipelined command is already sitting in the session's read buffer.
+# With idle_timeout set, a session that sends no command for that many
+# seconds is reaped: reap_session(session) tells the client why, then the
+# session is closed as usual and its worker (thread mode) or slot is freed.
+# "thread" mode parks one pool worker on every live session, so it accepts
+# at most one connection per worker and turns the rest away with "FAILURE
+# 421" instead of queueing them behind sessions that may never end; "asyncio"
+# mode keeps idle sessions on the event loop and only borrows a worker while
+# a command is being handled, so idle control connections cost no thread.
+
+DEFAULT_WORKERS = 256
+DEFAULT_MAX_CONNECTIONS = 1024
+DEFAULT_DRAIN_TIMEOUT = 30.0
+LISTEN_BACKLOG = 128
+
+# How often blocked accept/select calls wake up to notice a shutdown request
+POLL_INTERVAL = 0.5
+
+
+def create_listener(port, host='', reuse_port=False):
+    # reuse_port lets several processes listen on the same port, each with
+    # its own accept queue (see prefork.py)
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(LISTEN_BACKLOG)
+    return server_socket
+
+
+def reject_connection(connection, addr):
+    print(f"Rejecting connection from {addr}: too many connections")
+    try:
+        connection.sendall("FAILURE 421 Too many connections\n".encode())
+    except OSError:
+        pass
+    connection.close()
+
+
+class SessionTracker:
+    # Bookkeeping for live control connections: enforces the connection cap,
+    # remembers which sessions are mid-command and lets shutdown wait for
+    # (or force) the remaining sessions to finish.
+
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.condition = threading.Condition()
+        self.connections = {}  # connection -> busy flag
+
+    def __len__(self):
+        with self.condition:
+            return len(self.connections)
+
+    def add(self, connection):
+        with self.condition:
+            if len(self.connections) >= self.max_connections:
+                return False
+            self.connections[connection] = False
+            return True
+
+    def set_busy(self, connection, busy):
+        with self.condition:
+            if connection in self.connections:
+                self.connections[connection] = busy
+
+    def remove(self, connection):
+        with self.condition:
+            self.connections.pop(connection, None)
+            self.condition.notify_all()
+
+    def wait_empty(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.connections, timeout)
+
+    def close_all(self, idle_only=False):
+        with self.condition:
+            targets = [conn for conn, busy in self.connections.items()
+                       if not (idle_only and busy)]
+        for connection in targets:
+            try:
+                # Unblocks any worker still sitting in recv() on this socket
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class ThreadPoolServer:
+    mode = "thread"
+
+    def __init__(self, open_session, handle_command, close_session, port,
+                 host='', workers=DEFAULT_WORKERS, max_connections=None,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT, has_buffered_input=None,
+                 reuse_port=False, idle_timeout=None, reap_session=None):
+        self.open_session = open_session
+        self.handle_command = handle_command
+        self.close_session = close_session
+        self.has_buffered_input = has_buffered_input or (lambda session: False)
+        self.idle_timeout = idle_timeout
+        self.reap_session = reap_session or (lambda session: None)
+        self.port = port
+        self.host = host
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.reuse_port = reuse_port
+        # A connection past the worker count would wait in the executor's
+        # queue, unanswered, until some other session ended
+        if max_connections is None or max_connections > workers:
+            max_connections = workers
+        self.tracker = SessionTracker(max_connections)
+        self.stopping = threading.Event()
+        self.listener = None
+
+    def serve_forever(self):
+        self.listener = create_listener(self.port, self.host, self.reuse_port)
+        self.listener.settimeout(POLL_INTERVAL)
+        self.port = self.listener.getsockname()[1]
+        print(f"Server is ready to receive connections on port {self.port} "
+              f"({self.mode} mode, {self.workers} workers, "
+              f"max {self.tracker.max_connections} connections)...")
+
+        executor = ThreadPoolExecutor(max_workers=self.workers,
+                                      thread_name_prefix="ftp-session")
+        try:
+            while not self.stopping.is_set():
+                try:
+                    connection, addr = self.listener.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    if self.stopping.is_set():
+                        break
+                    raise
+                connection.setblocking(True)
+                if not self.tracker.add(connection):
+                    reject_connection(connection, addr)
+                    continue
+                executor.submit(self.run_session, connection, addr)
+        finally:
+            self.listener.close()
+            self.drain()
+            executor.shutdown(wait=True)
+            print("Server has been shut down.")
+
+    def run_session(self, connection, addr):
+        session = None
+        try:
+            session = self.open_session(connection, addr)
+            while self.wait_for_command(session, connection):
+                self.tracker.set_busy(connection, True)
+                try:
+                    if not self.handle_command(session):
+                        break
+                finally:
+                    self.tracker.set_busy(connection, False)
+        except Exception as e:
+            print(f"Session with {addr} failed: {e}")
+        finally:
+            if session is not None:
+                self.close_session(session)
+            else:
+                connection.close()
+            self.tracker.remove(connection)
+
+    def wait_for_command(self, session, connection):
+        # Block until the client sends something, waking periodically so an
+        # idle session notices a shutdown request or its idle timeout
+        # instead of pinning a worker
+        if self.has_buffered_input(session):
+            return not self.stopping.is_set()
+        deadline = time.monotonic() + self.idle_timeout if self.idle_timeout else None
+        with selectors.DefaultSelector() as selector:
+            selector.register(connection, selectors.EVENT_READ)
+            while not self.stopping.is_set():
+                timeout = POLL_INTERVAL
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.monotonic())
+                    if timeout <= 0:
+                        self.reap_session(session)
+                        return False
+                if selector.select(timeout):
+                    return True
+        return False
+
+    def shutdown(self):
+        self.stopping.set()
+
+    def drain(self):
+        active = len(self.tracker)
+        if active == 0:
+            return
+        print(f"Draining {active} active session(s)...")
+        # Idle sessions leave on their own once stopping is set; busy ones get
+        # drain_timeout seconds to finish their current command
+        if not self.tracker.wait_empty(self.drain_timeout):
+            print("Drain timeout reached, closing remaining sessions.")
+            self.tracker.close_all()
+            self.tracker.wait_empty(self.drain_timeout)
+
+
+class AsyncioServer:
+    mode = "asyncio"
+
+    def __init__(self, open_session, handle_command, close_session, port,
+                 host='', workers=DEFAULT_WORKERS, max_connections=None,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT, has_buffered_input=None,
+                 reuse_port=False, idle_timeout=None, reap_session=None):
+        self.open_session = open_session
+        self.handle_command = handle_command
+        self.close_session = close_session
+        self.has_buffered_input = has_buffered_input or (lambda session: False)
+        self.idle_timeout = idle_timeout
+        self.reap_session = reap_session or (lambda session: None)
+        self.port = port
+        self.host = host
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.reuse_port = reuse_port
+        self.tracker = SessionTracker(max_connections or DEFAULT_MAX_CONNECTIONS)
+        self.loop = None
+        self.stopping = None
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        listener = create_listener(self.port, self.host, self.reuse_port)
+        listener.setblocking(False)
+        self.port = listener.getsockname()[1]
+        print(f"Server is ready to receive connections on port {self.port} "
+              f"({self.mode} mode, {self.workers} workers, "
+              f"max {self.tracker.max_connections} connections)...")
+
+        executor = ThreadPoolExecutor(max_workers=self.workers,
+                                      thread_name_prefix="ftp-command")
+        sessions = set()
+        stop_task = asyncio.ensure_future(self.stopping.wait())
+        try:
+            while not self.stopping.is_set():
+                accept_task = asyncio.ensure_future(self.loop.sock_accept(listener))
+                await asyncio.wait({accept_task, stop_task},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not accept_task.done():
+                    accept_task.cancel()
+                    break
+                connection, addr = accept_task.result()
+                connection.setblocking(True)
+                if not self.tracker.add(connection):
+                    reject_connection(connection, addr)
+                    continue
+                task = asyncio.ensure_future(
+                    self.run_session(executor, connection, addr))
+                sessions.add(task)
+                task.add_done_callback(sessions.discard)
+        finally:
+            listener.close()
+            stop_task.cancel()
+            await self.drain(sessions)
+            executor.shutdown(wait=True)
+            print("Server has been shut down.")
+
+    async def run_session(self, executor, connection, addr):
+        session = None
+        try:
+            session = await self.loop.run_in_executor(
+                executor, self.open_session, connection, addr)
+            while await self.wait_for_command(executor, session, connection):
+                self.tracker.set_busy(connection, True)
+                try:
+                    keep_going = await self.loop.run_in_executor(
+                        executor, self.handle_command, session)
+                finally:
+                    self.tracker.set_busy(connection, False)
+                if not keep_going:
+                    break
+        except Exception as e:
+            print(f"Session with {addr} failed: {e}")
+        finally:
+            if session is not None:
+                await self.loop.run_in_executor(
+                    executor, self.close_session, session)
+            else:
+                connection.close()
+            self.tracker.remove(connection)
+
+    async def wait_for_command(self, executor, session, connection):
+        # Park the idle session on the event loop until it becomes readable,
+        # stays idle past the idle timeout or the server starts shutting down
+        if self.has_buffered_input(session):
+            return not self.stopping.is_set()
+        readable = self.loop.create_future()
+        fd = connection.fileno()
+        self.loop.add_reader(fd, lambda: readable.done() or readable.set_result(True))
+        stop_task = asyncio.ensure_future(self.stopping.wait())
+        try:
+            await asyncio.wait({readable, stop_task}, timeout=self.idle_timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.loop.remove_reader(fd)
+            stop_task.cancel()
+        if not readable.done() and not self.stopping.is_set():
+            # Telling the client may block on a full send buffer, so it
+            # happens off the event loop
+            await self.loop.run_in_executor(executor, self.reap_session, session)
+        return readable.done() and not self.stopping.is_set()
+
+    def shutdown(self):
+        # Safe to call from signal handlers and other threads
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def drain(self, sessions):
+        if not sessions:
+            return
+        print(f"Draining {len(sessions)} active session(s)...")
+        done, pending = await asyncio.wait(sessions, timeout=self.drain_timeout)
+        if pending:
+            print("Drain timeout reached, closing remaining sessions.")
+            self.tracker.close_all()
+            await asyncio.wait(pending, timeout=self.drain_timeout)
+
+
+ENGINES = {
+    "thread": ThreadPoolServer,
+    "asyncio": AsyncioServer,
+}
+
+
+def create_server(mode, *args, **kwargs):
+    if mode not in ENGINES:
+        raise ValueError(f"Unknown server mode: {mode}")
+    return ENGINES[mode](*args, **kwargs)
@@ -0,0 +1,95 @@
+# Timeouts and TCP options for control and data connections, shared by
+# FTPServer.py and FTPClient.py.
+#
+# Control connections get TCP_NODELAY (status lines are small and often
+# written back to back) and TCP keepalive, so a peer that disappeared
+# without a FIN or RST (a crashed host, a dropped NAT mapping) is noticed
+# after keepalive + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT seconds instead of
+# holding its session forever. Every control read and write gives up after
+# control_timeout seconds; the server only reads the control channel once a
+# command has started arriving (see server_engine.py), so this bounds how
+# long a half-sent command can stall a worker, not how long a client may
+# think.
+#
+# Data connections of a single transfer get data_timeout for connecting,
+# accepting and every send and receive, so a stalled peer, or one that never
+# connects back to its Data-Port, costs a handler at most that long. A
+# persistent multiplexed channel sits idle between transfers, so it gets
+# keepalive instead and is closed together with its session.
+#
+# sndbuf and rcvbuf set SO_SNDBUF/SO_RCVBUF on data connections. 0 (the
+# default) keeps Linux's buffer autotuning, which is usually best; a fixed
+# size turns autotuning off for that socket and is for links whose
+# bandwidth-delay product autotuning does not reach. Sizes are set before
+# connect() and on listening sockets, whose accepted connections inherit
+# them, so the TCP window scale is negotiated for them.
+#
+# Sessions that send no command for idle_timeout seconds are closed by the
+# connection engine (see server_engine.py).
+
+import socket
+
+DEFAULT_CONTROL_TIMEOUT = 60.0
+DEFAULT_DATA_TIMEOUT = 60.0
+DEFAULT_IDLE_TIMEOUT = 300.0
+
+# Seconds a connection is idle before the first keepalive probe, then the
+# seconds between probes and how many go unanswered before the kernel drops
+# the connection
+DEFAULT_KEEPALIVE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 6
+
+
+def optional_timeout(seconds):
+    # Command line timeouts use 0 for "never"
+    return seconds if seconds and seconds > 0 else None
+
+
+def set_keepalive(sock, idle=DEFAULT_KEEPALIVE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Probe timing can only be tuned where the platform has the options;
+    # elsewhere the system default (usually two hours) applies
+    for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval),
+                          ("TCP_KEEPCNT", count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class SocketOptions:
+    def __init__(self, control_timeout=DEFAULT_CONTROL_TIMEOUT, data_timeout=DEFAULT_DATA_TIMEOUT,
+                 keepalive=DEFAULT_KEEPALIVE, sndbuf=0, rcvbuf=0):
+        self.control_timeout = optional_timeout(control_timeout)
+        self.data_timeout = optional_timeout(data_timeout)
+        self.keepalive = keepalive  # Seconds before probing, 0 for no keepalive
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+
+    def tune_control(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            set_keepalive(sock, self.keepalive)
+        sock.settimeout(self.control_timeout)
+
+    def set_buffers(self, sock):
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def data_socket(self):
+        # A new socket for connecting or listening for one transfer
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_buffers(sock)
+        sock.settimeout(self.data_timeout)
+        return sock
+
+    def tune_data(self, sock):
+        # An accepted data connection; accept() does not pass on a timeout
+        sock.settimeout(self.data_timeout)
+
+    def tune_channel(self, sock):
+        # A data connection that becomes a persistent multiplexed channel
+        sock.settimeout(None)
+        if self.keepalive:
+            set_keepalive(sock, self.keepalive)
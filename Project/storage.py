@@ -0,0 +1,287 @@
+# Plain-file storage behind GET, PUT, SYNC, SIZE, REST and LS. All of them
+# work on one flat namespace of files under the storage root (uploads/ by
+# default); GET and SIZE used to read from the server's working directory
+# while everything else used uploads/.
+#
+# A name is a single path component. Names with a "/", "..", a NUL or a
+# leading "." (reserved for .partial/, .store/ and .trees/) are refused, so
+# no request reaches outside the root.
+#
+# Directory trees sent with PUTDIR (see tree_transfer.py) are a separate
+# namespace under .trees/, named like files. A tree is extracted into the
+# partial directory and swapped into place whole once it is complete, so
+# GETDIR never sees half of an upload.
+#
+# Layouts: "flat" keeps root/<name>; "sharded" keeps root/<xx>/<name>, where
+# xx is the first byte of the name's SHA-1 in hex, so a directory holding
+# millions of uploads is 256 directories of a few thousand entries, which
+# keeps lookups, renames and rescans fast on any filesystem. Switching an
+# existing root between layouts moves its files on startup (relayout()).
+#
+# I/O:
+#   - Reads: hashed sends of files of at least MMAP_MIN_SIZE go through a
+#     read-only mmap (map_file()), so the digest and the socket read the
+#     page cache directly instead of a copy of it; plain sends keep using
+#     sendfile(). Stored files are only ever replaced by a rename, never
+#     truncated in place, so a mapping cannot lose pages under a reader
+#     (which would be SIGBUS). With fadvise, files that size are opened with
+#     POSIX_FADV_SEQUENTIAL, doubling the kernel's readahead window.
+#   - Writes: preallocate() reserves the whole upload with posix_fallocate
+#     once Content-Length is known, so the file is laid out contiguously and
+#     a full disk is reported before any data is received.
+#   - Durability: with fsync "always" an upload is flushed to disk, renamed
+#     into place and its directory flushed before the server reports
+#     success. "batch" gives the same guarantee but concurrent uploads share
+#     their directory flushes (see DirectorySyncer). "off" leaves writeback
+#     to the kernel, as before.
+
+import errno
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+
+LAYOUTS = ["flat", "sharded"]
+FSYNC_MODES = ["off", "always", "batch"]
+
+MMAP_MIN_SIZE = 1024 * 1024
+PARTIAL_DIRECTORY = ".partial"
+TREE_DIRECTORY = ".trees"
+
+
+def valid_name(name):
+    return bool(name) and not name.startswith(".") and "/" not in name and "\0" not in name
+
+
+def shard_of(name):
+    return hashlib.sha1(name.encode()).hexdigest()[:2]
+
+
+def is_shard(name):
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+
+def sync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DirectorySyncer:
+    # Group commit for directory fsyncs. A caller that needs its rename to
+    # be durable waits for a flush that started after the rename; whoever
+    # finds no flush running does one for every directory queued so far, so
+    # N uploads finishing together cost one fsync per directory instead of N.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = set()
+        self.started = 0  # Flushes begun
+        self.completed = 0  # Flushes finished
+        self.flushing = False
+        self.failure = (0, None)  # (flush number, error) of the last failed flush
+        self.flushes = 0
+        self.requests = 0
+
+    def sync(self, directory):
+        with self.condition:
+            self.pending.add(directory)
+            self.requests += 1
+            needed = self.started + 1
+            while self.completed < needed:
+                if self.flushing:
+                    self.condition.wait()
+                    continue
+                self.flushing = True
+                self.started += 1
+                batch, self.pending = self.pending, set()
+                self.condition.release()
+                error = None
+                try:
+                    for queued in batch:
+                        sync_directory(queued)
+                except OSError as e:
+                    error = e
+                finally:
+                    self.condition.acquire()
+                    self.flushing = False
+                    self.completed = self.started
+                    self.flushes += 1
+                    if error is not None:
+                        self.failure = (self.started, error)
+                    self.condition.notify_all()
+            if self.failure[0] >= needed and self.failure[1] is not None:
+                raise self.failure[1]
+
+
+class FileStorage:
+    def __init__(self, root, layout="flat", fsync="off", fadvise=False):
+        self.root = root
+        self.layout = layout
+        self.fsync = fsync
+        self.fadvise = fadvise and hasattr(os, "posix_fadvise")
+        self.partial_directory = os.path.join(root, PARTIAL_DIRECTORY)
+        self.tree_directory = os.path.join(root, TREE_DIRECTORY)
+        self.syncer = DirectorySyncer()
+        self.can_preallocate = hasattr(os, "posix_fallocate")
+        self.lock = threading.Lock()
+        self.tree_lock = threading.Lock()
+        self.counters = {"preallocated_bytes": 0, "mapped_sends": 0, "fsyncs": 0}
+        os.makedirs(self.partial_directory, exist_ok=True)
+        os.makedirs(self.tree_directory, exist_ok=True)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self.lock:
+            values = dict(self.counters)
+        values["directory_syncs"] = self.syncer.requests
+        values["directory_flushes"] = self.syncer.flushes
+        return values
+
+    # Layout
+
+    def directory_of(self, name):
+        return os.path.join(self.root, shard_of(name)) if self.layout == "sharded" else self.root
+
+    def path(self, name):
+        # Where name is stored, or None for a name the storage refuses
+        if not valid_name(name):
+            return None
+        return os.path.join(self.directory_of(name), name)
+
+    def directories(self):
+        # Every directory holding stored files, for the directory index
+        if self.layout == "sharded":
+            return [os.path.join(self.root, f"{shard:02x}") for shard in range(256)]
+        return [self.root]
+
+    def relayout(self):
+        # Puts the root into this layout before the server starts: creates
+        # the shard directories and moves files stored under the other
+        # layout to where this one keeps them. Files go through a scratch
+        # directory first, since one may have the name of a shard directory.
+        # Returns how many files moved.
+        moving = []
+        with os.scandir(self.root) as scanner:
+            for entry in scanner:
+                if self.layout == "sharded" and entry.is_file() and valid_name(entry.name):
+                    moving.append(entry)
+                elif self.layout == "flat" and entry.is_dir() and is_shard(entry.name):
+                    with os.scandir(entry.path) as shard:
+                        moving.extend(stored for stored in shard
+                                      if stored.is_file() and valid_name(stored.name))
+        scratch = os.path.join(self.root, ".relayout")
+        os.makedirs(scratch, exist_ok=True)
+        for entry in moving:
+            os.replace(entry.path, os.path.join(scratch, entry.name))
+        for directory in self.directories():
+            os.makedirs(directory, exist_ok=True)
+        if self.layout == "flat":
+            for name in os.listdir(self.root):
+                if is_shard(name) and os.path.isdir(os.path.join(self.root, name)):
+                    try:
+                        os.rmdir(os.path.join(self.root, name))
+                    except OSError:
+                        pass  # Holds something other than stored files
+        for entry in moving:
+            os.replace(os.path.join(scratch, entry.name), self.path(entry.name))
+        os.rmdir(scratch)
+        return len(moving)
+
+    # Reads
+
+    def open(self, path, size):
+        file = open(path, 'rb')
+        if self.fadvise and size >= MMAP_MIN_SIZE:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return file
+
+    def map_file(self, file, size):
+        # Read-only mapping of an open plain file for hashed sends, or None
+        # when the file is small, not a plain file or cannot be mapped
+        if size < MMAP_MIN_SIZE or not hasattr(file, "fileno"):
+            return None
+        try:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if hasattr(mapping, "madvise"):
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+        self.count("mapped_sends")
+        return mapping
+
+    # Writes
+
+    def preallocate(self, file, offset, length):
+        # Reserves length bytes from offset. Raises OSError(ENOSPC) when they
+        # do not fit; filesystems without fallocate are left alone.
+        if not self.can_preallocate or length <= 0:
+            return
+        try:
+            os.posix_fallocate(file.fileno(), offset, length)
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                self.can_preallocate = False
+                return
+            raise
+        self.count("preallocated_bytes", length)
+
+    def commit(self, path, name):
+        # Moves the complete file at path into place as name, durably when
+        # fsync is on
+        if self.fsync != "off":
+            sync_file(path)
+            self.count("fsyncs")
+        target = self.path(name)
+        os.replace(path, target)
+        if self.fsync == "always":
+            sync_directory(os.path.dirname(target))
+            self.count("fsyncs")
+        elif self.fsync == "batch":
+            self.syncer.sync(os.path.dirname(target))
+
+    def tree_path(self, name):
+        # Where the tree called name is kept, or None for a refused name
+        if not valid_name(name):
+            return None
+        return os.path.join(self.tree_directory, name)
+
+    def commit_tree(self, staging, name):
+        # Replaces the tree called name with the complete tree extracted
+        # into staging (a directory in the partial directory)
+        if self.fsync != "off":
+            for directory, subdirectories, files in os.walk(staging):
+                sync_directory(directory)
+                self.count("fsyncs")
+        target = self.tree_path(name)
+        with self.tree_lock:
+            old = None
+            if os.path.isdir(target):
+                old = staging + ".old"
+                os.rename(target, old)
+            os.rename(staging, target)
+        if self.fsync != "off":
+            sync_directory(self.tree_directory)
+            self.count("fsyncs")
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def remove(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
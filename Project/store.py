@@ -0,0 +1,236 @@
+# Content-addressed storage for uploads. A stored file is cut into fixed-size
+# chunks kept once each under their SHA-256, a manifest (keyed by the SHA-256
+# of the whole file) lists the chunks in order, and names/<filename> holds
+# the digest of the manifest that name currently refers to:
+#
+#   .store/chunks/ab/abcdef...   chunk data
+#   .store/manifests/<digest>    {"size": ..., "chunk_size": ..., "chunks": [...]}
+#   .store/names/<filename>      <digest>
+#
+# Identical files, and identical aligned chunks of different files, take disk
+# space once, and a client that announces the digest of a file the store
+# already has does not need to send it at all.
+#
+# Unreferenced chunks and manifests are not collected.
+
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+
+from transfer import send_file
+
+STORE_CHUNK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+# Content-Digest header value, as in RFC 9530: sha-256=:<base64 digest>:
+DIGEST_ALGORITHM = "sha-256"
+
+
+def format_digest(digest):
+    return f"{DIGEST_ALGORITHM}=:{base64.b64encode(digest).decode()}:"
+
+
+def parse_digest(value):
+    # Returns the hex SHA-256 from a Content-Digest value, or None when the
+    # value does not carry one
+    for item in value.split(","):
+        algorithm, _, encoded = item.strip().partition("=")
+        if algorithm == DIGEST_ALGORITHM and encoded.startswith(":") and encoded.endswith(":"):
+            try:
+                digest = base64.b64decode(encoded[1:-1], validate=True)
+            except ValueError:
+                return None
+            return digest.hex() if len(digest) == hashlib.sha256().digest_size else None
+    return None
+
+
+def file_sha256(path, offset=0):
+    # SHA-256 of a local file read through one reused buffer
+    digest = hashlib.sha256()
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        file.seek(offset)
+        while True:
+            count = file.readinto(view)
+            if not count:
+                break
+            digest.update(view[:count])
+    return digest.digest()
+
+
+def write_atomic(path, data):
+    # Write-then-rename with a name unique to this thread, so readers and
+    # concurrent writers only ever see complete files
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+
+class ContentStore:
+    def __init__(self, root, chunk_size=STORE_CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.chunk_directory = os.path.join(root, "chunks")
+        self.manifest_directory = os.path.join(root, "manifests")
+        self.name_directory = os.path.join(root, "names")
+        for directory in (self.chunk_directory, self.manifest_directory, self.name_directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_directory, digest[:2], digest)
+
+    def manifest_path(self, digest):
+        return os.path.join(self.manifest_directory, digest)
+
+    def name_path(self, name):
+        return os.path.join(self.name_directory, name)
+
+    # Where the directory index finds stored names (see directory_index.py)
+
+    def directories(self):
+        return [self.name_directory]
+
+    def path(self, name):
+        return self.name_path(name)
+
+    def has(self, digest):
+        return os.path.exists(self.manifest_path(digest))
+
+    def resolve(self, name):
+        # Digest the name refers to, or None
+        try:
+            with open(self.name_path(name)) as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def manifest(self, digest):
+        try:
+            with open(self.manifest_path(digest)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def describe(self, name, stat):
+        # (size, mtime_ns) of a stored name for the directory index, given
+        # the stat of its names/ entry
+        if name.endswith(".tmp"):
+            return None
+        digest = self.resolve(name)
+        manifest = self.manifest(digest) if digest else None
+        if manifest is None:
+            return None
+        return manifest["size"], stat.st_mtime_ns
+
+    def link(self, name, digest):
+        # Points name at an already stored file
+        write_atomic(self.name_path(name), digest.encode())
+
+    def store_chunk(self, chunk):
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self.chunk_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, chunk)
+        return digest
+
+    def add(self, path):
+        # Adds the file at path and returns its digest; chunks the store
+        # already holds are not written again. Nothing is ever deleted, so a
+        # file being read while its name is pointed elsewhere stays intact.
+        file_digest = hashlib.sha256()
+        chunks = []
+        size = 0
+        with open(path, 'rb') as file:
+            while True:
+                chunk = file.read(self.chunk_size)
+                if not chunk:
+                    break
+                file_digest.update(chunk)
+                chunks.append(self.store_chunk(chunk))
+                size += len(chunk)
+        digest = file_digest.hexdigest()
+        if not self.has(digest):
+            write_atomic(self.manifest_path(digest),
+                         json.dumps({"size": size, "chunk_size": self.chunk_size,
+                                     "chunks": chunks}).encode())
+        return digest
+
+    def open(self, name):
+        # Returns a read-only file object for name, or None
+        digest = self.resolve(name)
+        manifest = self.manifest(digest) if digest else None
+        if manifest is None:
+            return None
+        return ManifestFile(self, digest, manifest)
+
+
+class ManifestFile(io.RawIOBase):
+    # A stored file read back through its manifest: seekable and readable
+    # like a regular binary file, so hashing, sampling for compression and
+    # encoded sends work on it unchanged
+    def __init__(self, store, digest, manifest):
+        super().__init__()
+        self.store = store
+        self.digest = digest
+        self.size = manifest["size"]
+        self.chunk_size = manifest["chunk_size"]
+        self.chunks = manifest["chunks"]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def segments(self, offset, count):
+        # Yields (chunk path, offset within the chunk, byte count) covering
+        # count bytes from offset
+        end = min(self.size, offset + count)
+        while offset < end:
+            index, start = divmod(offset, self.chunk_size)
+            length = min(self.chunk_size - start, end - offset)
+            yield self.store.chunk_path(self.chunks[index]), start, length
+            offset += length
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        for path, start, length in self.segments(self.position, len(view)):
+            with open(path, 'rb', buffering=0) as chunk:
+                chunk.seek(start)
+                while length:
+                    count = chunk.readinto(view[filled:filled + length])
+                    if not count:
+                        raise OSError(f"Stored chunk {path} is truncated")
+                    filled += count
+                    length -= count
+        self.position += filled
+        return filled
+
+    def send_range(self, sock, offset=0, count=None):
+        # send_file over the chunk files, so stored files keep zero-copy sends
+        if count is None:
+            count = self.size - offset
+        sent = 0
+        for path, start, length in self.segments(offset, count):
+            with open(path, 'rb') as chunk:
+                sent += send_file(sock, chunk, start, length)
+        return sent
@@ -0,0 +1,61 @@
+# A GET resumed with an If-Range that no longer matches restarts from byte
+# 0; it must still honour the rest of the request, i.e. come back encoded
+# and with the Content-Digest trailer the client asked for.
+#
+# usage: python3 -m unittest discover -s tests   (or python3 -m pytest tests)
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from FTPClient import close_session, connect_session, open_data_channel, receive_body
+from local_server import start_server, stop_server
+from store import DIGEST_ALGORITHM
+
+CONTENT = b"the same line, over and over\n" * 20000
+
+
+class RestartedGetTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        uploads = os.path.join(self.directory.name, "uploads")
+        os.makedirs(uploads)
+        with open(os.path.join(uploads, "file.txt"), 'wb') as file:
+            file.write(CONTENT)
+        self.server, self.port = start_server(self.directory.name, [])
+
+    def tearDown(self):
+        stop_server(self.server)
+        self.directory.cleanup()
+
+    def test_stale_if_range_keeps_digest_and_encoding(self):
+        session = connect_session("127.0.0.1", self.port, verbose=False)
+        try:
+            response, data = open_data_channel(session, "GET file.txt", headers={
+                "Offset": "1000", "Length": "500", "If-Range": "stale-etag",
+                "Accept-Encoding": "zlib", "Want-Content-Digest": DIGEST_ALGORITHM,
+            }, verbose=False)
+            self.assertIsNotNone(data, response)
+            try:
+                data_headers = data.read_headers()
+                self.assertEqual(data_headers.get("Offset"), "0")
+                self.assertEqual(data_headers.get("Content-Length"), str(len(CONTENT)))
+                self.assertEqual(data_headers.get("Content-Encoding"), "zlib")
+                self.assertEqual(data_headers.get("Trailer"), "Content-Digest")
+                body = io.BytesIO()
+                received, error = receive_body(data, data_headers, body, len(CONTENT))
+            finally:
+                data.close()
+        finally:
+            close_session(session)
+        self.assertIsNone(error)
+        self.assertEqual(received, len(CONTENT))
+        self.assertEqual(body.getvalue(), CONTENT)
+
+
+if __name__ == "__main__":
+    unittest.main()
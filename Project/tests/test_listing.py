@@ -0,0 +1,67 @@
+# LS paging arguments are checked before the server commits to a reply: a
+# Limit below 1 or an After that is not a file name gets "FAILURE 400", and
+# the session carries on.
+#
+# usage: python3 -m unittest discover -s tests   (or python3 -m pytest tests)
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from FTPClient import close_session, connect_session, open_data_channel
+from local_server import start_server, stop_server
+
+
+class ListingArgumentsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        uploads = os.path.join(self.directory.name, "uploads")
+        os.makedirs(uploads)
+        for name in ("a.txt", "b.txt", "c.txt"):
+            open(os.path.join(uploads, name), 'wb').close()
+        self.server, self.port = start_server(self.directory.name, [])
+        self.session = connect_session("127.0.0.1", self.port, verbose=False)
+
+    def tearDown(self):
+        close_session(self.session)
+        stop_server(self.server)
+        self.directory.cleanup()
+
+    def list_page(self, headers):
+        response, data = open_data_channel(self.session, "LS", headers=headers, verbose=False)
+        if data is None:
+            return response, None
+        try:
+            data_headers = data.read_headers()
+            body = data.read_exact(int(data_headers["Content-Length"]))
+        finally:
+            data.close()
+        return response, (bytes(body).decode().split("\n"), data_headers.get("Next-After"))
+
+    def assertRejected(self, headers, reply):
+        response, page = self.list_page(headers)
+        self.assertIsNone(page)
+        self.assertEqual(response, reply)
+        # The session is still usable
+        response, page = self.list_page({"Limit": "2"})
+        self.assertEqual(page, (["a.txt", "b.txt"], "b.txt"))
+
+    def test_zero_limit(self):
+        self.assertRejected({"Limit": "0"}, "FAILURE 400 Invalid Limit")
+
+    def test_negative_limit(self):
+        self.assertRejected({"Limit": "-5"}, "FAILURE 400 Invalid Limit")
+
+    def test_invalid_after(self):
+        self.assertRejected({"Limit": "2", "After": "../x"}, "FAILURE 400 Invalid After")
+
+    def test_paging(self):
+        response, page = self.list_page({"Limit": "2", "After": "b.txt"})
+        self.assertEqual(page, (["c.txt"], None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+# MuxChannel over a loopback connection: closed transfers are forgotten on
+# both sides, a slow consumer holds back its sender instead of buffering
+# the whole transfer, and a receiver that gives up does not stall the sender.
+#
+# usage: python3 -m unittest discover -s tests   (or python3 -m pytest tests)
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ftp_protocol import FRAME_DATA, TRANSFER_WINDOW, MuxChannel
+
+PAYLOAD = os.urandom(8 * TRANSFER_WINDOW + 12345)
+
+
+def read_all(transfer):
+    data = bytearray()
+    buffer = bytearray(64 * 1024)
+    while True:
+        count = transfer.recv_into(memoryview(buffer))
+        if not count:
+            return bytes(data)
+        data += buffer[:count]
+
+
+def queued_bytes(transfer):
+    with transfer.condition:
+        return sum(len(payload) for frame_type, payload in transfer.frames if frame_type == FRAME_DATA)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class MuxChannelTest(unittest.TestCase):
+    def setUp(self):
+        listener = socket.create_server(("127.0.0.1", 0))
+        left = socket.create_connection(listener.getsockname())
+        right, _ = listener.accept()
+        listener.close()
+        self.sender = MuxChannel(left).start()
+        self.receiver = MuxChannel(right).start()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def send(self, transfer_id, data):
+        transfer = self.sender.open(transfer_id)
+        transfer.send_headers({"Content-Length": str(len(data))})
+        transfer.sendall(data)
+        transfer.close()
+
+    def test_closed_transfers_are_not_kept(self):
+        for transfer_id in range(1, 101):
+            self.send(transfer_id, b"x" * 1000)
+            transfer = self.receiver.open(transfer_id)
+            self.assertEqual(transfer.read_headers()["Content-Length"], "1000")
+            self.assertEqual(read_all(transfer), b"x" * 1000)
+            # Answering on the same transfer sends a FRAME_END that reaches
+            # the sender after it has closed its side
+            transfer.send_headers({"Status": "done"})
+            transfer.close()
+        self.assertTrue(wait_for(lambda: not self.sender.transfers and not self.receiver.transfers),
+                        f"{len(self.sender.transfers)} and {len(self.receiver.transfers)} transfers left")
+
+    def test_slow_consumer_holds_back_sender(self):
+        thread = threading.Thread(target=self.send, args=(1, PAYLOAD))
+        thread.start()
+        self.assertTrue(wait_for(lambda: 1 in self.receiver.transfers))
+        transfer = self.receiver.transfers[1]
+        self.assertTrue(wait_for(lambda: queued_bytes(transfer) >= TRANSFER_WINDOW))
+        time.sleep(0.2)
+        self.assertTrue(thread.is_alive())
+        self.assertLessEqual(queued_bytes(transfer), TRANSFER_WINDOW)
+        transfer.read_headers()
+        self.assertEqual(read_all(transfer), PAYLOAD)
+        transfer.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_abandoned_transfer_does_not_stall_sender(self):
+        thread = threading.Thread(target=self.send, args=(1, PAYLOAD))
+        thread.start()
+        transfer = self.receiver.open(1)
+        transfer.read_headers()
+        transfer.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(wait_for(lambda: not self.receiver.transfers))
+
+
+if __name__ == "__main__":
+    unittest.main()
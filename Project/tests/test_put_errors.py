@@ -0,0 +1,109 @@
+# A PUT whose file cannot be written (full disk, I/O error) is answered with
+# a FAILURE line saying why, and the bytes that did reach the disk are kept
+# and recorded in the checkpoint for resuming. Runs handle_put in-process
+# with file writes failing part way, with and without the write-behind
+# pipeline.
+#
+# usage: python3 -m unittest discover -s tests   (or python3 -m pytest tests)
+
+import errno
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import FTPServer
+import transfer
+from checkpoint import load_checkpoint
+from ftp_protocol import ProtocolStream, format_headers
+from storage import FileStorage
+
+SIZE = 2 * transfer.PIPELINE_MIN_SIZE
+FAIL_AFTER = 3 * transfer.DEFAULT_BUFFER_SIZE
+
+
+class Session:
+    def __init__(self, connection):
+        self.connection = connection
+
+
+def failing_write_view(error_number):
+    # write_view that stores FAIL_AFTER bytes, then fails the way a full or
+    # broken disk does
+    real_write_view = transfer.write_view
+    written = 0
+
+    def write_view(file, view):
+        nonlocal written
+        if written + len(view) > FAIL_AFTER:
+            raise OSError(error_number, os.strerror(error_number))
+        real_write_view(file, view)
+        written += len(view)
+    return write_view
+
+
+class PutErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        patch = mock.patch.object(FTPServer, "STORAGE", FileStorage(self.directory.name))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def put(self, error_number, depth):
+        # Returns the control channel replies to a PUT of SIZE bytes
+        control, client_control = socket.socketpair()
+        data, client_data = socket.socketpair()
+
+        def send():
+            try:
+                client_data.sendall(format_headers({"Content-Length": str(SIZE)}).encode())
+                client_data.sendall(bytes(SIZE))
+            except OSError:
+                pass  # The server gave up reading
+        sender = threading.Thread(target=send)
+        sender.start()
+        with mock.patch.object(transfer, "write_view", failing_write_view(error_number)), \
+                mock.patch.object(FTPServer, "IO_DEPTH", depth):
+            FTPServer.handle_put(Session(control), ProtocolStream(data), ["big.bin"], {})
+        data.close()
+        sender.join()
+        client_data.close()
+        control.close()
+        with client_control:
+            replies = ProtocolStream(client_control)
+            return [replies.read_line(), replies.read_line()]
+
+    def check(self, error_number, depth, reply):
+        self.assertEqual(self.put(error_number, depth), ["SUCCESS 200 OK", reply])
+        partial_path, checkpoint_path = FTPServer.partial_paths("big.bin")
+        # Writes fail once FAIL_AFTER bytes are on disk; what was written
+        # before is kept and recorded
+        received = load_checkpoint(checkpoint_path)["received"]
+        self.assertGreater(received, FAIL_AFTER - transfer.DEFAULT_BUFFER_SIZE)
+        self.assertLessEqual(received, FAIL_AFTER)
+        self.assertEqual(os.path.getsize(partial_path), received)
+        self.assertEqual(FTPServer.resumable_offset("big.bin"), received)
+
+    def test_full_disk(self):
+        self.check(errno.ENOSPC, 0, "FAILURE 507 Insufficient Storage")
+
+    def test_full_disk_write_behind(self):
+        self.check(errno.ENOSPC, 4, "FAILURE 507 Insufficient Storage")
+
+    def test_quota_write_behind(self):
+        self.check(errno.EDQUOT, 4, "FAILURE 507 Insufficient Storage")
+
+    def test_io_error_write_behind(self):
+        self.check(errno.EIO, 4, "FAILURE 500 Internal Server Error")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,320 @@
+# Bulk data movement for GET/PUT. Sending hands the file to the kernel with
+# socket.sendfile() (os.sendfile where the platform has it), receiving reads
+# straight into one preallocated buffer with recv_into() and writes slices of
+# that buffer to disk, so no per-chunk bytes objects are created. When the
+# body has to be hashed on its way out (see integrity.py), send_hashed()
+# reads it through one reused buffer instead, so the data still passes
+# through memory only once, or with send_mapped() takes it straight from a
+# mapping of the file (see storage.py).
+#
+# Disk and socket work overlap on large transfers. Reads for send_hashed()
+# and send_encoded() are done by a ReadAhead thread that fills up to depth
+# buffers while the caller hashes, compresses and sends the ones already
+# read, and receive_file() hands what it received to a WriteBehind thread
+# that writes it to disk while the next buffer is received, so a slow disk
+# and a fast link each wait only for themselves. Reads and writes stay in
+# order on one thread, so digests and progress reports see the bytes in file
+# order. sendfile() and mapped sends never read in user space; for them
+# Prefetcher asks the kernel to read the next window of the file ahead of
+# the send with POSIX_FADV_WILLNEED.
+
+import os
+import queue
+import threading
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Buffers a pipelined transfer keeps in flight between the disk and the
+# socket (0 or 1 for the serial loop), and the smallest transfer worth a
+# thread of its own
+DEFAULT_DEPTH = 4
+PIPELINE_MIN_SIZE = 4 * 1024 * 1024
+
+
+class Prefetcher:
+    # Keeps the kernel reading one window of a file ahead of position, so
+    # the disk is busy while the window before it is sent. Does nothing where
+    # posix_fadvise is missing or the file has no descriptor.
+    def __init__(self, file, window):
+        self.fd = file.fileno() if hasattr(os, "posix_fadvise") and hasattr(file, "fileno") else None
+        self.window = window
+        self.advised = 0  # End of the range asked for so far
+
+    def advance(self, position, end):
+        if self.fd is None or self.advised >= end or self.advised - position > self.window:
+            return
+        start = max(self.advised, position)
+        self.advised = min(end, start + 2 * self.window)
+        try:
+            os.posix_fadvise(self.fd, start, self.advised - start, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            self.fd = None
+
+
+def send_file(sock, file, offset=0, count=None, read_ahead=0):
+    # Returns the number of bytes sent; file must be opened in binary mode.
+    # With read_ahead, the file goes out in windows of that many bytes, each
+    # read by the kernel while the one before it is sent.
+    if count == 0:
+        return 0  # socket.sendfile treats a zero count as "until EOF"
+    if not read_ahead or count is None or count <= read_ahead:
+        return sock.sendfile(file, offset, count)
+    prefetcher = Prefetcher(file, read_ahead)
+    sent = 0
+    while sent < count:
+        prefetcher.advance(offset + sent, offset + count)
+        window = sock.sendfile(file, offset + sent, min(read_ahead, count - sent))
+        if not window:
+            break
+        sent += window
+    return sent
+
+
+class PositionalWriter:
+    # File-like sink that writes with os.pwrite at an advancing offset, so
+    # several receivers can fill different ranges of one file concurrently
+    def __init__(self, fd, offset=0):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        written = os.pwrite(self.fd, data, self.offset)
+        self.offset += written
+        return written
+
+
+def write_view(file, view):
+    # Unbuffered files may accept only part of a write
+    while view:
+        written = file.write(view)
+        view = view[written:]
+
+
+class ReadAhead:
+    # Reads count bytes of file from offset (to the end when count is None)
+    # on a thread of its own into depth buffers of buffer_size, feeding them
+    # to digest as they are read. Iterating gives a view of each buffer in
+    # turn; a buffer is read into again once the caller asks for the next
+    # one. Use as a context manager, so the thread is stopped if the caller
+    # gives up early.
+    def __init__(self, file, offset, count, buffer_size=DEFAULT_BUFFER_SIZE, depth=DEFAULT_DEPTH,
+                 digest=None):
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.digest = digest
+        size = max(1, buffer_size if count is None else min(buffer_size, count))
+        self.free = queue.Queue()
+        for _ in range(max(2, depth)):
+            self.free.put(bytearray(size))
+        self.filled = queue.Queue()  # (buffer, bytes read), (None, 0) at the end, or an error
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="read-ahead", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped = True
+        self.free.put(None)
+        self.thread.join()
+
+    def run(self):
+        try:
+            self.file.seek(self.offset)
+            remaining = self.count
+            while remaining is None or remaining > 0:
+                buffer = self.free.get()
+                if buffer is None or self.stopped:
+                    return
+                view = memoryview(buffer)
+                read = self.file.readinto(view if remaining is None else view[:min(len(view), remaining)])
+                if not read:
+                    break
+                if self.digest is not None:
+                    self.digest.update(view[:read])
+                self.filled.put((buffer, read))
+                if remaining is not None:
+                    remaining -= read
+            self.filled.put((None, 0))
+        except Exception as e:
+            self.filled.put(e)
+
+    def __iter__(self):
+        previous = None
+        while True:
+            item = self.filled.get()
+            if previous is not None:
+                self.free.put(previous)
+            if isinstance(item, Exception):
+                raise item
+            buffer, read = item
+            if buffer is None:
+                return
+            previous = buffer
+            yield memoryview(buffer)[:read]
+
+
+def send_hashed(sock, file, offset, count, digest, buffer_size=DEFAULT_BUFFER_SIZE, depth=0):
+    # send_file that also feeds the bytes sent to digest; returns the number
+    # of bytes sent, fewer than count if the file is shorter. With depth,
+    # a ReadAhead reads and hashes while the socket drains.
+    if depth > 1 and count >= PIPELINE_MIN_SIZE:
+        sent = 0
+        with ReadAhead(file, offset, count, buffer_size, depth, digest) as reader:
+            for view in reader:
+                sock.sendall(view)
+                sent += len(view)
+        return sent
+    buffer = bytearray(max(1, min(buffer_size, count)))
+    view = memoryview(buffer)
+    file.seek(offset)
+    sent = 0
+    while sent < count:
+        read = file.readinto(view[:min(len(view), count - sent)])
+        if not read:
+            break
+        digest.update(view[:read])
+        sock.sendall(view[:read])
+        sent += read
+    return sent
+
+
+def send_mapped(sock, mapping, offset, count, digest, chunk_size=DEFAULT_BUFFER_SIZE, prefetcher=None):
+    # send_hashed over an mmap of the file: the digest and the socket read
+    # the mapped pages directly, saving the copy into a buffer. Every view
+    # is released on the way out, or the mapping could not be closed. A
+    # Prefetcher on the mapped file keeps the pages ahead being read in.
+    with memoryview(mapping) as view:
+        end = min(len(view), offset + count)
+        position = offset
+        while position < end:
+            if prefetcher is not None:
+                prefetcher.advance(position, end)
+            with view[position:min(end, position + chunk_size)] as chunk:
+                digest.update(chunk)
+                sock.sendall(chunk)
+                position += len(chunk)
+    return position - offset
+
+
+class WriteBehind:
+    # Writes buffers handed over with put() to file on a thread of its own,
+    # feeding each to digest and reporting progress(written, total) once it
+    # is on its way to disk. take() gives a free buffer, waiting while depth
+    # of them are queued, and raises the error a write failed with.
+    def __init__(self, file, total, buffer_size=DEFAULT_BUFFER_SIZE, depth=DEFAULT_DEPTH,
+                 progress=None, digest=None):
+        self.file = file
+        self.total = total
+        self.progress = progress
+        self.digest = digest
+        self.written = 0
+        self.error = None
+        size = max(1, min(buffer_size, total))
+        self.free = queue.Queue()
+        for _ in range(max(2, depth)):
+            self.free.put(bytearray(size))
+        self.filled = queue.Queue()  # (buffer, bytes received), None at the end
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.filled.get()
+            if item is None:
+                return
+            buffer, count = item
+            if self.error is None:
+                # After a failed write the rest are dropped, but every buffer
+                # still goes back so take() cannot wait forever
+                try:
+                    view = memoryview(buffer)[:count]
+                    write_view(self.file, view)
+                    if self.digest is not None:
+                        self.digest.update(view)
+                    self.written += count
+                    if self.progress:
+                        self.progress(self.written, self.total)
+                except Exception as e:
+                    self.error = e
+            self.free.put(buffer)
+
+    def take(self):
+        buffer = self.free.get()
+        if self.error is not None:
+            raise self.error
+        return buffer
+
+    def put(self, buffer, count):
+        self.filled.put((buffer, count))
+
+    def close(self):
+        # Waits for the queued writes; returns how many bytes were written
+        self.filled.put(None)
+        self.thread.join()
+        return self.written
+
+
+def receive_file(stream, file, length, buffer_size=DEFAULT_BUFFER_SIZE, progress=None, digest=None,
+                 depth=0):
+    # Copies exactly length bytes from stream (anything with recv_into) into
+    # file and returns how many arrived before the peer stopped sending;
+    # digest, if given, is updated with every byte written. With depth, a
+    # WriteBehind writes while the next buffers are received; everything
+    # received is written before this returns or raises.
+    if depth > 1 and length >= PIPELINE_MIN_SIZE:
+        # Buffers are handed over full, so a peer that sends in small
+        # pieces still gets depth whole buffers in flight
+        writer = WriteBehind(file, length, buffer_size, depth, progress, digest)
+        received = 0
+        buffer, filled = None, 0
+        try:
+            while received < length:
+                if buffer is None:
+                    buffer, filled = writer.take(), 0
+                end = min(len(buffer), filled + length - received)
+                count = stream.recv_into(memoryview(buffer)[filled:end])
+                if not count:
+                    break
+                filled += count
+                received += count
+                if filled == len(buffer):
+                    writer.put(buffer, filled)
+                    buffer = None
+        finally:
+            if buffer is not None and filled:
+                writer.put(buffer, filled)
+            written = writer.close()
+        if writer.error is not None:
+            raise writer.error
+        return written
+    buffer = bytearray(max(1, min(buffer_size, length)))
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = stream.recv_into(view[:min(len(view), length - received)])
+        if not count:
+            break
+        write_view(file, view[:count])
+        if digest is not None:
+            digest.update(view[:count])
+        received += count
+        if progress:
+            progress(received, length)
+    return received
+
+
+def discard(stream, length, buffer_size=DEFAULT_BUFFER_SIZE):
+    # Reads and drops a body the receiver has decided not to keep, so the
+    # data channel stays in step with the sender
+    buffer = bytearray(max(1, min(buffer_size, length)))
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = stream.recv_into(view[:min(len(view), length - received)])
+        if not count:
+            break
+        received += count
+    return received
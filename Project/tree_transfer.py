@@ -0,0 +1,215 @@
+# Directory trees as one streamed tar archive (GETDIR and PUTDIR). A whole
+# tree goes over a single data connection instead of one GET or PUT per
+# file, each with its own command, data connection and headers.
+#
+# The archive is written with tarfile in stream mode straight onto the data
+# channel, so it never exists on disk, and the receiver extracts each member
+# as it arrives. Members carry their relative path, permission bits and
+# mtime; only directories and regular files are sent (symlinks and special
+# files are skipped), and owners are left out. Extracted files and
+# directories stay readable and writable by their owner whatever their
+# mode, so the tree can be sent on and replaced later.
+#
+# The archive's length is not known up front, so instead of Content-Length
+# the body is framed like an encoded body (see compression.py): u32-length
+# chunks ended by a zero-length chunk, compressed when Content-Encoding
+# says so. A Content-Digest trailer (see integrity.py) may follow; it covers
+# the archive bytes before compression.
+#
+# Extraction refuses members whose path is absolute or has an empty, "." or
+# ".." component, so an archive cannot write outside the directory it is
+# extracted into.
+
+import os
+import stat
+import tarfile
+
+from compression import CHUNK, CHUNK_SIZE, CODECS, MAX_CHUNK_SIZE, DecodingError, DecodingReader, send_chunk
+from transfer import write_view
+
+CONTENT_TYPE = "application/x-tar"
+
+
+class TreeError(Exception):
+    pass
+
+
+def walk_tree(root):
+    # Yields (name, path, lstat result) for the directories and regular
+    # files under root, in name order with every directory before its
+    # contents; name is the path relative to root with "/" separators
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        with os.scandir(os.path.join(root, relative) if relative else root) as scanner:
+            entries = sorted(scanner, key=lambda entry: entry.name)
+        directories = []
+        for entry in entries:
+            name = f"{relative}/{entry.name}" if relative else entry.name
+            try:
+                info = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue  # Removed while we were listing
+            if stat.S_ISDIR(info.st_mode):
+                directories.append(name)
+                yield name, entry.path, info
+            elif stat.S_ISREG(info.st_mode):
+                yield name, entry.path, info
+        pending.extend(reversed(directories))
+
+
+def member_path(root, name):
+    # Where member name of an archive goes under root; TreeError for a name
+    # that would leave it
+    parts = name.split("/")
+    if name.startswith("/") or any(part in ("", ".", "..") or "\0" in part for part in parts):
+        raise TreeError(f"Unsafe path in archive: {name!r}")
+    return os.path.join(root, *parts)
+
+
+class ArchiveWriter:
+    # File object tarfile writes the archive to: hashes it and sends it as
+    # chunks, compressed with encoding if given
+    def __init__(self, data, encoding=None, digest=None):
+        self.data = data
+        self.compressor = CODECS[encoding][0]() if encoding else None
+        self.digest = digest
+        self.total = 0  # Archive bytes, before compression
+
+    def write(self, block):
+        if self.digest is not None:
+            self.digest.update(block)
+        self.total += len(block)
+        send_chunk(self.data, self.compressor.compress(block) if self.compressor else block)
+        return len(block)
+
+    def finish(self):
+        if self.compressor is not None:
+            send_chunk(self.data, self.compressor.flush())
+        self.data.sendall(CHUNK.pack(0))
+
+
+class ChunkedReader:
+    # recv_into() of the chunk payloads of a body that is not compressed,
+    # like DecodingReader for one that is; returns 0 at the end marker and
+    # raises ConnectionError if the body is cut short
+    def __init__(self, stream):
+        self.stream = stream
+        self.remaining = 0  # Unread bytes of the current chunk
+        self.ended = False
+
+    def recv_into(self, view):
+        while not self.remaining:
+            if self.ended:
+                return 0
+            length, = CHUNK.unpack(self.stream.read_exact(CHUNK.size))
+            if length > MAX_CHUNK_SIZE:
+                raise DecodingError(f"Chunk of {length} bytes exceeds {MAX_CHUNK_SIZE}")
+            self.remaining = length
+            self.ended = length == 0
+        count = self.stream.recv_into(view[:min(len(view), self.remaining)])
+        if not count:
+            raise ConnectionError("Archive ended in the middle of a chunk")
+        self.remaining -= count
+        return count
+
+
+class ArchiveReader:
+    # File object tarfile reads the archive from, hashing what it returns
+    def __init__(self, data, encoding=None, digest=None):
+        self.body = DecodingReader(data, encoding) if encoding else ChunkedReader(data)
+        self.digest = digest
+        self.buffer = bytearray(CHUNK_SIZE)
+        self.total = 0
+
+    def read(self, size=-1):
+        view = memoryview(self.buffer)[:size if 0 <= size < len(self.buffer) else len(self.buffer)]
+        count = self.body.recv_into(view)
+        if self.digest is not None:
+            self.digest.update(view[:count])
+        self.total += count
+        return bytes(view[:count])
+
+    def finish(self):
+        # Reads what tarfile left after the end of the archive (the rest of
+        # its last record) up to the end of the body, so the trailer can be read
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def send_tree(data, root, encoding=None, digest=None):
+    # Streams the tree under root as an archive; returns (members, archive
+    # bytes sent)
+    writer = ArchiveWriter(data, encoding, digest)
+    members = 0
+    with tarfile.open(fileobj=writer, mode="w|", bufsize=CHUNK_SIZE, copybufsize=CHUNK_SIZE,
+                      format=tarfile.PAX_FORMAT) as archive:
+        for name, path, info in walk_tree(root):
+            # Built from the lstat result rather than by gettarinfo(), which
+            # looks up owner names for every member
+            member = tarfile.TarInfo(name)
+            member.mode = stat.S_IMODE(info.st_mode)
+            member.mtime = int(info.st_mtime)
+            if stat.S_ISDIR(info.st_mode):
+                member.type = tarfile.DIRTYPE
+                archive.addfile(member)
+            else:
+                try:
+                    file = open(path, 'rb')
+                except FileNotFoundError:
+                    continue
+                with file:
+                    member.size = os.fstat(file.fileno()).st_size
+                    archive.addfile(member, file)
+            members += 1
+    writer.finish()
+    return members, writer.total
+
+
+def receive_tree(data, root, encoding=None, digest=None, sync=False):
+    # Extracts the archive arriving on data into root as it is read;
+    # returns (members, archive bytes received). Raises TreeError for an
+    # unsafe or malformed archive, ConnectionError if it is cut short. With
+    # sync, every file is flushed to disk before the next one is written.
+    reader = ArchiveReader(data, encoding, digest)
+    members = 0
+    directories = []  # Their mtimes are set last; adding files changes them
+    created = {root}  # Directories known to exist, to save a makedirs() per file
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    try:
+        with tarfile.open(fileobj=reader, mode="r|", bufsize=CHUNK_SIZE) as archive:
+            for member in archive:
+                path = member_path(root, member.name)
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    created.add(path)
+                    directories.append((path, member))
+                elif member.isreg():
+                    parent = os.path.dirname(path)
+                    if parent not in created:
+                        os.makedirs(parent, exist_ok=True)
+                        created.add(parent)
+                    source = archive.extractfile(member)
+                    with open(path, 'wb', buffering=0) as file:
+                        while True:
+                            count = source.readinto(view)
+                            if not count:
+                                break
+                            write_view(file, view[:count])
+                        os.fchmod(file.fileno(), (member.mode & 0o777) | stat.S_IRUSR | stat.S_IWUSR)
+                        os.utime(file.fileno(), (member.mtime, member.mtime))
+                        if sync:
+                            os.fsync(file.fileno())
+                else:
+                    print(f"Skipping {member.name}: not a file or directory")
+                    continue
+                members += 1
+        reader.finish()
+    except (tarfile.TarError, DecodingError, IsADirectoryError, NotADirectoryError,
+            FileExistsError) as e:
+        raise TreeError(f"Invalid archive: {e}") from e
+    for path, member in reversed(directories):
+        os.chmod(path, (member.mode & 0o777) | stat.S_IRWXU)
+        os.utime(path, (member.mtime, member.mtime))
+    return members, reader.total
@@ -1,83 +1,173 @@
-# *****************************************************
-# This file implements a server for receiving the file
-# sent using sendfile(). The server receives a file and
-# prints its contents.
-# *****************************************************
-
-import socket
-
-# The port on which to listen
-listenPort = 1234
-
-# Create a welcome socket.
-welcomeSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-# Bind the socket to the port
-welcomeSock.bind(('', listenPort))
-
-# Start listening on the socket
-welcomeSock.listen(1)
-
-# ************************************************
-# Receives the specified number of bytes
-# from the specified socket
-# @param sock - the socket from which to receive
-# @param numBytes - the number of bytes to receive
-# @return - the bytes received
-# *************************************************
-def recvAll(sock, numBytes):
-    # The buffer to hold received bytes
-    recvBuff = b""  # Use bytes instead of str
-
-    # Keep receiving until all bytes are received
-    while len(recvBuff) < numBytes:
-        # Attempt to receive bytes
-        tmpBuff = sock.recv(numBytes - len(recvBuff))
-
-        # The other side has closed the socket
-        if not tmpBuff:
-            break
-
-        # Add the received bytes to the buffer
-        recvBuff += tmpBuff
-
-    return recvBuff
-
-
-# Accept connections forever
-while True:
-    print("Waiting for connections...")
-
-    # Accept connections
-    clientSock, addr = welcomeSock.accept()
-
-    print("Accepted connection from client: ", addr)
-    print("\n")
-
-    # The buffer to hold all data received from the client
-    fileData = b""  # Use bytes
-
-    # The size of the incoming file
-    fileSize = 0
-
-    # Receive the first 10 bytes indicating the size of the file
-    fileSizeBuff = recvAll(clientSock, 10)
-
-    # Convert the file size from bytes to int
-    try:
-        fileSize = int(fileSizeBuff.decode())  # Decode bytes to string for conversion
-    except ValueError:
-        print("Invalid file size received. Closing connection.")
-        clientSock.close()
-        continue
-
-    print("The file size is ", fileSize)
-
-    # Get the file data
-    fileData = recvAll(clientSock, fileSize)
-
-    print("The file data is: ")
-    print(fileData.decode())  # Decode bytes to string to display
-
-    # Close the client socket
-    clientSock.close()
+# *****************************************************
+# This file implements a server for receiving files
+# sent using sendfile(). Every frame (a 10-byte size
+# followed by that many bytes of data) is written
+# straight to disk through one preallocated buffer, so
+# files of any size are received in constant memory.
+# Each sender is served by its own thread.
+#
+# USAGE: python sendfileserv.py [PORT] [DIRECTORY]
+# *****************************************************
+
+import os
+import socket
+import sys
+import threading
+import time
+
+# The port on which to listen
+listenPort = int(sys.argv[1]) if len(sys.argv) > 1 else 1234
+
+# The directory received files are written to
+outputDir = sys.argv[2] if len(sys.argv) > 2 else "received"
+
+# The size of the frame header
+headerSize = 10
+
+# The size of the per-connection receive buffer; data is written
+# to disk whenever it fills up
+bufferSize = 1024 * 1024
+
+os.makedirs(outputDir, exist_ok=True)
+
+# Create a welcome socket.
+welcomeSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+welcomeSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+# Bind the socket to the port
+welcomeSock.bind(('', listenPort))
+
+# Start listening on the socket
+welcomeSock.listen(128)
+
+# ************************************************
+# Receives exactly len(view) bytes from the
+# specified socket into the specified buffer
+# @param sock - the socket from which to receive
+# @param view - a memoryview to receive into
+# @return - the number of bytes received, less than
+# len(view) only if the other side closed the socket
+# *************************************************
+def recvAllInto(sock, view):
+    numReceived = 0
+
+    # Keep receiving until the buffer is full
+    while numReceived < len(view):
+        count = sock.recv_into(view[numReceived:])
+
+        # The other side has closed the socket
+        if not count:
+            break
+
+        numReceived += count
+
+    return numReceived
+
+
+# ************************************************
+# Receives every frame sent over the specified
+# socket and writes the data to the specified file
+# @param sock - the socket from which to receive
+# @param fileObj - the file to write to
+# @return - (frames, bytes, complete) where complete
+# is False if the sender stopped in the middle of a
+# frame or sent an invalid header
+# *************************************************
+def recvFrames(sock, fileObj):
+    header = bytearray(headerSize)
+    headerView = memoryview(header)
+    recvBuff = bytearray(bufferSize)
+    recvView = memoryview(recvBuff)
+
+    # Bytes waiting in the buffer to be written
+    bufferUsed = 0
+
+    numFrames = 0
+    numBytes = 0
+    complete = False
+
+    while True:
+        # Receive the next frame header; the sender closing
+        # the socket here is the normal end of the file
+        count = recvAllInto(sock, headerView)
+        if count == 0:
+            complete = True
+            break
+        if count < headerSize:
+            print("Connection closed in the middle of a frame header.")
+            break
+
+        # The header must be exactly headerSize ASCII digits;
+        # int() alone would also take a sign ("-000000001"),
+        # spaces or underscores, and a negative size would
+        # keep the receive loop below going forever
+        if not header.isdigit():
+            print("Invalid frame header received.")
+            break
+        frameSize = int(header)
+
+        # Receive the frame data into the buffer, writing the
+        # buffer out each time it fills up
+        remaining = frameSize
+        while remaining:
+            if bufferUsed == bufferSize:
+                fileObj.write(recvView)
+                bufferUsed = 0
+            count = sock.recv_into(recvView[bufferUsed:bufferUsed + remaining])
+            if not count:
+                break
+            bufferUsed += count
+            remaining -= count
+            numBytes += count
+
+        if remaining:
+            print("Connection closed in the middle of a frame.")
+            break
+
+        numFrames += 1
+
+    fileObj.write(recvView[:bufferUsed])
+    return numFrames, numBytes, complete
+
+
+# ************************************************
+# Receives one file from the specified client and
+# stores it in the output directory. The data goes
+# to a .part file that is renamed once the sender
+# has finished, so a file without .part is complete.
+# @param clientSock - the client socket
+# @param addr - the address of the client
+# *************************************************
+def handleClient(clientSock, addr):
+    fileName = os.path.join(outputDir,
+                            f"{addr[0]}-{addr[1]}-{time.strftime('%Y%m%d-%H%M%S')}.dat")
+    startTime = time.monotonic()
+
+    try:
+        with clientSock, open(fileName + ".part", "wb") as fileObj:
+            numFrames, numBytes, complete = recvFrames(clientSock, fileObj)
+    except OSError as e:
+        print(f"Error receiving from {addr}: {e}")
+        return
+
+    seconds = max(time.monotonic() - startTime, 1e-9)
+    if complete:
+        os.replace(fileName + ".part", fileName)
+        print(f"Received {numBytes} bytes in {numFrames} frames from {addr} "
+              f"({numBytes / 2**20 / seconds:.1f} MiB/s), saved as {fileName}")
+    else:
+        print(f"Incomplete file from {addr}: kept {numBytes} bytes in {fileName}.part")
+
+
+print(f"Waiting for connections on port {listenPort}, saving files to {outputDir}/")
+
+# Accept connections forever
+while True:
+    # Accept connections
+    clientSock, addr = welcomeSock.accept()
+
+    print("Accepted connection from client: ", addr)
+
+    # Receive the file in its own thread so that other
+    # senders do not have to wait for this one
+    threading.Thread(target=handleClient, args=(clientSock, addr), daemon=True).start()